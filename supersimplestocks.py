@@ -3,7 +3,7 @@ NAME:   supersimplestocks.py
 
 AUTHOR: Graham Kerr
 
-PURPOSE:  Defines three classes
+PURPOSE:  Defines the following classes
            1) Stock -- Defines the attributes and methods
                        of the Stock class. 
            2) Trade -- Defines the attributes and methods 
@@ -14,6 +14,70 @@ PURPOSE:  Defines three classes
            3) Portfolio -- Defines the attributes and methods
                            of the Portfolio class. This is a 
                            collection of trades of any stock.             
+           4) Market -- A registry of the stocks that can be
+                        traded, and their symbol ids, which can
+                        also follow the trades of many portfolios
+                        for a market wide All Share Index.
+           5) SymbolTable -- Interns stock symbols to small
+                             integer ids.
+           6) TradeColumns -- Columnar (NumPy array) storage
+                              for a portfolio's trades. Used
+                              in place of a list of Trade 
+                              objects for very large portfolios.
+           7) TradeSeries -- The trades of one stock in time
+                             order, with running sums for fast
+                             volume weighted prices.
+           8) TradeIndex -- A TradeSeries for each stock in a 
+                            portfolio.
+           9) TradeJournal -- An append-only file of the trades
+                              added to a portfolio.
+           10) RollingWindow -- Running vol. weighted prices and 
+                                All Share Index over a standing
+                                window of the most recent trades.
+           11) TimeBars -- Open, high, low, close and volume bars 
+                           of one stock's trades at a fixed 
+                           time resolution.
+           12) ResultCache -- A least recently used cache of the
+                              results of a portfolio's queries.
+           13) ConcurrentPortfolio -- A portfolio that trades can be
+                                      added to from many threads 
+                                      at once, while others query
+                                      it.
+           14) ConcurrentTradeSeries -- A TradeSeries that can be 
+                                        read while trades are being
+                                        added to it.
+           15) ShardedPortfolio -- A Portfolio split by stock over
+                                   a pool of worker processes, to
+                                   use more than one core.
+           16) FeedConsumer -- Takes raw trades from a feed through
+                               a bounded queue, and adds them to a
+                               portfolio in batches.
+           17) FeedResult -- The result of a query made through a
+                             FeedConsumer, once it is ready.
+           18) Instrumentation -- Call counts, trades scanned and
+                                  latency histograms of the 
+                                  methods of Stock, Trade and 
+                                  Portfolio, recorded while 
+                                  enable_instrumentation is on.
+           19) Position -- The net quantity, average cost and 
+                           profit and loss of a portfolio's 
+                           trades of one stock.
+           20) QuantileSketch -- A fixed size summary of many 
+                                 values, from which their median
+                                 or any other quantile can be 
+                                 estimated.
+           21) TradeSketches -- QuantileSketches of the prices and
+                                quantities of one stock's trades,
+                                by period of time.
+           22) PortfolioBase -- What Portfolio and 
+                                ConcurrentPortfolio share: the 
+                                trades, their index and 
+                                positions, and the queries.
+          and the function screen_stocks, which computes the
+          dividend yield and P/E ratio of many stocks at many 
+          prices at once, and functions to read and write CSV 
+          and binary trade files and Arrow record batches, and
+          simulated_feed, a made up feed of trades for testing.
 
 DATE WRITTEN: 31st May 2016
      MOD. HISTORY: 
@@ -33,7 +97,188 @@ NOTES:   ** This code defines three classes. These can be imported
 """
 
 # Imported modules
-from time import gmtime, strftime, time
+import csv
+import inspect
+import logging
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from Queue import Full, Queue
+from collections import OrderedDict, deque
+from heapq import merge
+from itertools import islice
+from math import ceil, exp, log
+from operator import attrgetter, itemgetter
+from time import gmtime, sleep, strftime, time
+
+# NumPy is only needed for the columnar trade storage, so 
+# it is optional
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# pyarrow is only needed to export and load trades as Arrow 
+# record batches, so it is optional too
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# By default the classes print what they are doing and ask the
+# user to correct any invalid input. In non-interactive mode,
+# set with set_interactive(False), nothing is printed or asked:
+# invalid input raises a StockError and any messages go to the
+# 'supersimplestocks' logger instead, at DEBUG level for progress
+# and INFO level for results such as a stock not being found.
+INTERACTIVE = True
+
+logger = logging.getLogger('supersimplestocks')
+logger.addHandler(logging.NullHandler())
+
+
+def set_interactive(interactive):
+    """ 
+    NAME: set_interactive(interactive)
+
+    PURPOSE: To switch between interactive mode (printing and 
+             asking for input) and non-interactive mode (raising
+             exceptions, logging, and no console I/O at all)
+
+    INPUTS:  interactive = True or False
+
+    OUTPUTS: None
+
+    """
+    global INTERACTIVE
+    INTERACTIVE = interactive
+
+
+def _report(level, msg, *args):
+    """ Prints msg % args if interactive, otherwise logs it """
+    if INTERACTIVE:
+        print msg % args if args else msg
+    elif logger.isEnabledFor(level):
+        logger.log(level, msg.lstrip(), *args)
+
+
+class _ScanCounts(threading.local):
+    """ 
+    Holds, in stack, the number of trades scanned by each of a 
+    thread's instrumented calls in progress, innermost last
+    """
+    def __init__(self):
+        self.stack = []
+
+
+# Each thread's counts of trades scanned. The stacks are empty 
+# unless instrumentation is enabled (see enable_instrumentation),
+# so counting is one test of an empty list when it is off.
+_scan_counts = _ScanCounts()
+
+
+def _scanned(num):
+    """ Counts num trades scanned by this thread's current call """
+    stack = _scan_counts.stack
+    if stack:
+        stack[-1] += num
+
+
+# The fixed size binary record used for a trade in trade files:
+# the stock symbol (up to 8 characters), the price, quantity and
+# timestamp as little-endian doubles, then 'B' or 'S', padded 
+# out to 40 bytes. TRADE_DTYPE is the same record as a NumPy 
+# structured dtype.
+TRADE_RECORD = struct.Struct('<8sdddc7x')
+TRADE_DTYPE = {'names': ['stock', 'tr_price', 'tr_quant', 'timestamp', 'bors'],
+               'formats': ['S8', '<f8', '<f8', '<f8', 'S1'],
+               'offsets': [0, 8, 16, 24, 32],
+               'itemsize': TRADE_RECORD.size}
+
+# Prices and quantities must lie strictly between 0 and INF, 
+# which also rules out NaN (every comparison with NaN is False)
+INF = float('inf')
+
+
+class StockError(ValueError):
+    """ Raised for invalid input when not in interactive mode """
+
+
+class InvalidPriceError(StockError):
+    """ A zero, negative or non-finite price """
+
+
+class InvalidQuantityError(StockError):
+    """ A zero, negative or non-finite quantity """
+
+
+class InvalidSideError(StockError):
+    """ A buy or sell indicator other than 'B' or 'S' """
+
+
+class InvalidStockTypeError(StockError):
+    """ A stock type other than 'common' or 'preferred' """
+
+
+class UnknownStockError(StockError, KeyError):
+    """ A stock symbol that isn't in the market """
+
+
+def _interval(clock, trange, start, end, asof):
+    """ 
+    The [start, end) time interval of a query, with end None 
+    for no end. Reads the clock at most once.
+    """
+    if end is None:
+        end = asof
+    if start is None:
+        if trange is None:
+            raise StockError("either a time range or a start time is needed")
+        start = (clock() if asof is None else asof) - trange*60.
+    return start, end
+
+
+# The readable times of recent whole seconds, as shown for a 
+# trade. Cleared when it reaches _TIME_CACHE_SIZE.
+_time_strings = {}
+_TIME_CACHE_SIZE = 86400
+
+
+def _format_time(timestamp):
+    """ The readable time of a timestamp, cached by the second """
+    # gmtime truncates the fractions of a second in the same way
+    second = int(timestamp)
+    readable = _time_strings.get(second)
+    if readable is None:
+        if len(_time_strings) >= _TIME_CACHE_SIZE:
+            _time_strings.clear()
+        readable = _time_strings[second] = strftime("%Y-%m-%d, %H:%M:%S", 
+                                                    gmtime(second))
+    return readable
+
+
+def _forwards(times, rows, lo, hi):
+    """ 
+    Yields (timestamp, row) for the trades rows[lo:hi], in time
+    order, so that they can be merged with heapq.merge
+    """
+    for i in xrange(lo, hi):
+        yield times[i], rows[i]
+
+
+def _backwards(times, rows, lo, hi):
+    """ 
+    Yields (-timestamp, -row) for the trades rows[lo:hi], latest
+    first, so that they can be merged with heapq.merge
+    """
+    for i in xrange(hi - 1, lo - 1, -1):
+        yield -times[i], -rows[i]
 
 
 # Define the classes: Stock, Trade and Portfolio
@@ -56,6 +301,9 @@ class Stock(object):
        div_yield   = Computes the dividend yield
        pe_ratio    = Computes the P/E pe_ratio
        trade_stock = Will trade some stock, buying or selling
+       div_numerator   = The dividend used for the dividend yield
+       div_yield_batch = Dividend yields at an array of prices
+       pe_ratio_batch  = P/E ratios at an array of prices
 
     """
   
@@ -88,96 +336,145 @@ class Stock(object):
     	% (self.sym, self.sym, self.typ, self.lastdiv, 
            self.fixeddiv, self.parval)
 
-    def div_yield(self, price):
-    	""" 
-    	NAME: .div_yield(price)
-
-    	PURPOSE: Computes the dividend yield, given 'price'. 
-    	         For 'common' type stock this is:-
-    	               last dividend / price
-    	         For 'preferred' type stock this is:-
-    	               (fixed dividend * par value) / price
-    	
-    	INPUTS: price =  Price should be number > 0. 
-
-    	OUTPUTS: div_yield = The dividend yield in same units as price
-
-    	NOTES: The code will check the price and query the user to 
-    	       ascertain whether to quit or enter a new price if 
-    	       price is input < 0.
-
-    	"""
-        # Tell the user what is happening
-    	print "\n>>> Computing Dividend Yield Ratio for %s at price"\
-              "= %sp <<<" % (self.sym, price)
-
-    	#Checks to see if price is a float. If not it converts to a float
-    	if type(price) != float:
-    		price = float(price)
-    
-    	# Checks to see if a negative or zero value has been given.
-    	# The user can either fix the price, or exit the method.
-        while price <=0:
+    def _check_price(self, price, cancel="... Cancelling query"):
+        """ 
+        Returns price as a float, or None if the user cancels. 
+        A zero or negative price is corrected by asking the user
+        when interactive, or raises InvalidPriceError if not.
+        """
+        price = float(price)
+        while not 0 < price < INF:
+            if not INTERACTIVE:
+                raise InvalidPriceError(
+                        "%s: price must be > 0, not %s" % (self.sym, price))
             price_neg = raw_input(self.PRICE_ERR)
             price_neg = price_neg.upper()
             if price_neg == 'X':
-                print "... Cancelling query"
-                return
+                print cancel
+                return None
             elif price_neg == 'P':
                 price = float(raw_input(
                         "... Please enter the actual price now: "))
+        return price
+
+    def _check_quant(self, quant):
+        """ 
+        Returns quant as a float, or None if the user cancels. 
+        A zero or negative quantity is corrected by asking the 
+        user when interactive, or raises InvalidQuantityError 
+        if not.
+        """
+        quant = float(quant)
+        while not 0 < quant < INF:
+            if not INTERACTIVE:
+                raise InvalidQuantityError(
+                        "%s: quantity must be > 0, not %s" % (self.sym, quant))
+            quant_neg = raw_input(self.QUANT_ERR)
+            quant_neg = quant_neg.upper()
+            if quant_neg == 'X':
+                print "... Cancelling trade"
+                return None
+            elif quant_neg == 'Q':
+                quant = float(raw_input(
+                        " ... Please enter the actual quantity now: "))
+        return quant
+
+    def _check_bors(self, bors):
+        """ 
+        Returns bors as 'B' or 'S', or None if the user cancels.
+        Anything other than b, B, s or S is corrected by asking 
+        the user when interactive, or raises InvalidSideError 
+        if not.
+        """
+        bors = str(bors).upper()
+        while (bors != 'B') and (bors != 'S'):
+            if not INTERACTIVE:
+                raise InvalidSideError(
+                        "%s: bors must be 'B' or 'S', not %r" % (self.sym, bors))
+            bors_val = raw_input(self.BORS_ERR)
+            bors_val = bors_val.upper()
+            if bors_val == 'X':
+                print "... Cancelling trade"
+                return None
+            elif (bors_val == 'B') or (bors_val == 'S'):
+                bors = bors_val
+        return bors
+
+    def div_yield(self, price):
+        """ 
+        NAME: .div_yield(price)
+
+        PURPOSE: Computes the dividend yield, given 'price'. 
+                 For 'common' type stock this is:-
+                       last dividend / price
+                 For 'preferred' type stock this is:-
+                       (fixed dividend * par value) / price
+        
+        INPUTS: price =  Price should be number > 0. 
+
+        OUTPUTS: div_yield = The dividend yield in same units as price
+
+        NOTES: The code will check the price and query the user to 
+               ascertain whether to quit or enter a new price if 
+               price is input < 0. When not interactive an 
+               InvalidPriceError is raised instead, and an invalid
+               stock type raises InvalidStockTypeError.
+
+        """
+        # Tell the user what is happening
+        _report(logging.DEBUG, "\n>>> Computing Dividend Yield Ratio for %s"
+                " at price= %sp <<<", self.sym, price)
+
+        # Checks to see if a negative or zero value has been given.
+        # The user can either fix the price, or exit the method.
+        price = self._check_price(price)
+        if price is None:
+            return
             
-        # Compute the div yield depening on stock type
-        if self.typ == 'common':
-        	return self.lastdiv / price 
-        elif self.typ == 'preferred':
-        	return (self.fixeddiv * self.parval) / price
-        else:
+        # Compute the div yield depending on stock type
+        div = self.div_numerator()
+        if div is None:
+            if not INTERACTIVE:
+                raise InvalidStockTypeError(
+                        "%s: stock type must be 'common' or 'preferred', "
+                        "not %r" % (self.sym, self.typ))
             print "!! Invalid stock type entered. Please correct."
             print " ... should be either 'common' or 'preferred'"
             return 
+        return div / price
 
     def pe_ratio(self, price):
-    	""" 
-    	NAME: .pe_ratio(price)
+        """ 
+        NAME: .pe_ratio(price)
 
-    	PURPOSE: Computes the P/E ratio, given 'price'.
-    	         This is the value:- price/dividend 
-    	
-    	INPUTS: price =  Price should be number > 0. 
+        PURPOSE: Computes the P/E ratio, given 'price'.
+                 This is the value:- price/dividend 
+        
+        INPUTS: price =  Price should be number > 0. 
 
-    	OUTPUTS: pe_ratio -- The P/E ratio 
+        OUTPUTS: pe_ratio -- The P/E ratio 
 
-    	NOTES: The code will check the price and query the user to 
-    	       ascertain whether to quit or enter a new price if 
-    	       price is input < 0.
+        NOTES: The code will check the price and query the user to 
+               ascertain whether to quit or enter a new price if 
+               price is input < 0. When not interactive an 
+               InvalidPriceError is raised instead.
 
-    	"""     
+        """     
         # Tell the user what is happening       
-    	print "\n>>> Computing P/E Ratio <<<"
+        _report(logging.DEBUG, "\n>>> Computing P/E Ratio <<<")
 
-    	#Checks to see if price is a float. If not it converts to a float
-    	if type(price) != float:
-    		price = float(price)
-    
-    	# Checks to see if a negative or zero value has been given.
-    	# The user can either fix the price, or exit the method.
-        while price <=0:
-            price_neg = raw_input(self.PRICE_ERR)
-            price_neg = price_neg.upper()
-            if price_neg == 'X':
-                print "... Cancelling query"
-                return
-            elif price_neg == 'P':
-                price = float(raw_input(\
-                        "... Please enter the actual price now: "))
+        # Checks to see if a negative or zero value has been given.
+        # The user can either fix the price, or exit the method.
+        price = self._check_price(price)
+        if price is None:
+            return
 
         # If the dividend is currently zero then the p/e ratio is 
         # set to 0 to avoid div by zero
         if self.lastdiv == 0:
-        	return 0
+            return 0
         else:
-        	return price/self.lastdiv
+            return price/self.lastdiv
 
     def trade_stock(self, price, quant, bors):
         """ 
@@ -194,68 +491,151 @@ class Stock(object):
 
         NOTES: The code will check the price & quant inputs, and query 
                the user to ascertain whether to quit or enter a new value if 
-    	       either is input < 0.
+               either is input < 0. When not interactive a StockError
+               (InvalidPriceError, InvalidQuantityError or 
+               InvalidSideError) is raised instead.
 
         """
         # Tell the user what is happening
-    	print "\n>>> Beginning trade of %s <<<" % (self.sym)
+        _report(logging.DEBUG, "\n>>> Beginning trade of %s <<<", self.sym)
 
         # Checks to see if a negative or zero value has been given.
         # The user can either fix the price, or end the trade.
-        while price <=0:
-            price_neg = raw_input(self.PRICE_ERR)
-            price_neg = price_neg.upper()
-            if price_neg == 'X':
-                print "... Cancelling query"
-                return
-            elif price_neg == 'P':
-                price = float(raw_input(
-                        "... Please enter the actual price now: ")) 
-        if type(price) != float:
-        	price = float(price)  
+        price = self._check_price(price)
+        if price is None:
+            return
         
         # Checks to see if a negative or zero value has been given.
         # The user can either fix the quantity, or end the trade.
-        while quant <= 0:
-            quant_neg = raw_input(self.QUANT_ERR)
-            quant_neg = quant_neg.upper()
-            if quant_neg == 'X':
-                print "... Cancelling trade"
-                return
-            elif quant_neg == 'Q':
-                quant = float(raw_input(
-                        " ... Please enter the actual quantity now: "))  
-        if type(quant) != float:
-        	quant = float(quant)
+        quant = self._check_quant(quant)
+        if quant is None:
+            return
 
         # The indicator must be a string that is 'B' or 'S'
         # Converts to upper case so user can enter either
         # b, B, s or S
-        if type(bors) != str:
-    		bors = str(bors)
-    	bors = bors.upper()
-    	while (bors != 'B') and (bors != 'S'):
-            bors_val = raw_input(self.BORS_ERR)
-            bors_val = bors_val.upper()
-            if bors_val == 'X':
-                print "... Cancelling trade"
-                return
-            elif (bors_val == 'B') or (bors_val == 'S'):
-            	bors = bors_val
+        bors = self._check_bors(bors)
+        if bors is None:
+            return
             
         #Assign the timestamp to the current time in seconds
         timestamp = time()
         
         #Prints the trade, with the timestamp in a readable format
         # of YYYY/MM/DD, HH:MM:SS
-        print "    %s  -- %s %s of %s at %sp" % (
-                    strftime("%Y-%m-%d, %H:%M:%S", 
-        	        gmtime(timestamp)), bors, quant, self.sym, price
-                    )
+        if INTERACTIVE:
+            print "    %s  -- %s %s of %s at %sp" % (
+                        strftime("%Y-%m-%d, %H:%M:%S", 
+                        gmtime(timestamp)), bors, quant, self.sym, price
+                        )
 
         #Returns the trade as an object of the Trade class
         return Trade(self.sym, price, quant, bors, timestamp)
 
+    def div_numerator(self):
+        """
+        NAME: .div_numerator()
+
+        PURPOSE: Returns the dividend that the price is divided 
+                 by to give the dividend yield. For 'common' type
+                 stock this is the last dividend, and for 
+                 'preferred' type stock it is the fixed dividend 
+                 * par value.
+
+        INPUTS:  None (self)
+
+        OUTPUTS: The dividend, or None for an invalid stock type
+
+        """
+        if self.typ == 'common':
+            return self.lastdiv
+        elif self.typ == 'preferred':
+            return self.fixeddiv * self.parval
+        return None
+
+    def div_yield_batch(self, prices):
+        """
+        NAME: .div_yield_batch(prices)
+
+        PURPOSE: Computes the dividend yield at each of an array 
+                 of prices, in one vectorised step
+
+        INPUTS:  prices = The prices, any shape (array-like)
+
+        OUTPUTS: An array of dividend yields, the same shape as 
+                 prices
+
+        NOTES: Unlike div_yield nothing is printed and nothing is
+               asked of the user. Zero, negative or NaN prices give
+               a NaN dividend yield, as does an invalid stock type.
+
+        """
+        return screen_stocks([self], np.asarray(prices)[np.newaxis])[0][0]
+
+    def pe_ratio_batch(self, prices):
+        """
+        NAME: .pe_ratio_batch(prices)
+
+        PURPOSE: Computes the P/E ratio at each of an array of 
+                 prices, in one vectorised step
+
+        INPUTS:  prices = The prices, any shape (array-like)
+
+        OUTPUTS: An array of P/E ratios, the same shape as prices
+
+        NOTES: Unlike pe_ratio nothing is printed and nothing is
+               asked of the user. Zero, negative or NaN prices give
+               a NaN P/E ratio. As with pe_ratio, the P/E ratio is 0
+               if the last dividend is 0.
+
+        """
+        return screen_stocks([self], np.asarray(prices)[np.newaxis])[1][0]
+
+
+def screen_stocks(stocks, prices):
+    """
+    NAME: screen_stocks(stocks, prices)
+
+    PURPOSE: Computes the dividend yield and P/E ratio of many 
+             stocks at many prices in one vectorised step, e.g.
+             to screen a whole market against a set of price
+             snapshots
+
+    INPUTS:  stocks = The Stock objects (type = list)
+             prices = The prices, with the first axis matching
+                      stocks, e.g. shape (len(stocks), num_ticks)
+                      (array-like)
+
+    OUTPUTS: A tuple of (dividend yields, P/E ratios), arrays the
+             same shape as prices
+
+    NOTES: The stock type of each stock is looked at once, not 
+           once per price. Zero, negative or NaN prices are masked,
+           giving NaN rather than asking the user for a new price.
+           A stock of invalid type has NaN dividend yields.
+
+    """
+    prices = np.asarray(prices, dtype=float)
+    if prices.shape[:1] != (len(stocks),):
+        raise ValueError("prices must have one row per stock")
+
+    # Per stock values, shaped to broadcast along the price rows
+    shape = (len(stocks),) + (1,)*(prices.ndim - 1)
+    divs = np.array([stock.div_numerator() for stock in stocks], 
+                    dtype=float).reshape(shape)
+    lastdivs = np.array([stock.lastdiv for stock in stocks]).reshape(shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Mask the invalid prices
+        prices = np.where(prices > 0, prices, np.nan)
+
+        div_yield = divs / prices
+        # The P/E ratio is 0 where the last dividend is 0, as in 
+        # pe_ratio, but stays masked where the price is invalid
+        pe_ratio = np.where(lastdivs == 0, 0., prices / lastdivs)
+        pe_ratio[np.isnan(prices)] = np.nan
+    return div_yield, pe_ratio
+
 
 class Trade(object):
     """ 
@@ -267,28 +647,49 @@ class Trade(object):
                    (type = string)
        tr_price  = The price of stock in the trade (type = float)
        tr_quant  = The quantity of the stock traded (type = float)
-       bors      = A string indicating if the stock was bought or 
-                   sold (type = string)
+       bors      = 'B' if the stock was bought or 'S' if sold, 
+                   upper case whatever the case given; anything
+                   else raises an InvalidSideError (type = string)
        timestamp = The time of the trade in seconds (type = float)
 
     Methods are:
        __repr__  = To format the printing of the class details
        show_time = To show the timestamp in a readable format
+
+    NOTES: The attributes are held in __slots__ rather than an 
+           instance __dict__, which cuts the memory used by each 
+           trade (see supersimplestocks_benchmarks.py). As a 
+           result no other attributes can be set on a trade, and
+           __reduce__ says how to pickle (or copy) one.
       
     """
+
+    __slots__ = ('stock', 'tr_price', 'tr_quant', 'bors', 'timestamp')
     
     def __init__(self, stock, tr_price, tr_quant, bors, timestamp):
     	""" Initialise the class """
-        self.stock = stock.upper() #Capitalise if not already
+        #Capitalise if not already. Symbols that already are, 
+        #e.g. from a Market, are kept as the same string object
+        if not stock.isupper():
+            stock = stock.upper()
+        #Likewise bors, which must be 'B' or 'S'
+        if bors != 'B' and bors != 'S':
+            bors = _check_side(stock, bors)
+        self.stock = stock
         self.tr_price = tr_price
         self.tr_quant = tr_quant
         self.bors = bors
         self.timestamp = timestamp
 
+    def __reduce__(self):
+        """ Pickle the trade as the arguments to make it again """
+        return (Trade, (self.stock, self.tr_price, self.tr_quant, self.bors,
+                        self.timestamp))
+
     def __repr__(self):
     	""" Format the printing of the class """
     	#Convert to a readable time
-    	str1 = strftime("%Y-%m-%d, %H:%M:%S", gmtime(self.timestamp))
+    	str1 = _format_time(self.timestamp)
     	#Expand out the abbreviation
     	if self.bors == 'B':
     		str2 = "Bought"
@@ -312,239 +713,5240 @@ class Trade(object):
         OUTPUTS: Prints to screen and returns a string
 
     	"""
-        print "\n>>> Trade timestamp is: %s" % (
-                           strftime("%Y-%m-%d, %H:%M:%S", 
-                           gmtime(self.timestamp))
-                           )
-        return strftime("%Y-%m-%d, %H:%M:%S", gmtime(self.timestamp))
-
+        readable = _format_time(self.timestamp)
+        if INTERACTIVE:
+            print "\n>>> Trade timestamp is: %s" % (readable)
+        return readable
 
-class Portfolio(object):
-    """ 
-    The Portfolio class describes the attributes and methods 
-	associated with a trader's portfolio. Effectively, this
-	holds a set of trades. 
-
-	Attributes: 
-	    tradername  = The trader's name (type = string)
-        tradelist   = The trades previously completed, if
-                	  these are to be added to this 
-                	  portfolio. This should have an empty
-                	  set entered if a new portfolio. 
-                	  (type = list)      
-	Methods:
-	    __repr__    = To format the printing of portfolio
-	    add_trade   = To add a trade into the portfolio 
-	    volweightsp = The volume weighted stock price
-	    asi_calc    = The All Share Index
-	    earliest_tr = Print the time of the earlist trade 
-	    num_tr      = The number of trades in the portfolio
-	    num_stocks  = The number of different stocks
-	    stock_types = The stock types in the portfolio
-
-    """
-
-    def __init__(self, tradername, tradelist):
-        """ Initialise the portfolio object """
-    	self.tradername = tradername
-        self.tradelist = tradelist
-        
-    def __repr__(self):
-    	""" Format the printing of the portfolio object"""
-    	print "\n\n%s's Portfolio:" % self.tradername 
-        return "".join(repr(item) for item in self.tradelist)
 
-    def add_trade(self,trade):
-    	"""
-    	NAME: .add_trade(trade)
+class SymbolTable(object):
+    """
+    The SymbolTable class interns stock symbols, giving each
+    new symbol the next small integer id. Trades that are
+    stored by id can then be grouped and compared without
+    any string work.
 
-    	PURPOSE: To add a trade into the tradelist
+    Attributes:
+       names = The symbols, in the order of their ids (type = list)
+       ids   = Maps each symbol to its id (type = dict)
 
-    	INPUTS:  A trade object
+    Methods:
+       intern = Returns the id of a symbol, adding it if new
+       lookup = Returns the id of a symbol, or None if unknown
 
-    	OUTPUTS: The updated tradelist
+    """
 
-    	"""
-    	#Tell the user what is happening
-    	print "\n... Updating %s's Portfolio " % (self.tradername)
-    	
-        #Append the trade object to the list
-        return self.tradelist.append(trade)
+    def __init__(self, names=()):
+        """ Initialise the class """
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.intern(name)
 
-    def volweightsp(self, stock_search, trange):
-    	"""
-    	NAME: volweightsp(stock_search, trange)
-
-    	PURPOSE: To compute the volume weighted stock 
-    	         price for a given stock type over 
-    	         the time trange provided. This is computed as
-    	         sum( price*quantity ) / sum( quantity )
-
-    	INPUTS:  stock  = The abbreviation of the stock 
-    	                  name (type = string)
-    	         trange = The time range over which to 
-    	                  compute the vol weighted price
-    	                  in minutes (type = float)
-        
-        OUTPUTS: The vol. weighted stock price. 
-                
-        NOTES:   If the stock is either not present in the 
-                 portfolio, or hasn't been traded in the allotted
-                 time range then 0 (zero) is returned and the 
-                 trader is informed that the search criteria
-                 was not met.
+    def __len__(self):
+        """ The number of symbols in the table """
+        return len(self.names)
 
+    def intern(self, sym):
         """
-        #Tell the user what is happening
-        print "\n>>> Computing the Volume Weighted Stock Price <<<"
+        NAME: .intern(sym)
 
-        if type(stock_search) != str:
-            stock_search = str(stock_search)
+        PURPOSE: Returns the id of the symbol, giving it the
+                 next free id if it is not yet in the table
 
-        # Check if the stock if present, and if it is not exit 
-        # this retuning 0 (zero). It is present then extract the
-        # trades that match the search criteria into a new list
-        stock_pres = len([trades for trades in self.tradelist if
-                         trades.stock == stock_search.upper()]) >=1
-        stock_inrange = len([trades for trades in self.tradelist if
-        	             (trades.stock == stock_search.upper() and
-                         (time() - trades.timestamp) <= (trange*60.))
-                         ]) >=1
-        if stock_pres == False:
-            print "\n >>> The stock you are searching for (%s) is not"\
-                  " in %s's portfolio." % (
-                        stock_search.upper(), self.tradername)
-            return 0
-        elif stock_inrange == False:
-            print "\n >>> The stock (%s) has not been traded by %s within"\
-                  "the time range of %s mins." % (
-                        stock_search.upper(), self.tradername, trange)
-            return 0
-        else:
-            valid_trades = [trades for trades in self.tradelist if \
-                            (trades.stock == stock_search.upper()) and \
-                            ((time() - trades.timestamp) <= (trange*60.))]     
-            # Sum the value of price * quantity for the trades within 
-            # the valid trades, and also sum just the quanity so that 
-            #the weighted sum can then be computed
-            price_quant_sum = sum(trades.tr_price*trades.tr_quant 
-                                   for trades in valid_trades) 
-            quant_sum = sum(trades.tr_quant 
-                                   for trades in valid_trades)
-            return price_quant_sum/quant_sum
+        INPUTS:  sym = The stock abbreviation (upper case string)
+
+        OUTPUTS: The symbol id (type = int)
 
-    def asi_calc(self,trange):
         """
-        NAME: asi_calc()
+        symid = self.ids.get(sym)
+        if symid is None:
+            symid = self.ids[sym] = len(self.names)
+            self.names.append(sym)
+        return symid
 
-        PURPOSE: Computes the All Share Index (ASI) using the 
-                 geometric mean of the stock prices
+    def lookup(self, sym):
+        """ Returns the id of the symbol, or None if it is unknown """
+        return self.ids.get(sym)
 
-        INPUTS:  trange = The time in minutes over which to 
-                          compute the ASI
 
-        OUTPUTS: The ASI
+class Market(object):
+    """
+    The Market class is a registry of all of the stocks that 
+    can be traded. Each stock's symbol is interned in the 
+    market's symbol table and given a small integer id. 
+    Portfolios created with the market share its ids. The 
+    Stock objects themselves aren't changed, so one stock can
+    be in more than one market.
 
-        NOTES: In the event of an empty tradelist the 
-               method exits, returning zero, with a message
-               informing the user that the tradelist is empty.
+    Attributes:
+       stocks  = Maps each symbol to its Stock object (type = dict)
+       symbols = The ids of the symbols, including those of any
+                 other stocks traded by its columnar portfolios,
+                 which have ids but no Stock (type = SymbolTable)
+       portfolios = The portfolios whose trades the market follows
+                 (type = list)
+       index   = The running sums of the trades of all of the 
+                 portfolios, by stock and time. Each series' rows 
+                 count the trades in the order the market was 
+                 given them (type = TradeIndex)
+       owners  = The number of the portfolio each row's trade 
+                 came from, for unregister (type = array of ints)
+       num_tr  = The number of trades followed (type = int)
+       clock   = The function giving the current time, in 
+                 seconds (type = function, default time.time)
 
-        """   
-        #Tell the user what is happening
-        print "\n>>> Computing All Share Index (ASI) using %s's" \
-               " Portfolio <<<" % (self.tradername)
+    Methods:
+       add_stock = Adds a stock to the market
+       stock     = Looks up a stock by its symbol
+       symid     = Looks up the id of a stock's symbol
+       trade     = Trades a stock, given its symbol
+       screen    = Dividend yields and P/E ratios of every stock
+       register  = Follow the trades of a portfolio
+       unregister = Stop following a portfolio
+       volweightsp = The market wide vol. weighted stock price
+       volweightsp_all = The market wide vol. weighted price of 
+                   every stock traded within a time range
+       asi_calc  = The market wide All Share Index
 
-        #First check if the tradelist is empty
-        if len(self.tradelist) == 0:
-            print "\n ...%s's portfolio is empty, can't compute "\
-                  "all share index\n" % (self.tradername)
-            return 0
+    NOTES: The market doesn't copy the trades of the portfolios it
+           follows, only their prices, quantities and times, 
+           which it adds to its running sums as each portfolio's
+           add_trade (or add_trades) is called. Its queries 
+           then cost the same however many portfolios there are.
 
-        #Initially set the price product to an initial value of 1
-        price_product = 1
-        
-        
-        # This line finds the unique occurrences of a stock name, so 
-        # that we can then compute the volume weighted stock price 
-        # for each stock within the portfolio
-        stock_names = list(set([self.tradelist[i].stock 
-                                for i in range(len(self.tradelist))]))
-        num_stocks = len(stock_names)
-        
-        # Loop through each type of stock, compute the volume weighed 
-        # stock price and update the price_product variable
-        for name in stock_names:
-            price_product*=self.volweightsp(name,trange)
-          
-        if price_product == 1:
-            print " >>> No trades in given time range..."
-            return 0  
-        #The geometric mean is then:
-        else:
-        	return price_product**(1/float(num_stocks))
+    """
 
-    def earliest_tr(self):
-    	""" 
-    	NAME: earliest_tr()
+    def __init__(self, stocks=(), clock=time):
+        """ Initialise the class """
+        self.stocks = {}
+        self.symbols = SymbolTable()
+        for stock in stocks:
+            self.add_stock(stock)
+        self.portfolios = []
+        self.index = TradeIndex()
+        self.owners = array('i')
+        self.num_tr = 0
+        self.clock = clock
+        # The number given to each registered portfolio, keyed by
+        # its id, for owners
+        self._numbers = {}
+        self._next_number = 0
 
-    	PURPOSE: Prints the earliest trade to the screen, 
-    	         both the readable time and the time 
-    	         in seconds
-        
-        INPUTS:  None (self)
+    def __len__(self):
+        """ The number of stocks in the market """
+        return len(self.stocks)
 
-        OUTPUTS: A print statement and the time of the
-                 earliest trade is returned, in seconds
-                 from the current time
-    	"""
-    	#Grab the timestaps, in seconds, of each trade
-    	trade_times = [time()-self.tradelist[i].timestamp 
-                           for i in range(len(self.tradelist))]
-        print "\n>>> The earliest trade was %ss ago:" % (max(trade_times))
-        print (self.tradelist[trade_times.index(max(trade_times))])
-        return max(trade_times)
-            
-    def num_tr(self):
-    	""" 
-    	NAME: num_tr()
+    def __contains__(self, sym):
+        """ Whether the market has a stock with this symbol """
+        return sym.upper() in self.stocks
 
-    	PURPOSE: Returns the number of trades in the portfolio
+    def __iter__(self):
+        """ 
+        The stocks, in the order of their ids, skipping any symbols
+        traded by a portfolio that have no Stock in the market
+        """
+        stocks = self.stocks
+        return (stocks[sym] for sym in self.symbols.names if sym in stocks)
 
-        INPUTS: none (self)
+    def add_stock(self, stock):
+        """
+        NAME: .add_stock(stock)
 
-        OUTPUTS: The number of trades
+        PURPOSE: Adds a stock to the market, interning its symbol
+                 and giving it an id
 
-    	"""
-        return len(self.tradelist)
+        INPUTS:  stock = A Stock object
 
-    def num_stocks(self):
-    	""" 
-    	NAME: num_stocks()
+        OUTPUTS: The stock
 
-    	PURPOSE: Returns the number of stock types in the portfolio
+        NOTES: A stock with the same symbol as one already in the
+               market replaces it, keeping the same id. The id is
+               kept by the market, not the stock (see symid).
 
-        INPUTS: none (self)
+        """
+        sym = intern(stock.sym)
+        self.symbols.intern(sym)
+        self.stocks[sym] = stock
+        return stock
 
-        OUTPUTS: The number of unique stock types
+    def stock(self, sym):
+        """
+        NAME: .stock(sym)
 
-    	"""
-        return len(set([self.tradelist[i].stock 
-                         for i in range(len(self.tradelist))]))
+        PURPOSE: Looks up a stock by its symbol
 
-    def stock_types(self):
-    	""" 
-    	NAME: stock_types()
+        INPUTS:  sym = The stock abbreviation (type = string)
 
-    	PURPOSE: Returns a list of stock types in the portfolio
+        OUTPUTS: The Stock object
 
-        INPUTS: none (self)
+        NOTES: Raises an UnknownStockError if the market has no 
+               stock with this symbol.
 
-        OUTPUTS: A list containing the names of the types of
-                 stock within the portfolio
+        """
+        try:
+            return self.stocks[sym]
+        except KeyError:
+            try:
+                return self.stocks[sym.upper()]
+            except KeyError:
+                raise UnknownStockError("%s is not in the market" % (sym))
 
-    	"""
-        return list(set([self.tradelist[i].stock 
+    def symid(self, sym):
+        """ 
+        Returns the id of a stock's symbol in this market, raising
+        an UnknownStockError if the market has no such stock
+        """
+        for name in (sym, sym.upper()):
+            if name in self.stocks:
+                return self.symbols.lookup(name)
+        raise UnknownStockError("%s is not in the market" % (sym))
+
+    def trade(self, sym, price, quant, bors, portfolio=None):
+        """
+        NAME: .trade(sym, price, quant, bors, portfolio=None)
+
+        PURPOSE: Trades a stock, given its symbol, and optionally
+                 adds the trade to a portfolio
+
+        INPUTS:  sym       = The stock abbreviation (type = string)
+                 price     = As for Stock.trade_stock
+                 quant     = As for Stock.trade_stock
+                 bors      = As for Stock.trade_stock
+                 portfolio = A Portfolio to add the trade to, or None
+
+        OUTPUTS: A trade object, or None if the trade was cancelled
+
+        NOTES: The trade goes through Stock.trade_stock, so the
+               inputs are checked in the same way. An unknown symbol
+               is reported, or raises UnknownStockError when not in
+               interactive mode.
+
+        """
+        try:
+            stock = self.stock(sym)
+        except UnknownStockError:
+            if not INTERACTIVE:
+                raise
+            print "\n!! %s is not in the market. Cancelling trade" % (sym)
+            return
+        trade = stock.trade_stock(price, quant, bors)
+        if trade is not None and portfolio is not None:
+            portfolio.add_trade(trade)
+        return trade
+
+    def screen(self, prices):
+        """
+        NAME: .screen(prices)
+
+        PURPOSE: Computes the dividend yield and P/E ratio of every
+                 stock in the market, at many prices at once
+
+        INPUTS:  prices = The prices, with one row per stock in the 
+                          order the market gives them (that of 
+                          their ids) (array-like)
+
+        OUTPUTS: A tuple of (dividend yields, P/E ratios), as for 
+                 screen_stocks
+
+        """
+        return screen_stocks(list(self), prices)
+
+    def register(self, portfolio):
+        """
+        NAME: .register(portfolio)
+
+        PURPOSE: Follows the trades of a portfolio, both those it 
+                 already has and those added to it from now on
+
+        INPUTS:  portfolio = A Portfolio object
+
+        OUTPUTS: None
+
+        NOTES: If the portfolio can't be followed (its add_listener
+               raises), the error is passed on and the market is 
+               left as it was. A ConcurrentPortfolio calls no 
+               listeners, so can't be registered.
+
+        """
+        if id(portfolio) in self._numbers:
+            return
+        # Listen first, so that a portfolio which can't be followed
+        # leaves the market as it was
+        portfolio.add_listener(self._listener)
+        number = self._numbers[id(portfolio)] = self._next_number
+        self._next_number += 1
+        try:
+            trades = portfolio.tradelist
+            self._add_trades(number, [trade.stock for trade in trades], 
+                             [trade.tr_price for trade in trades],
+                             [trade.tr_quant for trade in trades],
+                             [trade.timestamp for trade in trades])
+        except Exception:
+            portfolio.remove_listener(self._listener)
+            del self._numbers[id(portfolio)]
+            raise
+        self.portfolios.append(portfolio)
+
+    def unregister(self, portfolio):
+        """
+        NAME: .unregister(portfolio)
+
+        PURPOSE: Stops following a portfolio, and takes its trades
+                 out of the market's running sums
+
+        INPUTS:  portfolio = A registered Portfolio object
+
+        OUTPUTS: None
+
+        NOTES: Only the trades the market was given by this 
+               portfolio are taken out, found by their owners. 
+               The other portfolios' trades stay as they are, 
+               including any they have since compacted away (see 
+               Portfolio.set_retention). A portfolio that isn't 
+               registered is left alone.
+
+        """
+        number = self._numbers.pop(id(portfolio), None)
+        if number is None:
+            return
+        portfolio.remove_listener(self._listener)
+        self.portfolios = [other for other in self.portfolios 
+                           if other is not portfolio]
+        owners = self.owners
+        self.num_tr -= self.index.remove(lambda row: owners[row] == number)
+
+    def _listener(self, portfolio, stocks, prices, quants, timestamps):
+        """ Called with the trades added to a registered portfolio """
+        self._add_trades(self._numbers[id(portfolio)], stocks, prices, 
+                         quants, timestamps)
+
+    def _add_trades(self, number, stocks, prices, quants, timestamps):
+        """ Adds the trades of portfolio number to the running sums """
+        row = len(self.owners)
+        if len(stocks) == 1:
+            self.index.add(stocks[0], prices[0], quants[0], timestamps[0], 
+                           row)
+        else:
+            self.index.add_batch(stocks, prices, quants, timestamps, row)
+        self.owners.extend(array('i', [number])*len(stocks))
+        self.num_tr += len(stocks)
+
+    def volweightsp(self, sym, trange=None, start=None, end=None, asof=None):
+        """
+        NAME: .volweightsp(sym, trange=None, start=None, end=None, 
+                           asof=None)
+
+        PURPOSE: The volume weighted price of a stock over the 
+                 trades of all of the portfolios the market follows
+
+        INPUTS:  sym    = The stock abbreviation (type = string)
+                 trange, start, end, asof = As for 
+                          Portfolio.volweightsp
+
+        OUTPUTS: The vol. weighted stock price, or 0 (zero) if the
+                 stock hasn't been traded in the time range
+
+        """
+        tstart, tend = _interval(self.clock, trange, start, end, asof)
+        series = self.index.series.get(str(sym).upper())
+        if series is None:
+            return 0
+        price_quant_sum, quant_sum, num_valid = series.window(tstart, tend)
+        if num_valid == 0:
+            return 0
+        return price_quant_sum/quant_sum
+
+    def volweightsp_all(self, trange=None, start=None, end=None, asof=None):
+        """
+        NAME: .volweightsp_all(trange=None, start=None, end=None, 
+                               asof=None)
+
+        PURPOSE: The volume weighted price of every stock traded 
+                 within the time range, over the trades of all of 
+                 the portfolios the market follows
+
+        INPUTS:  As for Portfolio.volweightsp
+
+        OUTPUTS: A dict of the vol. weighted price of each stock
+
+        """
+        tstart, tend = _interval(self.clock, trange, start, end, asof)
+        vwsp = {}
+        for sym, series in self.index.series.iteritems():
+            price_quant_sum, quant_sum, num_valid = series.window(tstart, 
+                                                                  tend)
+            if num_valid:
+                vwsp[sym] = price_quant_sum/quant_sum
+        return vwsp
+
+    def asi_calc(self, trange=None, start=None, end=None, asof=None):
+        """
+        NAME: .asi_calc(trange=None, start=None, end=None, asof=None)
+
+        PURPOSE: The All Share Index of the whole market: the 
+                 geometric mean of the vol. weighted prices of the
+                 stocks traded within the time range, over the 
+                 trades of all of the portfolios the market follows
+
+        INPUTS:  As for Portfolio.asi_calc
+
+        OUTPUTS: The ASI, or 0 (zero) if nothing has been traded 
+                 in the time range
+
+        """
+        prices = self.volweightsp_all(trange, start, end, asof).values()
+        if not prices:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0
+        return exp(sum(log(price) for price in prices)/len(prices))
+
+
+class TradeColumns(object):
+    """
+    The TradeColumns class stores a set of trades column by
+    column, in growable NumPy arrays, rather than as a list
+    of Trade objects. It behaves like a list of trades (len,
+    indexing, iteration and append all work) but a Trade
+    object is only built when a trade is asked for.
+
+    Attributes:
+       symbols   = The SymbolTable used to intern the stock symbols
+       price     = The price of each trade (type = float64 array)
+       quant     = The quantity of each trade (type = float64 array)
+       timestamp = The time of each trade in seconds
+                   (type = float64 array)
+       side      = +1 for a buy and -1 for a sell (type = int8 array)
+       symid     = The interned id of each trade's stock
+                   (type = int32 array)
+
+    Methods:
+       append = Adds a trade object to the columns
+       extend = Adds several trade objects to the columns
+       extend_records = Adds an array of trade records to the columns
+       from_records   = Makes columns from an array of trade records
+       to_records     = The trades as an array of trade records
+       drop   = Drops the first trades
+       keep   = Keeps only some of the trades
+
+    NOTES: The column attributes are views of the filled part of
+           the underlying arrays. They are only valid until the
+           next append, which may reallocate the arrays.
+
+    """
+
+    # The columns, and their dtypes
+    COLUMNS = (('price', 'f8'), ('quant', 'f8'), ('timestamp', 'f8'),
+               ('side', 'i1'), ('symid', 'i4'))
+    # The number of rows allocated for a new set of columns
+    INITIAL_SIZE = 1024
+    # The number of rows converted at a time when iterating
+    ITER_CHUNK = 4096
+
+    def __init__(self, trades=(), symbols=None):
+        """ Initialise the class """
+        if np is None:
+            raise ImportError("numpy is needed for columnar trade storage")
+        if symbols is None:
+            symbols = SymbolTable()
+        self.symbols = symbols
+        self._n = 0
+        # The records the columns are views of, if made by 
+        # from_records and not appended to since
+        self._records = None
+        for name, dtype in self.COLUMNS:
+            setattr(self, '_' + name, np.empty(self.INITIAL_SIZE, dtype))
+        self.extend(trades)
+
+    def __len__(self):
+        """ The number of trades held """
+        return self._n
+
+    def __getitem__(self, i):
+        """ Builds the trade (or list of trades for a slice) at i """
+        if isinstance(i, slice):
+            return [self._trade(j) for j in xrange(*i.indices(self._n))]
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("trade index out of range")
+        return self._trade(i)
+
+    def __iter__(self):
+        """ Builds each trade in turn, a chunk of rows at a time """
+        names = self.symbols.names
+        for start in xrange(0, self._n, self.ITER_CHUNK):
+            stop = min(start + self.ITER_CHUNK, self._n)
+            rows = zip(self._symid[start:stop].tolist(),
+                       self._price[start:stop].tolist(),
+                       self._quant[start:stop].tolist(),
+                       self._side[start:stop].tolist(),
+                       self._timestamp[start:stop].tolist())
+            for symid, price, quant, side, timestamp in rows:
+                yield Trade(names[symid], price, quant,
+                            'B' if side > 0 else 'S', timestamp)
+
+    @property
+    def price(self):
+        return self._price[:self._n]
+
+    @property
+    def quant(self):
+        return self._quant[:self._n]
+
+    @property
+    def timestamp(self):
+        return self._timestamp[:self._n]
+
+    @property
+    def side(self):
+        return self._side[:self._n]
+
+    @property
+    def symid(self):
+        return self._symid[:self._n]
+
+    def _trade(self, i):
+        """ Builds a Trade object from row i of the columns """
+        return Trade(self.symbols.names[self._symid[i]],
+                     self._price[i].item(), self._quant[i].item(),
+                     'B' if self._side[i] > 0 else 'S',
+                     self._timestamp[i].item())
+
+    def _grow(self, size):
+        """ Reallocates the columns to hold at least size rows """
+        size = max(size, 2*len(self._price))
+        self._records = None
+        for name, dtype in self.COLUMNS:
+            old = getattr(self, '_' + name)
+            new = np.empty(size, dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, '_' + name, new)
+
+    def append(self, trade):
+        """
+        NAME: .append(trade)
+
+        PURPOSE: Adds a trade to the end of the columns,
+                 interning its stock symbol
+
+        INPUTS:  trade = A trade object
+
+        OUTPUTS: None
+
+        """
+        i = self._n
+        if i == len(self._price):
+            self._grow(i + 1)
+        self._price[i] = trade.tr_price
+        self._quant[i] = trade.tr_quant
+        self._timestamp[i] = trade.timestamp
+        self._side[i] = 1 if trade.bors.upper() == 'B' else -1
+        self._symid[i] = self.symbols.intern(trade.stock)
+        self._n = i + 1
+
+    def extend(self, trades):
+        """
+        NAME: .extend(trades)
+
+        PURPOSE: Adds each trade in an iterable of trades to
+                 the end of the columns
+
+        INPUTS:  trades = An iterable of trade objects
+
+        OUTPUTS: None
+
+        """
+        trades = list(trades)
+        i, n = self._n, len(trades)
+        if i + n > len(self._price):
+            self._grow(i + n)
+        intern = self.symbols.intern
+        self._price[i:i+n] = [trade.tr_price for trade in trades]
+        self._quant[i:i+n] = [trade.tr_quant for trade in trades]
+        self._timestamp[i:i+n] = [trade.timestamp for trade in trades]
+        self._side[i:i+n] = [1 if trade.bors.upper() == 'B' else -1 
+                             for trade in trades]
+        self._symid[i:i+n] = [intern(trade.stock) for trade in trades]
+        self._n = i + n
+
+    def extend_records(self, records):
+        """
+        NAME: .extend_records(records)
+
+        PURPOSE: Adds an array of trade records to the end of the
+                 columns, without building any Trade objects
+
+        INPUTS:  records = A NumPy array with dtype TRADE_DTYPE
+
+        OUTPUTS: None
+
+        """
+        i, n = self._n, len(records)
+        if n == 0:
+            return
+        if i + n > len(self._price):
+            self._grow(i + n)
+        self._price[i:i+n] = records['tr_price']
+        self._quant[i:i+n] = records['tr_quant']
+        self._timestamp[i:i+n] = records['timestamp']
+        self._side[i:i+n], self._symid[i:i+n] = self._side_symid(records)
+        self._n = i + n
+
+    def _side_symid(self, records):
+        """ The side and symbol id columns for an array of records """
+        bors = records['bors']
+        side = np.where((bors == 'B') | (bors == 'b'), 1, -1).astype('i1')
+        # Intern each different symbol once
+        names, inverse = np.unique(records['stock'], return_inverse=True)
+        symids = np.array([self.symbols.intern(name.upper()) 
+                           for name in names.tolist()], dtype='i4')
+        return side, symids[inverse]
+
+    def drop(self, num):
+        """
+        NAME: .drop(num)
+
+        PURPOSE: Drops the first num trades
+
+        INPUTS:  num = The number of trades to drop (type = int)
+
+        OUTPUTS: None
+
+        NOTES: The columns become views starting num rows into the
+               arrays, so nothing is copied. The rows dropped are
+               freed when the arrays are next reallocated.
+
+        """
+        num = min(num, self._n)
+        for name, dtype in self.COLUMNS:
+            setattr(self, '_' + name, getattr(self, '_' + name)[num:])
+        if self._records is not None:
+            self._records = self._records[num:]
+        self._n -= num
+
+    def keep(self, mask):
+        """
+        NAME: .keep(mask)
+
+        PURPOSE: Keeps only the trades where mask is True, in 
+                 their order
+
+        INPUTS:  mask = One entry per trade (type = bool array)
+
+        OUTPUTS: None
+
+        NOTES: The kept trades are copied into new arrays.
+
+        """
+        n = int(np.count_nonzero(mask))
+        for name, dtype in self.COLUMNS:
+            old = getattr(self, '_' + name)[:self._n]
+            new = np.empty(max(n, self.INITIAL_SIZE), dtype)
+            new[:n] = old[mask]
+            setattr(self, '_' + name, new)
+        self._records = None
+        self._n = n
+
+    @classmethod
+    def from_records(cls, records, symbols=None):
+        """
+        NAME: TradeColumns.from_records(records, symbols=None)
+
+        PURPOSE: Makes a set of columns that uses the price, 
+                 quantity and timestamp fields of an array of 
+                 trade records in place, without copying them.
+                 This is how a memory mapped trade file is served.
+
+        INPUTS:  records = A NumPy array with dtype TRADE_DTYPE
+                 symbols = The SymbolTable to use, or None for a
+                           new one
+
+        OUTPUTS: The TradeColumns object
+
+        NOTES: Only the side and symbol id columns are built. The
+               first trade appended afterwards copies the columns 
+               into new arrays, as for any other reallocation.
+
+        """
+        cols = cls(symbols=symbols)
+        if len(records):
+            cols._price = records['tr_price']
+            cols._quant = records['tr_quant']
+            cols._timestamp = records['timestamp']
+            cols._side, cols._symid = cols._side_symid(records)
+            cols._n = len(records)
+            cols._records = records
+        return cols
+
+    def to_records(self):
+        """
+        NAME: .to_records()
+
+        PURPOSE: Returns the trades as an array of trade records,
+                 e.g. to analyse, save or add to another portfolio
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A NumPy array with dtype TRADE_DTYPE
+
+        NOTES: Columns made by from_records, with nothing added
+               since, give back the records they use, without 
+               copying them (so a memory mapped file stays 
+               mapped). Otherwise the records are built from the
+               columns. Raises a StockError if a stock symbol is
+               longer than the 8 characters a record holds.
+
+        """
+        if self._records is not None:
+            return self._records
+        records = np.zeros(self._n, dtype=TRADE_DTYPE)
+        _check_symbols(self.symbols.names[symid] 
+                       for symid in np.unique(self.symid))
+        names = np.array(self.symbols.names or [''], dtype='S8')
+        records['stock'] = names[self.symid]
+        records['tr_price'] = self.price
+        records['tr_quant'] = self.quant
+        records['timestamp'] = self.timestamp
+        records['bors'] = np.where(self.side > 0, 'B', 'S')
+        return records
+
+
+class TradeSeries(object):
+    """
+    The TradeSeries class holds the trades of a single stock 
+    in time order, along with running sums of price*quantity
+    and of quantity. The sums over any time window are then 
+    the difference of two running sums, found by bisection.
+
+    Attributes:
+       times   = The trade timestamps in ascending order 
+                 (type = array of doubles)
+       rows    = The position of each trade in the tradelist 
+                 (type = array of longs)
+       cum_pq  = The running sum of price*quantity, where cum_pq[i] 
+                 is the sum over the first i trades (type = array
+                 of doubles)
+       cum_q   = The running sum of quantity, as for cum_pq 
+                 (type = array of doubles)
+       pending = Late trades waiting to be merged into the series,
+                 as (timestamp, price*quantity, quantity, row) 
+                 (type = list)
+
+    Methods:
+       add    = Adds a trade to the series
+       extend = Adds a batch of trades to the series
+       flush  = Merges any late trades into the series
+       window = The sums over a time window
+       span   = The positions of the trades in a time window
+       drop   = Drops the trades before a time
+       remove = Removes the trades of some rows
+
+    NOTES: The columns are arrays rather than lists, so each 
+           trade takes 32 bytes, however many trades there are.
+
+           Trades normally arrive in time order and are simply
+           appended. Late trades wait in pending, and are merged
+           in together when the series is next read, or once 
+           there are more than MERGE_EVERY of them (or more than
+           an eighth of the series). Only the running sums after
+           the earliest of them are then redone, once for all of
+           them rather than once each.
+
+    """
+
+    # The fewest late trades that are merged in without a read
+    MERGE_EVERY = 1024
+
+    def __init__(self):
+        """ Initialise the class """
+        self.times = array('d')
+        self.rows = array('l')
+        self.cum_pq = array('d', [0.])
+        self.cum_q = array('d', [0.])
+        self.pending = []
+
+    def __len__(self):
+        """ The number of trades in the series """
+        return len(self.times) + len(self.pending)
+
+    def add(self, price, quant, timestamp, row):
+        """
+        NAME: .add(price, quant, timestamp, row)
+
+        PURPOSE: Adds a trade to the series, keeping it in 
+                 time order
+
+        INPUTS:  price     = The trade price (type = float)
+                 quant     = The trade quantity (type = float)
+                 timestamp = The trade time in seconds (type = float)
+                 row       = The trade's position in the tradelist
+
+        OUTPUTS: None
+
+        """
+        times = self.times
+        price_quant = float(price)*quant
+        if times and timestamp < times[-1]:
+            self.pending.append((timestamp, price_quant, quant, row))
+            if len(self.pending) > max(self.MERGE_EVERY, len(times) >> 3):
+                self.flush()
+            return
+        times.append(timestamp)
+        self.rows.append(row)
+        self.cum_pq.append(self.cum_pq[-1] + price_quant)
+        self.cum_q.append(self.cum_q[-1] + quant)
+
+    def extend(self, prices, quants, timestamps, rows):
+        """
+        NAME: .extend(prices, quants, timestamps, rows)
+
+        PURPOSE: Adds a batch of trades to the series
+
+        INPUTS:  prices     = The trade prices (type = list, or 
+                              NumPy array)
+                 quants     = The trade quantities (type = list, 
+                              or NumPy array)
+                 timestamps = The trade times in seconds, in 
+                              ascending order (type = list, or 
+                              NumPy array)
+                 rows       = The trades' positions in the 
+                              tradelist (type = list, or NumPy 
+                              array)
+
+        OUTPUTS: None
+
+        NOTES: If the whole batch is no earlier than the last 
+               trade it is appended, straight from the arrays if
+               given NumPy arrays. Otherwise it is merged in as 
+               for late trades.
+
+        """
+        if not len(timestamps):
+            return
+        times = self.times
+        if np is not None and isinstance(timestamps, np.ndarray):
+            price_quants = np.multiply(prices, quants, dtype='f8')
+            if times and timestamps[0] < times[-1]:
+                self._merge(zip(timestamps.tolist(), price_quants.tolist(),
+                                quants.tolist(), rows.tolist()))
+                return
+            times.fromstring(np.asarray(timestamps, 'f8').tostring())
+            self.rows.fromstring(np.asarray(rows, np.int_).tostring())
+            for cum, values in ((self.cum_pq, price_quants), 
+                                (self.cum_q, quants)):
+                cum.fromstring((cum[-1] + np.cumsum(values, dtype='f8'))
+                               .tostring())
+            return
+
+        price_quants = [float(price)*quant 
+                        for price, quant in zip(prices, quants)]
+        if times and timestamps[0] < times[-1]:
+            self._merge(zip(timestamps, price_quants, quants, rows))
+            return
+        times.extend(timestamps)
+        self.rows.extend(rows)
+        for cum, values in ((self.cum_pq, price_quants), 
+                            (self.cum_q, quants)):
+            total = cum[-1]
+            for value in values:
+                total += value
+                cum.append(total)
+
+    def _merge(self, late):
+        """ 
+        Merges late trades, as (timestamp, price*quantity, 
+        quantity, row), into the series 
+        """
+        late.sort(key=itemgetter(0))
+        times, rows, cum_pq, cum_q = self.times, self.rows, self.cum_pq, \
+                                     self.cum_q
+        # Recover the individual values of the trades held after
+        # the earliest late trade, then merge the two sets in time
+        # order. Trades already held come first when the times 
+        # are equal.
+        pos = bisect_right(times, late[0][0])
+        held = [(times[i], cum_pq[i+1] - cum_pq[i], cum_q[i+1] - cum_q[i],
+                 rows[i]) for i in xrange(pos, len(times))]
+        merged = sorted(held + late, key=itemgetter(0))
+        del times[pos:], rows[pos:], cum_pq[pos+1:], cum_q[pos+1:]
+        total_pq, total_q = cum_pq[-1], cum_q[-1]
+        for timestamp, price_quant, quant, row in merged:
+            total_pq += price_quant
+            total_q += quant
+            times.append(timestamp)
+            rows.append(row)
+            cum_pq.append(total_pq)
+            cum_q.append(total_q)
+
+    def flush(self):
+        """ Merges any late trades waiting in pending into the series """
+        if self.pending:
+            late, self.pending = self.pending, []
+            self._merge(late)
+
+    def window(self, start, end=None):
+        """
+        NAME: .window(start, end=None)
+
+        PURPOSE: Sums price*quantity and quantity over the 
+                 trades with start <= timestamp < end 
+
+        INPUTS:  start = The start of the window in seconds
+                 end   = The end of the window in seconds, or
+                         None for no end
+
+        OUTPUTS: A tuple of (sum of price*quantity, sum of 
+                 quantity, number of trades)
+
+        """
+        if self.pending:
+            self.flush()
+        lo = bisect_left(self.times, start)
+        if end is None:
+            hi = len(self.times)
+        else:
+            hi = bisect_left(self.times, end)
+        if hi <= lo:
+            return 0., 0., 0
+        return (self.cum_pq[hi] - self.cum_pq[lo], 
+                self.cum_q[hi] - self.cum_q[lo], hi - lo)
+
+    def span(self, start=None, end=None):
+        """
+        NAME: .span(start=None, end=None)
+
+        PURPOSE: Finds the trades with start <= timestamp < end,
+                 by bisection
+
+        INPUTS:  start = The start of the window in seconds, or 
+                         None for no start
+                 end   = The end of the window in seconds, or
+                         None for no end
+
+        OUTPUTS: A tuple of (times, rows, lo, hi), where 
+                 times[lo:hi] and rows[lo:hi] are the timestamps 
+                 and tradelist positions of the trades in the 
+                 window, in time order
+
+        """
+        if self.pending:
+            self.flush()
+        lo = 0 if start is None else bisect_left(self.times, start)
+        hi = len(self.times) if end is None else bisect_left(self.times, end)
+        return self.times, self.rows, lo, max(lo, hi)
+
+    def drop(self, end, num_rows):
+        """
+        NAME: .drop(end, num_rows)
+
+        PURPOSE: Drops the trades with timestamp < end from the 
+                 front of the series, in place, after the first 
+                 num_rows trades of the tradelist have been 
+                 removed
+
+        INPUTS:  end      = The time before which trades are dropped
+                 num_rows = The number of rows removed from the 
+                            front of the tradelist. The rows of 
+                            the trades kept are moved down by it.
+
+        OUTPUTS: The number of trades dropped
+
+        NOTES: The running sums are moved down to start from zero
+               again, so they don't grow without limit.
+
+        """
+        self.flush()
+        times, rows, cum_pq, cum_q = self.times, self.rows, self.cum_pq, \
+                                     self.cum_q
+        lo = bisect_left(times, end)
+        del times[:lo], rows[:lo], cum_pq[:lo], cum_q[:lo]
+        if np is not None:
+            # In place, through NumPy views of the arrays (which 
+            # must be let go of before the arrays can grow again)
+            for cum in (cum_pq, cum_q):
+                values = np.frombuffer(cum, dtype=cum.typecode)
+                values -= values[0]
+            if rows:
+                values = np.frombuffer(rows, dtype=rows.typecode)
+                values -= num_rows
+            del values
+        else:
+            for cum in (cum_pq, cum_q):
+                base = cum[0]
+                cum[:] = array(cum.typecode, [value - base for value in cum])
+            rows[:] = array(rows.typecode, [row - num_rows for row in rows])
+        return lo
+
+    def remove(self, removed):
+        """
+        NAME: .remove(removed)
+
+        PURPOSE: Removes the trades of the rows for which removed
+                 is true, in place, redoing the running sums of 
+                 the trades kept
+
+        INPUTS:  removed = A function of a trade's row, true if 
+                           the trade is to be removed
+
+        OUTPUTS: The number of trades removed
+
+        NOTES: The price*quantity and quantity of each trade kept
+               are the differences of the running sums, so are as
+               accurate as the running sums are.
+
+        """
+        self.flush()
+        times, rows, cum_pq, cum_q = self.times, self.rows, self.cum_pq, \
+                                     self.cum_q
+        kept_times, kept_rows = array('d'), array(rows.typecode)
+        kept_pq, kept_q = array('d', [0.]), array('d', [0.])
+        for i, row in enumerate(rows):
+            if not removed(row):
+                kept_times.append(times[i])
+                kept_rows.append(row)
+                kept_pq.append(kept_pq[-1] + (cum_pq[i+1] - cum_pq[i]))
+                kept_q.append(kept_q[-1] + (cum_q[i+1] - cum_q[i]))
+        num = len(times) - len(kept_times)
+        if num:
+            times[:], rows[:] = kept_times, kept_rows
+            cum_pq[:], cum_q[:] = kept_pq, kept_q
+        return num
+
+
+class ConcurrentTradeSeries(TradeSeries):
+    """
+    The ConcurrentTradeSeries class is a TradeSeries that can be
+    read by any number of threads while one thread at a time 
+    adds trades to it, without the readers taking a lock.
+
+    Attributes:
+       As for TradeSeries, plus
+       state = The published arrays and the number of trades in 
+               them, as (times, rows, cum_pq, cum_q, n). Readers 
+               only look at the first n trades of the arrays they
+               find here. (type = tuple)
+
+    Methods:
+       As for TradeSeries
+
+    NOTES: Trades added in time order are appended to the arrays,
+           past the published n, which is then updated. A late 
+           trade, which would move trades the readers can see, 
+           is instead merged into copies of the arrays that are
+           then published in their place (copy on write), 
+           straight away rather than waiting in pending.
+
+    """
+
+    def __init__(self):
+        """ Initialise the class """
+        TradeSeries.__init__(self)
+        self.state = (self.times, self.rows, self.cum_pq, self.cum_q, 0)
+
+    def __len__(self):
+        """ The number of trades published in the series """
+        return self.state[4]
+
+    def _copy(self):
+        """ Replaces the arrays with copies, for a late trade """
+        self.times, self.rows = self.times[:], self.rows[:]
+        self.cum_pq, self.cum_q = self.cum_pq[:], self.cum_q[:]
+
+    def _publish(self):
+        """ Makes the trades added so far visible to readers """
+        self.state = (self.times, self.rows, self.cum_pq, self.cum_q, 
+                      len(self.times))
+
+    def add(self, price, quant, timestamp, row):
+        """ As for TradeSeries.add """
+        if self.times and timestamp < self.times[-1]:
+            self._copy()
+            TradeSeries.add(self, price, quant, timestamp, row)
+            self.flush()
+        else:
+            TradeSeries.add(self, price, quant, timestamp, row)
+        self._publish()
+
+    def extend(self, prices, quants, timestamps, rows):
+        """ As for TradeSeries.extend """
+        if self.times and len(timestamps) and timestamps[0] < self.times[-1]:
+            self._copy()
+        TradeSeries.extend(self, prices, quants, timestamps, rows)
+        self._publish()
+
+    def window(self, start, end=None):
+        """ As for TradeSeries.window, over the published trades """
+        times, rows, cum_pq, cum_q, num = self.state
+        lo = bisect_left(times, start, 0, num)
+        if end is None:
+            hi = num
+        else:
+            hi = bisect_left(times, end, lo, num)
+        if hi <= lo:
+            return 0., 0., 0
+        return cum_pq[hi] - cum_pq[lo], cum_q[hi] - cum_q[lo], hi - lo
+
+    def span(self, start=None, end=None):
+        """ As for TradeSeries.span, over the published trades """
+        times, rows, cum_pq, cum_q, num = self.state
+        lo = 0 if start is None else bisect_left(times, start, 0, num)
+        hi = num if end is None else bisect_left(times, end, lo, num)
+        return times, rows, lo, hi
+
+
+class TradeIndex(object):
+    """
+    The TradeIndex class holds a TradeSeries for each stock
+    in a portfolio, so that a stock's trades within a time
+    range can be found without looking at any other trades.
+
+    Attributes:
+       series = Maps each stock symbol to the TradeSeries of
+                its trades (type = dict)
+       series_class = The class of the series, TradeSeries or
+                ConcurrentTradeSeries
+
+    Methods:
+       add         = Adds a trade to the index
+       add_batch   = Adds a batch of trades to the index
+       add_columns = Adds a batch of trades, as NumPy columns, to
+                     the index
+       drop        = Drops the trades before a time
+       remove      = Removes the trades of some rows
+
+    """
+
+    def __init__(self, stocks=(), prices=(), quants=(), timestamps=(),
+                 series_class=TradeSeries):
+        """ 
+        Initialise the class, indexing any trades given as 
+        parallel sequences with one entry per tradelist row 
+        """
+        self.series = {}
+        self.series_class = series_class
+        self.add_batch(stocks, prices, quants, timestamps)
+
+    def _series(self, stock):
+        """ The series of a stock, starting one if need be """
+        series = self.series.get(stock)
+        if series is None:
+            series = self.series[stock] = self.series_class()
+        return series
+
+    def add_batch(self, stocks, prices, quants, timestamps, start=0):
+        """
+        NAME: .add_batch(stocks, prices, quants, timestamps, start=0)
+
+        PURPOSE: Adds a batch of trades to the index, updating the
+                 series of each stock once for the whole batch
+
+        INPUTS:  stocks     = The stock symbols (type = list)
+                 prices     = The trade prices (type = list)
+                 quants     = The trade quantities (type = list)
+                 timestamps = The trade times in seconds (type = list)
+                 start      = The tradelist position of the first 
+                              trade in the batch (type = int)
+
+        OUTPUTS: None
+
+        """
+        # Sort the batch by time, then split it up by stock
+        batches = {}
+        for row in sorted(xrange(len(timestamps)), 
+                          key=timestamps.__getitem__):
+            batch = batches.get(stocks[row])
+            if batch is None:
+                batch = batches[stocks[row]] = []
+            batch.append(row)
+
+        for stock, batch in batches.iteritems():
+            self._series(stock).extend([prices[row] for row in batch], 
+                                       [quants[row] for row in batch],
+                                       [timestamps[row] for row in batch],
+                                       [start + row for row in batch])
+
+    def add_columns(self, symids, names, prices, quants, timestamps, 
+                    start=0):
+        """
+        NAME: .add_columns(symids, names, prices, quants, timestamps,
+                           start=0)
+
+        PURPOSE: Adds a batch of trades, given as NumPy columns, to
+                 the index, without making a Python object for 
+                 each trade
+
+        INPUTS:  symids     = The id of each trade's stock (type = 
+                              int array)
+                 names      = The stock symbol of each id 
+                              (type = list)
+                 prices     = The trade prices (type = float array)
+                 quants     = The trade quantities (type = float 
+                              array)
+                 timestamps = The trade times in seconds (type = 
+                              float array)
+                 start      = The tradelist position of the first 
+                              trade in the batch (type = int)
+
+        OUTPUTS: None
+
+        """
+        if not len(timestamps):
+            return
+        # Sort the batch by stock, then time, and split it up 
+        order = np.lexsort((timestamps, symids))
+        sorted_ids = symids[order]
+        bounds = (np.flatnonzero(np.diff(sorted_ids)) + 1).tolist()
+        for lo, hi in zip([0] + bounds, bounds + [len(order)]):
+            rows = order[lo:hi]
+            self._series(names[sorted_ids[lo]]).extend(
+                                    prices[rows], quants[rows], 
+                                    timestamps[rows], rows + start)
+
+    def add(self, stock, price, quant, timestamp, row):
+        """
+        NAME: .add(stock, price, quant, timestamp, row)
+
+        PURPOSE: Adds a trade to the series of its stock
+
+        INPUTS:  stock     = The stock symbol (type = string)
+                 price     = The trade price (type = float)
+                 quant     = The trade quantity (type = float)
+                 timestamp = The trade time in seconds (type = float)
+                 row       = The trade's position in the tradelist
+
+        OUTPUTS: None
+
+        """
+        self._series(stock).add(price, quant, timestamp, row)
+
+    def drop(self, end, num_rows):
+        """
+        NAME: .drop(end, num_rows)
+
+        PURPOSE: Drops the trades with timestamp < end, once they 
+                 have been removed from the front of the tradelist,
+                 trimming each series in place (see 
+                 TradeSeries.drop)
+
+        INPUTS:  end      = The time before which trades are dropped
+                 num_rows = The number of rows removed from the 
+                            front of the tradelist
+
+        OUTPUTS: The number of trades dropped
+
+        """
+        num = 0
+        for stock, series in self.series.items():
+            num += series.drop(end, num_rows)
+            if not len(series):
+                del self.series[stock]
+        return num
+
+    def remove(self, removed):
+        """ 
+        Removes the trades of the rows for which removed(row) is 
+        true from every series (see TradeSeries.remove), returning
+        the number removed
+        """
+        num = 0
+        for stock, series in self.series.items():
+            num += series.remove(removed)
+            if not len(series):
+                del self.series[stock]
+        return num
+
+
+class RollingWindow(object):
+    """
+    The RollingWindow class keeps running sums of price*quantity
+    and quantity for each stock over a standing window of the 
+    last 'trange' minutes. Each trade is added once and removed
+    once, when it ages out of the window, so the current vol. 
+    weighted prices and All Share Index are read without looking
+    at the trades again.
+
+    Attributes:
+       trange  = The length of the window in minutes (type = float)
+       stocks  = The stocks to follow, or None for all stocks
+                 (type = set)
+       entries = The trades in the window, in time order, as 
+                 (timestamp, stock, price*quantity, quantity)
+                 (type = deque)
+       sums    = Maps each stock in the window to its running
+                 [price*quantity, quantity, number of trades]
+                 (type = dict)
+
+    Methods:
+       add    = Adds a trade to the window
+       expire = Removes the trades that have aged out
+       vwsp   = The vol. weighted price of a stock in the window
+       asi    = The All Share Index of the stocks in the window
+
+    NOTES: The sum of the logs of the vol. weighted prices is also
+           kept up to date, for the All Share Index. As that sum 
+           is only ever changed by adding and subtracting, it is 
+           recomputed from scratch every RESUM_EVERY updates to 
+           stop rounding errors building up. A stock's own sums 
+           are added up again from its entries should taking off
+           a trade cancel out most of their digits.
+
+    """
+
+    # How often the sum of the log prices is recomputed
+    RESUM_EVERY = 100000
+
+    def __init__(self, trange, stocks=None):
+        """ Initialise the class """
+        self.trange = trange
+        if stocks is not None:
+            stocks = set(stock.upper() for stock in stocks)
+        self.stocks = stocks
+        self.entries = deque()
+        self.sums = {}
+        self._log_sum = 0.
+        self._updates = 0
+
+    def _update(self, stock, price_quant, quant, num):
+        """ Adds to (or takes from) the running sums of a stock """
+        sums = self.sums.get(stock)
+        if sums is None:
+            sums = self.sums[stock] = [0., 0., 0]
+        else:
+            self._log_sum -= log(sums[0]/sums[1])
+        sums[2] += num
+        if sums[2] == 0:
+            # Nothing left in the window, so drop the stock rather
+            # than keep a sum that should be, but isn't quite, zero
+            del self.sums[stock]
+            if not self.sums:
+                self._log_sum = 0.
+        else:
+            sums[0] += price_quant
+            sums[1] += quant
+            if (sums[0] <= abs(price_quant)*1e-6 or 
+                    sums[1] <= abs(quant)*1e-6):
+                # Taking off a trade much larger than the rest has
+                # cancelled out most of the digits of what is left,
+                # perhaps all of them, so add that up again
+                self._resum(stock, sums)
+            self._log_sum += log(sums[0]/sums[1])
+
+        self._updates += 1
+        if self._updates >= self.RESUM_EVERY:
+            self._updates = 0
+            self._log_sum = sum(log(pq/q) for pq, q, n in self.sums.values())
+
+    def _resum(self, stock, sums):
+        """ Recomputes the running sums of a stock from the entries """
+        sums[0] = sums[1] = 0.
+        for timestamp, entry_stock, price_quant, quant in self.entries:
+            if entry_stock == stock:
+                sums[0] += price_quant
+                sums[1] += quant
+
+    def add(self, stock, price, quant, timestamp, now=None):
+        """
+        NAME: .add(stock, price, quant, timestamp, now=None)
+
+        PURPOSE: Adds a trade to the window, if it is for a stock
+                 being followed and isn't already too old
+
+        INPUTS:  stock     = The stock symbol (type = string)
+                 price     = The trade price (type = float)
+                 quant     = The trade quantity (type = float)
+                 timestamp = The trade time in seconds (type = float)
+                 now       = The current time in seconds, or None
+                             to read the clock
+
+        OUTPUTS: None
+
+        """
+        if self.stocks is not None and stock not in self.stocks:
+            return
+        if now is None:
+            now = time()
+        if timestamp < now - self.trange*60.:
+            return
+
+        entry = (timestamp, stock, float(price)*quant, quant)
+        entries = self.entries
+        if not entries or timestamp >= entries[-1][0]:
+            entries.append(entry)
+        else:
+            # A late trade: rotate the later entries out of the
+            # way, add this one, then rotate them back
+            num_later = 0
+            for later in reversed(entries):
+                if later[0] <= timestamp:
+                    break
+                num_later += 1
+            entries.rotate(num_later)
+            entries.append(entry)
+            entries.rotate(-num_later)
+        self._update(stock, entry[2], quant, 1)
+        self.expire(now)
+
+    def expire(self, now=None):
+        """
+        NAME: .expire(now=None)
+
+        PURPOSE: Removes the trades that are older than the 
+                 window from the running sums
+
+        INPUTS:  now = The current time in seconds, or None to 
+                       read the clock
+
+        OUTPUTS: None
+
+        """
+        if now is None:
+            now = time()
+        tstart = now - self.trange*60.
+        entries = self.entries
+        while entries and entries[0][0] < tstart:
+            timestamp, stock, price_quant, quant = entries.popleft()
+            self._update(stock, -price_quant, -quant, -1)
+
+    def vwsp(self, stock, now=None):
+        """
+        NAME: .vwsp(stock, now=None)
+
+        PURPOSE: The vol. weighted price of a stock over the window
+
+        INPUTS:  stock = The stock symbol (type = string)
+                 now   = The current time in seconds, or None to 
+                         read the clock
+
+        OUTPUTS: The vol. weighted stock price, or None if the stock
+                 has no trades in the window
+
+        """
+        self.expire(now)
+        sums = self.sums.get(stock)
+        if sums is None:
+            return None
+        return sums[0]/sums[1]
+
+    def asi(self, now=None):
+        """
+        NAME: .asi(now=None)
+
+        PURPOSE: The All Share Index over the window, the geometric
+                 mean of the vol. weighted prices of the stocks 
+                 traded within it
+
+        INPUTS:  now = The current time in seconds, or None to 
+                       read the clock
+
+        OUTPUTS: The ASI, or None if there are no trades in the
+                 window
+
+        """
+        self.expire(now)
+        if not self.sums:
+            return None
+        return exp(self._log_sum/len(self.sums))
+
+
+class TimeBars(object):
+    """
+    The TimeBars class holds one stock's trades as a bar for 
+    each period of 'resolution' seconds in which it was traded:
+    the open, high, low and close prices, the volume, the sum 
+    of price*volume and the number of trades. Windowed prices
+    can then be found from the bars, without the trades.
+
+    Attributes:
+       resolution = The length of each bar in seconds (type = float)
+       starts     = The start time of each bar, in ascending 
+                    order (type = list)
+       opens, highs, lows, closes = The prices of each bar
+                    (type = list)
+       volumes    = The total quantity traded in each bar 
+                    (type = list)
+       pvs        = The sum of price*quantity in each bar 
+                    (type = list)
+       counts     = The number of trades in each bar (type = list)
+       first_ts, last_ts = The times of the first and last trade 
+                    in each bar (type = list)
+
+    Methods:
+       add    = Adds a trade to its bar
+       window = The sums over the bars in a time window
+       bars   = The bars in a time window, e.g. for charting
+
+    """
+
+    def __init__(self, resolution):
+        """ Initialise the class """
+        self.resolution = float(resolution)
+        self.starts = []
+        self.opens, self.highs, self.lows, self.closes = [], [], [], []
+        self.volumes, self.pvs, self.counts = [], [], []
+        self.first_ts, self.last_ts = [], []
+
+    def __len__(self):
+        """ The number of bars """
+        return len(self.starts)
+
+    def add(self, price, quant, timestamp):
+        """
+        NAME: .add(price, quant, timestamp)
+
+        PURPOSE: Adds a trade to the bar for its time, starting
+                 a new bar if need be
+
+        INPUTS:  price     = The trade price (type = float)
+                 quant     = The trade quantity (type = float)
+                 timestamp = The trade time in seconds (type = float)
+
+        OUTPUTS: None
+
+        """
+        start = timestamp - timestamp % self.resolution
+        starts = self.starts
+        if starts and start <= starts[-1]:
+            i = bisect_left(starts, start)
+        else:
+            i = len(starts)
+        if i == len(starts) or starts[i] != start:
+            # A new bar, normally at the end
+            for values, value in ((starts, start), (self.opens, price), 
+                                  (self.highs, price), (self.lows, price),
+                                  (self.closes, price), (self.volumes, 0.),
+                                  (self.pvs, 0.), (self.counts, 0),
+                                  (self.first_ts, timestamp), 
+                                  (self.last_ts, timestamp)):
+                values.insert(i, value)
+
+        if price > self.highs[i]:
+            self.highs[i] = price
+        if price < self.lows[i]:
+            self.lows[i] = price
+        if timestamp < self.first_ts[i]:
+            self.opens[i], self.first_ts[i] = price, timestamp
+        if timestamp >= self.last_ts[i]:
+            self.closes[i], self.last_ts[i] = price, timestamp
+        self.volumes[i] += quant
+        self.pvs[i] += float(price)*quant
+        self.counts[i] += 1
+
+    def _range(self, start, end):
+        """ The positions of the bars in a time window """
+        if start is None:
+            lo = 0
+        else:
+            lo = bisect_right(self.starts, start - self.resolution)
+        if end is None:
+            hi = len(self.starts)
+        else:
+            hi = bisect_left(self.starts, end)
+        return lo, hi
+
+    def window(self, start, end=None):
+        """
+        NAME: .window(start, end=None)
+
+        PURPOSE: Sums price*quantity and quantity over the bars 
+                 in a time window
+
+        INPUTS:  start = The start of the window in seconds
+                 end   = The end of the window in seconds, or
+                         None for no end
+
+        OUTPUTS: A tuple of (sum of price*quantity, sum of 
+                 quantity, number of trades)
+
+        NOTES: The window is widened out to whole bars: a bar is
+               included if any part of it is within the window.
+
+        """
+        lo, hi = self._range(start, end)
+        if hi <= lo:
+            return 0., 0., 0
+        return (sum(self.pvs[lo:hi]), sum(self.volumes[lo:hi]), 
+                sum(self.counts[lo:hi]))
+
+    def bars(self, start=None, end=None):
+        """
+        NAME: .bars(start=None, end=None)
+
+        PURPOSE: Returns the bars in a time window, e.g. for 
+                 charting
+
+        INPUTS:  start = The start of the window in seconds, or
+                         None for all of the bars before end
+                 end   = The end of the window in seconds, or 
+                         None for no end
+
+        OUTPUTS: A list of (start, open, high, low, close, volume,
+                 price*volume, count) tuples, one for each bar, in
+                 time order
+
+        """
+        lo, hi = self._range(start, end)
+        return zip(self.starts[lo:hi], self.opens[lo:hi], self.highs[lo:hi],
+                   self.lows[lo:hi], self.closes[lo:hi], 
+                   self.volumes[lo:hi], self.pvs[lo:hi], self.counts[lo:hi])
+
+
+class ResultCache(object):
+    """
+    The ResultCache class holds the results of recent queries 
+    of a portfolio, so that asking the same question again is
+    almost free. A result is used again until a trade is added
+    for a stock it depends on, or until the earliest trade it
+    used has aged out of its time range. 
+
+    Attributes:
+       maxsize     = The most results held. The least recently
+                     used are dropped first (type = int)
+       entries     = The results, as (result, generation, since,
+                     expires), in order of use (type = OrderedDict)
+       generations = The number of times trades have been added 
+                     for each stock (type = dict)
+       generation  = The number of times trades have been added
+                     for any stock (type = int)
+       hits, misses = The number of results found and not found
+                     (type = int)
+
+    Methods:
+       get   = Looks up a result
+       put   = Holds a result
+       touch = Notes that trades have been added for stocks
+       clear = Drops all of the results
+       stats = The hit and miss statistics
+
+    """
+
+    def __init__(self, maxsize=1024):
+        """ Initialise the class """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.generation = 0
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        """ The number of results held """
+        return len(self.entries)
+
+    def get(self, key, generation, now):
+        """
+        NAME: .get(key, generation, now)
+
+        PURPOSE: Looks up the result of a query
+
+        INPUTS:  key        = The query (type = tuple)
+                 generation = The current generation of the 
+                              stock(s) the query depends on
+                 now        = The current time in seconds
+
+        OUTPUTS: A tuple of (found, result)
+
+        """
+        entry = self.entries.pop(key, None)
+        if (entry is None or entry[1] != generation or 
+                not entry[2] <= now <= entry[3]):
+            self.misses += 1
+            return False, None
+        # Put it back as the most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, key, result, generation, since, expires):
+        """
+        NAME: .put(key, result, generation, since, expires)
+
+        PURPOSE: Holds the result of a query
+
+        INPUTS:  key, generation = As for get
+                 result     = The result of the query
+                 since      = The time the result was found at
+                 expires    = The last time the result holds at
+
+        OUTPUTS: None
+
+        """
+        self.entries[key] = (result, generation, since, expires)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def touch(self, stocks):
+        """ Notes that trades have been added for the given stocks """
+        generations = self.generations
+        for stock in stocks:
+            generations[stock] = generations.get(stock, 0) + 1
+        self.generation += 1
+
+    def clear(self):
+        """ Drops all of the results """
+        self.entries.clear()
+        self.generation += 1
+        self.generations = dict((stock, generation + 1) for stock, generation
+                                in self.generations.iteritems())
+
+    def stats(self):
+        """ 
+        The hit and miss statistics, as a dict of 'hits', 
+        'misses', 'hit_rate', 'size' and 'maxsize'
+        """
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits)/calls if calls else None,
+                'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class Position(object):
+    """
+    The Position class keeps a portfolio's position in one stock
+    up to date as trades are added, at the average cost of the 
+    stock held. Each trade costs the same to add, however many 
+    trades came before it.
+
+    Attributes:
+       stock     = The stock abbreviation (type = string)
+       net_quant = The quantity held, negative if short 
+                   (type = float)
+       avg_price = The average price the quantity held was 
+                   bought (or, if short, sold) at, or 0 (zero) 
+                   if nothing is held (type = float)
+       realized  = The profit (or, if negative, loss) made by
+                   the trades that reduced the position 
+                   (type = float)
+       bought    = The total quantity bought (type = float)
+       sold      = The total quantity sold (type = float)
+
+    Methods:
+       add        = Adds a trade to the position
+       unrealized = The profit or loss of the quantity held, 
+                    at a given price
+       summary    = All of the above, as a dict
+
+    NOTES: A trade adding to the position changes the average 
+           price. A trade reducing it realizes the difference 
+           between its price and the average price, and leaves 
+           the average price as it was. A trade taking the 
+           position from long to short (or short to long) does
+           both, the new position starting at the trade's price.
+
+    """
+
+    def __init__(self, stock):
+        """ Initialise the class """
+        self.stock = stock
+        self.net_quant = 0.
+        self.avg_price = 0.
+        self.realized = 0.
+        self.bought = 0.
+        self.sold = 0.
+
+    def __repr__(self):
+        """ Format the printing of the position """
+        return ("%s: %s @ %.2f, realized P&L %.2f" % 
+                (self.stock, self.net_quant, self.avg_price, self.realized))
+
+    def add(self, price, quant, bors):
+        """
+        NAME: .add(price, quant, bors)
+
+        PURPOSE: Adds a trade to the position
+
+        INPUTS:  price = The trade price (type = float)
+                 quant = The quantity traded (type = float)
+                 bors  = 'B' if bought, 'S' if sold, in either case
+                         (type = string)
+
+        OUTPUTS: None
+
+        NOTES: Any other bors raises an InvalidSideError, leaving 
+               the position as it was.
+
+        """
+        if bors != 'B' and bors != 'S':
+            bors = _check_side(self.stock, bors)
+        if bors == 'B':
+            self.bought += quant
+            signed = quant
+        else:
+            self.sold += quant
+            signed = -quant
+        net = self.net_quant
+        self.net_quant = net + signed
+        if net == 0 or (net > 0) == (signed > 0):
+            held = abs(net)
+            self.avg_price = (self.avg_price*held + price*quant)/(held + quant)
+            return
+
+        closed = min(quant, abs(net))
+        if net > 0:
+            self.realized += closed*(price - self.avg_price)
+        else:
+            self.realized += closed*(self.avg_price - price)
+        if self.net_quant == 0:
+            self.avg_price = 0.
+        elif (self.net_quant > 0) != (net > 0):
+            self.avg_price = float(price)
+
+    def unrealized(self, mark):
+        """
+        NAME: .unrealized(mark)
+
+        PURPOSE: The profit (or, if negative, loss) that would be
+                 made by closing the position at a given price
+
+        INPUTS:  mark = The price to value the position at 
+                        (type = float)
+
+        OUTPUTS: The unrealized profit or loss
+
+        """
+        return self.net_quant*(mark - self.avg_price)
+
+    def summary(self, mark=None):
+        """
+        NAME: .summary(mark=None)
+
+        PURPOSE: The position, as a dict
+
+        INPUTS:  mark = The price to value the position at, or 
+                        None (type = float)
+
+        OUTPUTS: A dict of 'stock', 'net_quant', 'avg_price', 
+                 'realized', 'unrealized' (None if no mark is
+                 given), 'bought' and 'sold'
+
+        """
+        return {'stock': self.stock, 'net_quant': self.net_quant, 
+                'avg_price': self.avg_price, 'realized': self.realized,
+                'unrealized': (self.unrealized(mark) if mark is not None
+                               else None),
+                'bought': self.bought, 'sold': self.sold}
+
+
+class QuantileSketch(object):
+    """
+    The QuantileSketch class summarises a stream of values in a 
+    fixed amount of memory, so that the median, 95th percentile
+    etc. of all of the values can be estimated without keeping 
+    (or sorting) them. It is a KLL sketch: values are held in 
+    levels, each value at level h standing for 2**h of the 
+    values added. When a level fills up it is sorted and every
+    other value (starting at random with the first or second) 
+    is moved up a level. Sketches can be merged, e.g. across 
+    portfolios or periods of time.
+
+    Attributes:
+       k          = The accuracy. The rank error of a quantile is
+                    roughly 1.7/k of the number of values, and 
+                    about 3*k values are held (type = int)
+       compactors = The values held at each level (type = list of
+                    lists)
+       count      = The number of values added (type = int)
+       min, max   = The smallest and largest values added, or 
+                    None (type = float)
+
+    Methods:
+       add       = Adds a value
+       merge     = Adds in the values of another sketch
+       rank      = The estimated number of values <= a value
+       quantile  = The estimated value at a quantile
+       quantiles = The estimated values at several quantiles
+
+    NOTES: The random choices are made with a random.Random of 
+           the sketch's own (seeded with seed), or with one 
+           shared by many sketches (rand), as a TradeSketches 
+           does, since each Random holds a few kB of state.
+
+    """
+
+    def __init__(self, k=200, seed=None, rand=None):
+        """ Initialise the class """
+        self.k = k
+        self.compactors = [[]]
+        self.count = 0
+        self.min = self.max = None
+        self._random = rand if rand is not None else random.Random(seed)
+        self._size = 0
+        self._max_size = self._capacity(0)
+        self._cdf = None
+
+    def __len__(self):
+        """ The number of values added """
+        return self.count
+
+    def _capacity(self, level):
+        """ How many values a level can hold before compacting """
+        depth = len(self.compactors) - level - 1
+        return int(ceil(self.k*(2./3.)**depth)) + 1
+
+    def _grow(self):
+        """ Adds a level at the top """
+        self.compactors.append([])
+        self._max_size = sum(self._capacity(level) 
+                             for level in xrange(len(self.compactors)))
+
+    def _compress(self):
+        """ Compacts the lowest level that is full """
+        for level, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self._grow()
+                items.sort()
+                # An odd value out stays at this level
+                last = items.pop() if len(items) % 2 else None
+                self.compactors[level + 1].extend(
+                                items[self._random.random() < 0.5::2])
+                del items[:]
+                if last is not None:
+                    items.append(last)
+                break
+        self._size = sum(len(items) for items in self.compactors)
+
+    def add(self, value):
+        """
+        NAME: .add(value)
+
+        PURPOSE: Adds a value to the sketch
+
+        INPUTS:  value = The value (type = float)
+
+        OUTPUTS: None
+
+        """
+        self.compactors[0].append(value)
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._size += 1
+        if self._size >= self._max_size:
+            self._compress()
+        self._cdf = None
+
+    def merge(self, other):
+        """
+        NAME: .merge(other)
+
+        PURPOSE: Adds the values summarised by another sketch to 
+                 this one, as if they had been added to it
+
+        INPUTS:  other = A QuantileSketch. It is not changed.
+
+        OUTPUTS: This sketch
+
+        """
+        if other.count == 0:
+            return self
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for items, other_items in zip(self.compactors, other.compactors):
+            items.extend(other_items)
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._size = sum(len(items) for items in self.compactors)
+        while self._size >= self._max_size:
+            self._compress()
+        self._cdf = None
+        return self
+
+    def _weights(self):
+        """ 
+        The values held, in order, and the running total of 
+        their weights, made once after each change
+        """
+        if self._cdf is None:
+            weighted = sorted((value, 2**level) 
+                              for level, items in enumerate(self.compactors)
+                              for value in items)
+            values = [value for value, weight in weighted]
+            totals = []
+            total = 0
+            for value, weight in weighted:
+                total += weight
+                totals.append(total)
+            self._cdf = values, totals
+        return self._cdf
+
+    def rank(self, value):
+        """ The estimated number of values added that are <= value """
+        values, totals = self._weights()
+        i = bisect_right(values, value)
+        return totals[i-1] if i else 0
+
+    def quantile(self, q):
+        """
+        NAME: .quantile(q)
+
+        PURPOSE: Estimates the value at a quantile of those added
+
+        INPUTS:  q = The quantile, from 0 to 1, e.g. 0.5 for the 
+                     median or 0.99 for the 99th percentile 
+                     (type = float)
+
+        OUTPUTS: The estimated value, or None if no values have 
+                 been added
+
+        """
+        if self.count == 0:
+            return None
+        if not 0 <= q <= 1:
+            raise StockError("a quantile must be from 0 to 1")
+        if q == 0:
+            return self.min
+        if q == 1:
+            return self.max
+        values, totals = self._weights()
+        i = bisect_left(totals, q*totals[-1])
+        return values[min(i, len(values) - 1)]
+
+    def quantiles(self, qs):
+        """ The estimated values at each of a list of quantiles """
+        return [self.quantile(q) for q in qs]
+
+
+class TradeSketches(object):
+    """
+    The TradeSketches class holds QuantileSketches of the prices
+    and quantities of one stock's trades, one pair for each 
+    period of 'bucket' seconds in which it was traded (or one 
+    pair for all time). The sketches of the periods in a time 
+    window are merged to answer a query, so the cost of a query
+    depends on the number of periods, not trades. At most 
+    max_periods periods are kept: older ones are rolled up into
+    a single pair of sketches, so the memory used is fixed.
+
+    Attributes:
+       k       = The accuracy of each sketch (type = int)
+       bucket  = The length of each period in seconds, or None
+                 for a single period (type = float)
+       max_periods = The most periods kept, or None for no limit
+                 (type = int)
+       starts  = The start time of each period, in ascending 
+                 order (type = list)
+       prices, quants = The sketches of each period (type = list
+                 of QuantileSketch objects)
+       rolled  = The price and quantity sketches of the periods 
+                 rolled up, or None (type = tuple)
+       rolled_from, rolled_to = The time span of the rolled up
+                 periods, or None (type = float)
+
+    Methods:
+       add    = Adds a trade to its period's sketches
+       window = The merged sketches of the periods in a time window
+       merge  = Adds in the sketches of another TradeSketches
+
+    NOTES: All of the sketches share one random.Random.
+
+    """
+
+    def __init__(self, k=200, bucket=None, max_periods=1440, seed=None):
+        """ Initialise the class """
+        self.k = k
+        self.bucket = float(bucket) if bucket is not None else None
+        self.max_periods = max_periods
+        self.starts = []
+        self.prices, self.quants = [], []
+        self.rolled = None
+        self.rolled_from = self.rolled_to = None
+        self._random = random.Random(seed)
+
+    def _sketch(self):
+        """ A new, empty QuantileSketch """
+        return QuantileSketch(self.k, rand=self._random)
+
+    def __len__(self):
+        """ The number of periods """
+        return len(self.starts)
+
+    def _period(self, start):
+        """ The position of a period, adding it if need be """
+        starts = self.starts
+        i = bisect_left(starts, start)
+        if i == len(starts) or starts[i] != start:
+            starts.insert(i, start)
+            self.prices.insert(i, self._sketch())
+            self.quants.insert(i, self._sketch())
+        return i
+
+    def _roll(self, start, end, prices, quants):
+        """ Adds the sketches of the span start to end to the roll up """
+        if self.rolled is None:
+            self.rolled = (self._sketch(), self._sketch())
+            self.rolled_from, self.rolled_to = start, end
+        else:
+            self.rolled_from = min(self.rolled_from, start)
+            self.rolled_to = max(self.rolled_to, end)
+        self.rolled[0].merge(prices)
+        self.rolled[1].merge(quants)
+
+    def _trim(self):
+        """ 
+        Rolls up the oldest periods while there are more than 
+        max_periods, or they overlap the roll up 
+        """
+        starts = self.starts
+        while starts and ((self.max_periods is not None and 
+                           len(starts) > self.max_periods) or 
+                          (self.rolled_to is not None and 
+                           starts[0] < self.rolled_to)):
+            start = starts.pop(0)
+            self._roll(start, start + self.bucket, self.prices.pop(0), 
+                       self.quants.pop(0))
+
+    def add(self, price, quant, timestamp):
+        """
+        NAME: .add(price, quant, timestamp)
+
+        PURPOSE: Adds a trade to the sketches of its period
+
+        INPUTS:  price     = The trade price (type = float)
+                 quant     = The trade quantity (type = float)
+                 timestamp = The trade time in seconds (type = float)
+
+        OUTPUTS: None
+
+        """
+        if self.bucket is None:
+            start = 0.
+        else:
+            start = timestamp - timestamp % self.bucket
+        if self.starts and self.starts[-1] == start:
+            i = len(self.starts) - 1
+        elif self.rolled_to is not None and start < self.rolled_to:
+            # A late trade from a period already rolled up
+            self.rolled[0].add(price)
+            self.rolled[1].add(quant)
+            self.rolled_from = min(self.rolled_from, start)
+            return
+        else:
+            i = self._period(start)
+            if self.max_periods is not None and \
+                    len(self.starts) > self.max_periods:
+                # The new period may itself be the one rolled up
+                self._trim()
+                return self.add(price, quant, timestamp)
+        self.prices[i].add(price)
+        self.quants[i].add(quant)
+
+    def window(self, start=None, end=None):
+        """
+        NAME: .window(start=None, end=None)
+
+        PURPOSE: Merges the sketches of the periods in a time 
+                 window
+
+        INPUTS:  start = The start of the window in seconds, or 
+                         None for no start
+                 end   = The end of the window in seconds, or 
+                         None for no end
+
+        OUTPUTS: A tuple of (price sketch, quantity sketch)
+
+        NOTES: The window is widened out to whole periods, as for
+               TimeBars, and to all of the rolled up periods if 
+               it reaches into them. Without periods every trade
+               is included.
+
+        """
+        if self.bucket is None or start is None:
+            lo = 0
+        else:
+            lo = bisect_right(self.starts, start - self.bucket)
+        if self.bucket is None or end is None:
+            hi = len(self.starts)
+        else:
+            hi = bisect_left(self.starts, end)
+        prices, quants = self._sketch(), self._sketch()
+        if (self.rolled is not None and 
+                (start is None or start < self.rolled_to) and 
+                (end is None or end > self.rolled_from)):
+            prices.merge(self.rolled[0])
+            quants.merge(self.rolled[1])
+        for i in xrange(lo, hi):
+            prices.merge(self.prices[i])
+            quants.merge(self.quants[i])
+        return prices, quants
+
+    def merge(self, other):
+        """
+        NAME: .merge(other)
+
+        PURPOSE: Adds in the sketches of another TradeSketches with
+                 the same periods, e.g. of another portfolio
+
+        INPUTS:  other = A TradeSketches object. It is not changed.
+
+        OUTPUTS: This TradeSketches
+
+        """
+        if other.bucket != self.bucket:
+            raise StockError("sketches of different periods can't be "
+                             "merged")
+        if other.rolled is not None:
+            self._roll(other.rolled_from, other.rolled_to, *other.rolled)
+        for start, prices, quants in zip(other.starts, other.prices, 
+                                         other.quants):
+            if self.rolled_to is not None and start < self.rolled_to:
+                self._roll(start, start + self.bucket, prices, quants)
+                continue
+            i = self._period(start)
+            self.prices[i].merge(prices)
+            self.quants[i].merge(quants)
+        self._trim()
+        return self
+
+
+class TradeJournal(object):
+    """
+    The TradeJournal class is an append-only file of the trades
+    added to a portfolio, one TRADE_RECORD record per trade, so
+    that the portfolio can be reopened after a restart (see 
+    Portfolio.from_journal). It is the same format as the 
+    binary trade files, so load_binary can also read it.
+
+    Attributes:
+       filename  = The journal file (type = string)
+       autoflush = If True each write is flushed to the file 
+                   straight away (type = bool)
+
+    Methods:
+       append = Writes a trade to the journal
+       extend = Writes a batch of trades to the journal
+       flush  = Flushes any buffered writes to the file
+       close  = Closes the journal
+
+    NOTES: If the last record was only partly written, e.g. 
+           because of a crash, it is removed when the journal 
+           is opened again.
+
+    """
+
+    def __init__(self, filename, autoflush=True):
+        """ Initialise the class """
+        self.filename = filename
+        self.autoflush = autoflush
+        self._file = open(filename, 'ab')
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        if size % TRADE_RECORD.size:
+            self._file.truncate(size - size % TRADE_RECORD.size)
+
+    def append(self, trade):
+        """
+        NAME: .append(trade)
+
+        PURPOSE: Writes a trade to the end of the journal
+
+        INPUTS:  trade = A trade object
+
+        OUTPUTS: None
+
+        """
+        write_binary_trades(self._file, [trade])
+        if self.autoflush:
+            self._file.flush()
+
+    def extend(self, trades):
+        """
+        NAME: .extend(trades)
+
+        PURPOSE: Writes a batch of trades to the end of the journal
+
+        INPUTS:  trades = An iterable of trade objects, or a NumPy 
+                          array of trade records (dtype TRADE_DTYPE)
+
+        OUTPUTS: None
+
+        """
+        if np is not None and isinstance(trades, np.ndarray):
+            records = np.zeros(len(trades), dtype=TRADE_DTYPE)
+            for name in TRADE_DTYPE['names']:
+                records[name] = trades[name]
+            self._file.write(records.tostring())
+        else:
+            write_binary_trades(self._file, trades)
+        if self.autoflush:
+            self._file.flush()
+
+    def flush(self):
+        """ Flushes any buffered writes to the file """
+        self._file.flush()
+
+    def close(self):
+        """ Closes the journal """
+        self._file.close()
+
+
+class PortfolioBase(object):
+    """ 
+    The PortfolioBase class holds what a Portfolio and a 
+    ConcurrentPortfolio share: a trader's trades, their index 
+    and positions, and the queries of them. The trades are 
+    added by the subclasses' add_trade and add_trades.
+
+    Attributes: 
+        tradername  = The trader's name (type = string)
+        tradelist   = The trades previously completed, if
+                      these are to be added to this 
+                      portfolio. This should have an empty
+                      set entered if a new portfolio. 
+                      (type = list, or TradeColumns if
+                      columnar)
+        columnar    = If True the trades are held in NumPy
+                      columns rather than as a list of 
+                      Trade objects (type = bool)
+        market      = The Market the portfolio's stocks are in, or
+                      None. Columnar portfolios in a market use 
+                      the market's symbol ids (type = Market)
+        journal     = The journal that trades are written to as 
+                      they are added, or None (type = TradeJournal)
+        index       = The trades of each stock in time order,
+                      or None if the portfolio was created
+                      with indexed=False (type = TradeIndex)
+        windows     = Any standing windows, keyed by their time
+                      range in minutes (type = dict of 
+                      RollingWindow objects)
+        clock       = The function giving the current time, in 
+                      seconds (type = function, default time.time)
+        bars        = Any time bars kept, keyed by their resolution
+                      in seconds, then by stock (type = dict of 
+                      dicts of TimeBars objects)
+        cache       = The cache of query results, or None 
+                      (type = ResultCache)
+        listeners   = The functions called with each trade or 
+                      batch of trades added (type = list)
+        positions   = The position in each stock traded, in the
+                      order the trades were added, brought up to 
+                      date when a position is asked for (type = 
+                      dict of Position objects)
+        retention   = How long trades are held for, in minutes, 
+                      or None to hold them all (type = float)
+        archive     = The trades older than the retention, 
+                      compacted into bars of each stock 
+                      (type = dict of TimeBars objects)
+        compacted_to = The time before which trades have been
+                      compacted, or None (type = float)
+        num_compacted = The number of trades compacted (type = int)
+        sketches    = The quantile sketches of each stock's trades,
+                      or None (type = dict of TradeSketches)
+    Methods:
+        __repr__    = To format the printing of portfolio
+        iter_report = The printed trades, a chunk at a time
+        write_report = Write the printed trades to a file
+        load_csv    = Add the trades in a CSV file
+        load_binary = Add the trades in a binary trade file
+        save_binary = Write the trades to a binary trade file
+        to_records  = The trades as an array of trade records
+        to_columns  = The trades as NumPy columns
+        to_arrow    = The trades as an Arrow record batch
+        close       = Close the portfolio's journal
+        reindex     = Rebuild the index from the tradelist
+        volweightsp = The volume weighted stock price
+        volweightsp_all = The volume weighted price of every
+                      stock traded within a time range
+        asi_calc    = The All Share Index
+        earliest_tr = Print the time of the earlist trade 
+        earliest_trade = The earliest trade, without printing it
+        latest_tr   = Print the time of the latest trade
+        recent_trades = The most recent trades, a page at a time
+        trades_between = The trades within a time range
+        position    = The position in a stock
+        position_all = The position in every stock traded
+        num_tr      = The number of trades in the portfolio
+        num_stocks  = The number of different stocks
+        stock_types = The stock types in the portfolio
+
+    NOTES: Only a Portfolio keeps standing windows, time bars, 
+           quantile sketches and cached results, compacts its 
+           trades and calls listeners. A ConcurrentPortfolio's 
+           windows, bars, archive and listeners are always 
+           empty, and its cache and sketches None.
+
+    """
+
+    def __init__(self, tradername, tradelist, columnar=False, indexed=True,
+                 journal=None, market=None, clock=time):
+        """ Initialise the portfolio object """
+        self.tradername = tradername
+        self.columnar = columnar
+        self.market = market
+        self.clock = clock
+        if columnar and not isinstance(tradelist, TradeColumns):
+            # Copy any pre-existing trades into the columns, which 
+            # use the market's symbol ids if there is a market
+            if market is not None:
+                tradelist = TradeColumns(tradelist, market.symbols)
+            else:
+                tradelist = TradeColumns(tradelist)
+        self.tradelist = tradelist
+
+        # Write any pre-existing trades to the journal 
+        if journal is not None and not isinstance(journal, TradeJournal):
+            journal = TradeJournal(journal)
+        self.journal = journal
+        if journal is not None:
+            journal.extend(self.tradelist)
+
+        # Index any pre-existing trades by stock and time
+        self.index = None
+        self.cache = None
+        self.retention = None
+        self.archive = {}
+        self.compacted_to = None
+        self.num_compacted = 0
+        if indexed:
+            self.reindex()
+
+        # Any standing windows, keyed by their time range
+        self.windows = {}
+
+        # Any time bars, keyed by their resolution
+        self.bars = {}
+
+        # Any quantile sketches, keyed by stock
+        self.sketches = None
+
+        # Anything (e.g. a Market) following the trades added
+        self.listeners = []
+
+        # The position in each stock. The trades are only taken 
+        # into the positions when one is asked for, the first 
+        # _positions_to of the tradelist having been taken so far
+        self.positions = {}
+        self._positions_to = 0
+
+    def __repr__(self):
+        """ Format the printing of the portfolio object"""
+        if INTERACTIVE:
+            print "\n\n%s's Portfolio:" % self.tradername 
+        return "".join(self.iter_report())
+
+    def iter_report(self, stock=None, start=None, end=None, page=None,
+                    page_size=1000, chunk_size=1000):
+        """
+        NAME: .iter_report(stock=None, start=None, end=None, page=None,
+                           page_size=1000, chunk_size=1000)
+
+        PURPOSE: Yields the printed form of the trades (as for
+                 printing the portfolio) a chunk at a time, so that
+                 a large portfolio can be written out without 
+                 holding all of it as one string
+
+        INPUTS:  stock      = If given, only this stock's trades 
+                              are included
+                 start, end = If given, only the trades with 
+                              start <= timestamp < end are included
+                 page       = If given, only this page (counting 
+                              from 0) of page_size trades is 
+                              included
+                 page_size  = The number of trades per page
+                 chunk_size = The number of trades in each string
+                              yielded
+
+        OUTPUTS: Yields strings, which joined together are the 
+                 same as repr() of the portfolio when there are 
+                 no filters
+
+        NOTES: The trades are in the order they were added. 
+               Filtered trades are found from the index, if there
+               is one.
+
+        """
+        for text, num in self._report_chunks(stock, start, end, page, 
+                                             page_size, chunk_size):
+            yield text
+
+    def write_report(self, fileobj, stock=None, start=None, end=None, 
+                     page=None, page_size=1000, chunk_size=1000):
+        """
+        NAME: .write_report(fileobj, stock=None, start=None, end=None,
+                            page=None, page_size=1000, chunk_size=1000)
+
+        PURPOSE: Writes the printed form of the trades to a file,
+                 a chunk at a time
+
+        INPUTS:  fileobj = An open file, or any object with a 
+                           write method
+                 Others  = As for iter_report
+
+        OUTPUTS: The number of trades written
+
+        """
+        written = 0
+        for text, num in self._report_chunks(stock, start, end, page, 
+                                             page_size, chunk_size):
+            fileobj.write(text)
+            written += num
+        return written
+
+    def _report_chunks(self, stock, start, end, page, page_size, chunk_size):
+        """ 
+        Yields (text, number of trades) for each chunk of the 
+        report of iter_report 
+        """
+        if stock is None and start is None and end is None:
+            _scanned(len(self.tradelist))
+            rows = None
+            total = len(self.tradelist)
+        else:
+            rows = sorted(row for times, span_rows, lo, hi in 
+                          self._spans(stock, start, end) 
+                          for row in span_rows[lo:hi])
+            total = len(rows)
+        first, last = 0, total
+        if page is not None:
+            first = min(total, page*page_size)
+            last = min(total, first + page_size)
+
+        if rows is None and first == 0 and last == total:
+            trades = iter(self.tradelist)
+        elif rows is None:
+            trades = (self.tradelist[row] for row in xrange(first, last))
+        else:
+            trades = (self.tradelist[row] for row in rows[first:last])
+        chunk = []
+        for trade in trades:
+            chunk.append(repr(trade))
+            if len(chunk) == chunk_size:
+                yield "".join(chunk), len(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk), len(chunk)
+
+    def close(self):
+        """ Closes the portfolio's journal, if it has one """
+        if self.journal is not None:
+            self.journal.close()
+
+    def load_csv(self, filename, chunksize=10000):
+        """
+        NAME: .load_csv(filename, chunksize=10000)
+
+        PURPOSE: To add the trades in a CSV file into the 
+                 portfolio, reading 'chunksize' trades at a time
+                 so that the whole file is never held in memory
+
+        INPUTS:  filename  = The CSV file, with one trade per line
+                             as stock,price,quantity,bors,timestamp
+                             and an optional header line
+                 chunksize = The number of trades per batch
+
+        OUTPUTS: The number of trades added
+
+        """
+        num = 0
+        with open(filename, 'rb') as csvfile:
+            for trades in read_csv_trades(csvfile, chunksize):
+                num += self.add_trades(trades)
+        return num
+
+    def load_binary(self, filename, chunksize=100000):
+        """
+        NAME: .load_binary(filename, chunksize=100000)
+
+        PURPOSE: To add the trades in a binary trade file (see 
+                 write_binary_trades) into the portfolio, reading
+                 'chunksize' trades at a time
+
+        INPUTS:  filename  = The binary trade file
+                 chunksize = The number of trades per batch
+
+        OUTPUTS: The number of trades added
+
+        """
+        num = 0
+        with open(filename, 'rb') as binfile:
+            for trades in read_binary_trades(binfile, chunksize):
+                num += self.add_trades(trades)
+        return num
+
+    def save_binary(self, filename):
+        """
+        NAME: .save_binary(filename)
+
+        PURPOSE: To write the portfolio's trades to a binary 
+                 trade file, which load_binary can read back
+
+        INPUTS:  filename = The file to write
+
+        OUTPUTS: None
+
+        """
+        with open(filename, 'wb') as binfile:
+            write_binary_trades(binfile, self.tradelist)
+
+    def to_records(self):
+        """
+        NAME: .to_records()
+
+        PURPOSE: Returns the trades as an array of trade records 
+                 (e.g. for pandas.DataFrame), which add_trades 
+                 also takes
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A NumPy array with dtype TRADE_DTYPE
+
+        NOTES: A portfolio reopened from its journal, with no 
+               trades added since, gives back the mapped journal
+               without copying it. Otherwise the records are 
+               built, without making any Trade objects if the 
+               portfolio is columnar. Raises a StockError if a 
+               stock symbol is longer than the 8 characters a 
+               record holds, as write_binary_trades does.
+
+        """
+        if self.columnar:
+            return self.tradelist.to_records()
+        if np is None:
+            raise ImportError("numpy is needed to export trades")
+        _scanned(len(self.tradelist))
+        trades = self.tradelist
+        records = np.zeros(len(trades), dtype=TRADE_DTYPE)
+        stocks = [trade.stock for trade in trades]
+        _check_symbols(set(stocks))
+        records['stock'] = stocks
+        records['tr_price'] = [trade.tr_price for trade in trades]
+        records['tr_quant'] = [trade.tr_quant for trade in trades]
+        records['timestamp'] = [trade.timestamp for trade in trades]
+        records['bors'] = [trade.bors for trade in trades]
+        return records
+
+    def to_columns(self):
+        """
+        NAME: .to_columns()
+
+        PURPOSE: Returns the trades as NumPy columns, one array 
+                 per field
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A dict of 'tr_price', 'tr_quant' and 'timestamp'
+                 (float64 arrays), 'side' (+1 for a buy, -1 for a
+                 sell, an int8 array), 'symid' (int32 array) and 
+                 'symbols', the list of stock symbols that the 
+                 symids index, e.g. for 
+                 pandas.Categorical.from_codes(symid, symbols)
+
+        NOTES: A columnar portfolio gives views of its own 
+               columns, without copying them. These are only 
+               valid until the next trade is added, and must not
+               be changed. Otherwise the columns are built.
+
+        """
+        if self.columnar:
+            cols = self.tradelist
+        else:
+            _scanned(len(self.tradelist))
+            cols = TradeColumns(self.tradelist)
+        return {'tr_price': cols.price, 'tr_quant': cols.quant, 
+                'timestamp': cols.timestamp, 'side': cols.side, 
+                'symid': cols.symid, 'symbols': list(cols.symbols.names)}
+
+    def to_arrow(self):
+        """
+        NAME: .to_arrow()
+
+        PURPOSE: Returns the trades as an Arrow record batch, 
+                 which add_trades also takes
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A pyarrow.RecordBatch with the fields of 
+                 TRADE_DTYPE. 'stock' and 'bors' are dictionary
+                 encoded.
+
+        NOTES: Made from to_columns, so the price, quantity and 
+               timestamp (and stock id) buffers of a columnar 
+               portfolio are shared, not copied. The same caveats
+               apply.
+
+        """
+        if pa is None:
+            raise ImportError("pyarrow is needed to export trades to "
+                              "Arrow")
+        cols = self.to_columns()
+        stock = pa.DictionaryArray.from_arrays(pa.array(cols['symid']),
+                                               pa.array(cols['symbols'],
+                                                        type=pa.string()))
+        bors = pa.DictionaryArray.from_arrays(
+                            pa.array((cols['side'] < 0).astype('i1')),
+                            pa.array(['B', 'S'], type=pa.string()))
+        return pa.RecordBatch.from_arrays(
+                            [stock, pa.array(cols['tr_price']), 
+                             pa.array(cols['tr_quant']),
+                             pa.array(cols['timestamp']), bors],
+                            TRADE_DTYPE['names'])
+
+    def _archived(self, stock, start, end):
+        """ 
+        The bars of the archive (of one stock, or all of them) 
+        within start <= timestamp < end, as a list of (stock, 
+        bars, lo, hi) where bars holds the bars lo to hi-1
+        """
+        if not self.archive:
+            return []
+        if stock is not None:
+            stock = str(stock).upper()
+            items = [(stock, self.archive.get(stock))]
+        else:
+            items = self.archive.items()
+        archived = []
+        for stock, stock_bars in items:
+            if stock_bars is not None:
+                lo, hi = stock_bars._range(start, end)
+                if hi > lo:
+                    archived.append((stock, stock_bars, lo, hi))
+        return archived
+
+    def _cached(self, key, stock, compute, trange, start, end, asof):
+        """
+        Returns compute(now), the result of a query over the time 
+        range given by trange, start, end and asof, using the 
+        cache if it has a result that still holds. The result 
+        depends on the trades of the given stock, or of all 
+        stocks if stock is None. A miss goes through the query's
+        usual path, standing windows and all, with the time range
+        as given and the time now read here, so that the clock is
+        read once and the result and its expiry share the time.
+        """
+        cache = self.cache
+        now = self.clock()
+        tstart, tend = _interval(lambda: now, trange, start, end, asof)
+        if stock is None:
+            generation = cache.generation
+        else:
+            generation = cache.generations.get(stock, 0)
+        found, result = cache.get(key, generation, now)
+        if found:
+            return result
+
+        result = compute(now)
+        # A time range that ends now changes when its earliest 
+        # trade ages out of it
+        expires = float('inf')
+        if start is None and asof is None:
+            firsts = [times[lo] for times, rows, lo, hi in 
+                      self._spans(stock, tstart, tend) if hi > lo]
+            firsts.extend(stock_bars.first_ts[lo] for _, stock_bars, lo, hi
+                          in self._archived(stock, tstart, tend))
+            if firsts:
+                expires = min(firsts) + trange*60.
+        cache.put(key, result, generation, now, expires)
+        return result
+
+    def _get_bars(self, resolution):
+        """ The time bars of a resolution, which must be kept """
+        bars = self.bars.get(resolution)
+        if bars is None:
+            raise StockError("no time bars of %s seconds are kept, see "
+                             "add_bars" % (resolution))
+        return bars
+
+    def _update_positions(self):
+        """ 
+        Takes the trades added since a position was last asked 
+        for into the positions, a chunk at a time
+        """
+        first, last = self._positions_to, len(self.tradelist)
+        chunk = 100000
+        for lo in xrange(first, last, chunk):
+            hi = min(last, lo + chunk)
+            if self.columnar:
+                cols = self.tradelist
+                names = cols.symbols.names
+                self._add_positions(
+                        [names[i] for i in cols.symid[lo:hi].tolist()],
+                        cols.price[lo:hi].tolist(), cols.quant[lo:hi].tolist(),
+                        ['B' if side > 0 else 'S' 
+                         for side in cols.side[lo:hi].tolist()])
+            else:
+                trades = self.tradelist[lo:hi]
+                self._add_positions([trade.stock for trade in trades],
+                                    [trade.tr_price for trade in trades],
+                                    [trade.tr_quant for trade in trades],
+                                    [trade.bors for trade in trades])
+        self._positions_to = last
+
+    def _add_positions(self, stocks, prices, quants, sides):
+        """ Adds trades to the positions, in the order given """
+        positions = self.positions
+        for stock, price, quant, bors in zip(stocks, prices, quants, sides):
+            position = positions.get(stock)
+            if position is None:
+                position = positions[stock] = Position(stock)
+            position.add(price, quant, bors)
+
+    def reindex(self):
+        """
+        NAME: .reindex()
+
+        PURPOSE: To rebuild the index of trades by stock and 
+                 time from the tradelist. Only needed if the 
+                 tradelist has been changed other than through
+                 add_trade. Any cached results are dropped.
+
+        INPUTS:  None (self)
+
+        OUTPUTS: None
+
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        _scanned(len(self.tradelist))
+        if self.columnar:
+            # Straight from the columns, sorted and summed by NumPy
+            cols = self.tradelist
+            self.index = TradeIndex()
+            self.index.add_columns(cols.symid, cols.symbols.names, 
+                                   cols.price, cols.quant, cols.timestamp)
+        else:
+            self.index = TradeIndex(
+                        [trade.stock for trade in self.tradelist],
+                        [trade.tr_price for trade in self.tradelist],
+                        [trade.tr_quant for trade in self.tradelist],
+                        [trade.timestamp for trade in self.tradelist])
+
+    def volweightsp(self, stock_search, trange=None, resolution=None,
+                    start=None, end=None, asof=None):
+        """
+        NAME: volweightsp(stock_search, trange=None, resolution=None,
+                          start=None, end=None, asof=None)
+
+        PURPOSE: To compute the volume weighted stock 
+                 price for a given stock type over 
+                 the time trange provided. This is computed as
+                 sum( price*quantity ) / sum( quantity )
+
+        INPUTS:  stock  = The abbreviation of the stock 
+                          name (type = string)
+                 trange = The time range over which to 
+                          compute the vol weighted price
+                          in minutes (type = float)
+                 resolution = If given, the price is found from 
+                          the time bars of this many seconds 
+                          (see add_bars), widening the time range
+                          out to whole bars
+                 start, end = Instead of trange, the trades with
+                          start <= timestamp < end are used. An 
+                          end of None is no end.
+                 asof   = Find the price as it was at this time,
+                          using the trades from trange minutes 
+                          before it, up to (not including) it
+        
+        OUTPUTS: The vol. weighted stock price. 
+                
+        NOTES:   If the stock is either not present in the 
+                 portfolio, or hasn't been traded in the allotted
+                 time range then 0 (zero) is returned and the 
+                 trader is informed that the search criteria
+                 was not met.
+
+                 The clock is read once, when only trange is 
+                 given. Trades timed after the clock are then
+                 included, as they always have been.
+
+        """
+        if self.cache is None or resolution is not None:
+            return self._volweightsp(stock_search, trange, resolution, 
+                                     start, end, asof)
+        stock_search = str(stock_search).upper()
+        return self._cached(('volweightsp', stock_search, trange, start, end,
+                             asof), stock_search,
+                            lambda now: self._volweightsp(
+                                stock_search, trange, None, start, end, asof,
+                                now),
+                            trange, start, end, asof)
+
+    def _volweightsp(self, stock_search, trange=None, resolution=None,
+                     start=None, end=None, asof=None, now=None):
+        """ 
+        Computes volweightsp, without the cache, taking now as the
+        time if it is given rather than reading the clock
+        """
+        #Tell the user what is happening
+        _report(logging.DEBUG, 
+                "\n>>> Computing the Volume Weighted Stock Price <<<")
+
+        if type(stock_search) != str:
+            stock_search = str(stock_search)
+        stock_search = stock_search.upper()
+
+        # Trades with tstart <= timestamp < tend are within the 
+        # time range
+        standing = start is None and end is None and asof is None
+        clock = self.clock if now is None else lambda: now
+        tstart, tend = _interval(clock, trange, start, end, asof)
+
+        # A standing window for this time range already has the
+        # answer, unless the stock hasn't been traded within it
+        window = self.windows.get(trange)
+        if window is not None and resolution is None and standing:
+            vwsp = window.vwsp(stock_search, tstart + trange*60.)
+            if vwsp is not None:
+                return vwsp
+
+        # Check if the stock if present, and if it is not exit 
+        # this retuning 0 (zero). If it is present then sum the 
+        # value of price * quantity for the trades that match the
+        # search criteria, and also sum just the quantity so that
+        # the weighted sum can then be computed
+        if resolution is not None:
+            # Sums over the stock's bars, rather than its trades
+            stock_bars = self._get_bars(resolution).get(stock_search)
+            stock_pres = stock_bars is not None
+            if stock_pres:
+                price_quant_sum, quant_sum, num_valid = \
+                                            stock_bars.window(tstart, tend)
+        elif self.index is not None:
+            # Two bisects into the stock's time sorted trades
+            series = self.index.series.get(stock_search)
+            stock_pres = series is not None
+            if stock_pres:
+                price_quant_sum, quant_sum, num_valid = \
+                                            series.window(tstart, tend)
+        elif self.columnar:
+            # The same checks, vectorised over the trade columns
+            cols = self.tradelist
+            _scanned(len(cols))
+            symid = cols.symbols.lookup(stock_search)
+            if symid is None:
+                valid = np.zeros(len(cols), dtype=bool)
+            else:
+                valid = cols.symid == symid
+            stock_pres = valid.any()
+            valid &= cols.timestamp >= tstart
+            if tend is not None:
+                valid &= cols.timestamp < tend
+            quant = cols.quant[valid]
+            price_quant_sum = float(np.dot(cols.price[valid], quant))
+            quant_sum = float(quant.sum())
+            num_valid = len(quant)
+        else:
+            # A single pass over the trade list
+            _scanned(len(self.tradelist))
+            if tend is None:
+                tend = float('inf')
+            stock_pres = False
+            price_quant_sum = quant_sum = 0.
+            num_valid = 0
+            for trades in self.tradelist:
+                if trades.stock == stock_search:
+                    stock_pres = True
+                    if tstart <= trades.timestamp < tend:
+                        price_quant_sum += trades.tr_price*trades.tr_quant
+                        quant_sum += trades.tr_quant
+                        num_valid += 1
+
+        # Add any trades compacted into the archive
+        stock_bars = self.archive.get(stock_search)
+        if stock_bars is not None and resolution is None:
+            if not stock_pres:
+                stock_pres = True
+                price_quant_sum = quant_sum = 0.
+                num_valid = 0
+            archived = stock_bars.window(tstart, tend)
+            price_quant_sum += archived[0]
+            quant_sum += archived[1]
+            num_valid += archived[2]
+
+        if stock_pres == False:
+            _report(logging.INFO, 
+                    "\n >>> The stock you are searching for (%s) is not"
+                    " in %s's portfolio.", stock_search, self.tradername)
+            return 0
+        elif num_valid == 0:
+            _report(logging.INFO, 
+                    "\n >>> The stock (%s) has not been traded by %s within"
+                    "the time range of %s mins.", 
+                    stock_search, self.tradername, trange)
+            return 0
+        else:
+            return price_quant_sum/quant_sum
+
+    def volweightsp_all(self, trange=None, resolution=None, start=None,
+                        end=None, asof=None):
+        """
+        NAME: volweightsp_all(trange=None, resolution=None, start=None,
+                              end=None, asof=None)
+
+        PURPOSE: To compute the volume weighted stock price of 
+                 every stock traded within the time range, in a
+                 single pass rather than one volweightsp call 
+                 per stock
+
+        INPUTS:  trange = The time range over which to compute
+                          the vol weighted prices in minutes 
+                          (type = float)
+                 resolution, start, end, asof = As for volweightsp
+
+        OUTPUTS: A dict of the vol. weighted stock price of each 
+                 stock traded within the time range
+
+        """
+        if self.cache is None or resolution is not None:
+            return self._volweightsp_all(trange, resolution, start, end, 
+                                         asof)
+        return dict(self._cached(('volweightsp_all', trange, start, end, 
+                                  asof), None,
+                                 lambda now: self._volweightsp_all(
+                                     trange, None, start, end, asof, now),
+                                 trange, start, end, asof))
+
+    def _volweightsp_all(self, trange=None, resolution=None, start=None,
+                         end=None, asof=None, now=None):
+        """ As for _volweightsp, for volweightsp_all """
+        # Trades with tstart <= timestamp < tend are within the 
+        # time range
+        clock = self.clock if now is None else lambda: now
+        tstart, tend = _interval(clock, trange, start, end, asof)
+
+        if resolution is not None:
+            # Each stock's sums come from its bars
+            vwsp = {}
+            for stock, stock_bars in self._get_bars(resolution).iteritems():
+                price_quant_sum, quant_sum, num_valid = \
+                                            stock_bars.window(tstart, tend)
+                if num_valid:
+                    vwsp[stock] = price_quant_sum/quant_sum
+            return vwsp
+
+        if self.index is not None:
+            # Each stock's sums come from its own series
+            sums = {}
+            # (a copy of the items, as another thread may be adding
+            # a new stock meanwhile)
+            for stock, series in self.index.series.items():
+                price_quant_sum, quant_sum, num_valid = \
+                                            series.window(tstart, tend)
+                if num_valid:
+                    sums[stock] = [price_quant_sum, quant_sum]
+
+        elif self.columnar:
+            # Group the sums by stock id, vectorised over the columns
+            cols = self.tradelist
+            _scanned(len(cols))
+            inrange = cols.timestamp >= tstart
+            if tend is not None:
+                inrange &= cols.timestamp < tend
+            symid = cols.symid[inrange]
+            quant = cols.quant[inrange]
+            nsym = len(cols.symbols)
+            price_quant_sum = np.bincount(symid, minlength=nsym,
+                                weights=cols.price[inrange]*quant)
+            quant_sum = np.bincount(symid, weights=quant, minlength=nsym)
+            num_valid = np.bincount(symid, minlength=nsym)
+            names = cols.symbols.names
+            return dict((names[i], float(price_quant_sum[i]/quant_sum[i]))
+                        for i in np.flatnonzero(num_valid).tolist())
+
+        else:
+            # Group the sums by stock in one pass over the trade list
+            _scanned(len(self.tradelist))
+            sums = {}
+            for trades in self.tradelist:
+                if (tstart <= trades.timestamp and 
+                        (tend is None or trades.timestamp < tend)):
+                    stock_sums = sums.get(trades.stock)
+                    if stock_sums is None:
+                        stock_sums = sums[trades.stock] = [0., 0.]
+                    stock_sums[0] += trades.tr_price*trades.tr_quant
+                    stock_sums[1] += trades.tr_quant
+
+        # Add any trades compacted into the archive
+        for stock, stock_bars, lo, hi in self._archived(None, tstart, tend):
+            stock_sums = sums.get(stock)
+            if stock_sums is None:
+                stock_sums = sums[stock] = [0., 0.]
+            stock_sums[0] += sum(stock_bars.pvs[lo:hi])
+            stock_sums[1] += sum(stock_bars.volumes[lo:hi])
+        return dict((stock, price_quant_sum/quant_sum) 
+                    for stock, (price_quant_sum, quant_sum) in 
+                    sums.iteritems())
+
+    def asi_calc(self, trange=None, resolution=None, start=None, end=None,
+                 asof=None):
+        """
+        NAME: asi_calc(trange=None, resolution=None, start=None, 
+                       end=None, asof=None)
+
+        PURPOSE: Computes the All Share Index (ASI) using the 
+                 geometric mean of the stock prices
+
+        INPUTS:  trange = The time in minutes over which to 
+                          compute the ASI
+                 resolution, start, end, asof = As for volweightsp
+
+        OUTPUTS: The ASI
+
+        NOTES: In the event of an empty tradelist the 
+               method exits, returning zero, with a message
+               informing the user that the tradelist is empty.
+
+               The geometric mean is taken over the vol. weighted
+               prices of the stocks traded within the time range, 
+               as the exponent of the mean of their logs, so that 
+               it can't overflow however many stocks there are.
+
+        """   
+        if self.cache is None or resolution is not None:
+            return self._asi_calc(trange, resolution, start, end, asof)
+        return self._cached(('asi_calc', trange, start, end, asof), None,
+                            lambda now: self._asi_calc(
+                                trange, None, start, end, asof, now),
+                            trange, start, end, asof)
+
+    def _asi_calc(self, trange=None, resolution=None, start=None, end=None,
+                  asof=None, now=None):
+        """ As for _volweightsp, for asi_calc """
+        #Tell the user what is happening
+        _report(logging.DEBUG, "\n>>> Computing All Share Index (ASI) using"
+                " %s's Portfolio <<<", self.tradername)
+
+        #First check if the tradelist is empty
+        if len(self.tradelist) == 0 and not self.archive:
+            _report(logging.INFO, "\n ...%s's portfolio is empty, can't "
+                    "compute all share index\n", self.tradername)
+            return 0
+
+        # A standing window over all stocks for this time range 
+        # keeps the index up to date as trades come in
+        standing = start is None and end is None and asof is None
+        window = self.windows.get(trange)
+        if (window is not None and window.stocks is None and 
+                resolution is None and standing):
+            asi = window.asi(self.clock() if now is None else now)
+            if asi is None:
+                _report(logging.INFO, " >>> No trades in given time range...")
+                return 0
+            return asi
+
+        # Compute the volume weighted stock price of each stock 
+        # within the portfolio, all in one go
+        prices = self._volweightsp_all(trange, resolution, start, end, 
+                                       asof, now).values()
+          
+        if len(prices) == 0:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0  
+        #The geometric mean is then:
+        else:
+            return exp(sum(log(price) for price in prices)/len(prices))
+
+    def earliest_tr(self, start=None, end=None, asof=None, stock=None):
+        """ 
+        NAME: earliest_tr(start=None, end=None, asof=None, stock=None)
+
+        PURPOSE: Prints the earliest trade to the screen, 
+                 both the readable time and the time 
+                 in seconds
+        
+        INPUTS:  start, end = If given, only the trades with 
+                              start <= timestamp < end are looked
+                              at
+                 asof       = Look at the trades before this time,
+                              and give the age of the earliest as
+                              of this time
+                 stock      = If given, only this stock's trades
+                              are looked at
+
+        OUTPUTS: A print statement and the time of the
+                 earliest trade is returned, in seconds
+                 from the current time (or asof). If there 
+                 are no trades in the time range, 0 (zero)
+                 is returned.
+
+        NOTES: Trades compacted into the archive are looked at a
+               bar at a time, as for volweightsp.
+        """
+        if end is None:
+            end = asof
+        now = self.clock() if asof is None else asof
+        first = self.earliest_trade(start, end, stock)
+        archived = [(stock_bars.first_ts[lo], stock_name) 
+                    for stock_name, stock_bars, lo, hi in 
+                    self._archived(stock, start, end)]
+        if first is None and not archived:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0
+        if archived and (first is None or 
+                         min(archived)[0] < first.timestamp):
+            first_time, first_stock = min(archived)
+            oldest = now - first_time
+            _report(logging.INFO, "\n>>> The earliest trade was %ss ago:", 
+                    oldest)
+            _report(logging.INFO, "\n%s  -- A trade of %s (compacted)", 
+                    _format_time(first_time), first_stock)
+            return oldest
+        oldest = now - first.timestamp
+        _report(logging.INFO, "\n>>> The earliest trade was %ss ago:", oldest)
+        _report(logging.INFO, "%s", first)
+        return oldest
+
+    def earliest_trade(self, start=None, end=None, stock=None):
+        """ 
+        NAME: earliest_trade(start=None, end=None, stock=None)
+
+        PURPOSE: Returns the earliest trade, without printing it
+        
+        INPUTS:  As for earliest_tr
+
+        OUTPUTS: The earliest trade object, or None if there are
+                 no trades in the time range
+
+        NOTES: Trades compacted into the archive aren't looked 
+               at, as they are no longer kept as trades.
+        """
+        firsts = [(times[lo], rows[lo]) for times, rows, lo, hi in 
+                  self._spans(stock, start, end) if hi > lo]
+        if not firsts:
+            return None
+        return self.tradelist[min(firsts)[1]]
+
+    def latest_tr(self, start=None, end=None, asof=None, stock=None):
+        """ 
+        NAME: latest_tr(start=None, end=None, asof=None, stock=None)
+
+        PURPOSE: Prints the latest trade to the screen, both the
+                 readable time and the time in seconds
+        
+        INPUTS:  As for earliest_tr
+
+        OUTPUTS: A print statement and the time of the latest 
+                 trade is returned, in seconds from the current 
+                 time (or asof). If there are no trades in the 
+                 time range, 0 (zero) is returned.
+        """
+        if end is None:
+            end = asof
+        now = self.clock() if asof is None else asof
+        lasts = [(times[hi-1], rows[hi-1]) for times, rows, lo, hi in 
+                 self._spans(stock, start, end) if hi > lo]
+        archived = [(stock_bars.last_ts[hi-1], stock_name) 
+                    for stock_name, stock_bars, lo, hi in 
+                    self._archived(stock, start, end)]
+        if not lasts and not archived:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0
+        if archived and (not lasts or max(archived)[0] > max(lasts)[0]):
+            last_time, last_stock = max(archived)
+            newest = now - last_time
+            _report(logging.INFO, "\n>>> The latest trade was %ss ago:", 
+                    newest)
+            _report(logging.INFO, "\n%s  -- A trade of %s (compacted)", 
+                    _format_time(last_time), last_stock)
+            return newest
+        last_time, last = max(lasts)
+        newest = now - last_time
+        _report(logging.INFO, "\n>>> The latest trade was %ss ago:", newest)
+        _report(logging.INFO, "%s", self.tradelist[last])
+        return newest
+
+    def recent_trades(self, num, stock=None, offset=0, end=None):
+        """ 
+        NAME: recent_trades(num, stock=None, offset=0, end=None)
+
+        PURPOSE: Returns the most recent trades, a page at a time
+
+        INPUTS:  num    = The number of trades (type = int)
+                 stock  = If given, only this stock's trades are 
+                          returned
+                 offset = The number of more recent trades to 
+                          skip, e.g. 50 for the second page of 50
+                 end    = If given, only the trades before this 
+                          time are looked at
+
+        OUTPUTS: A list of up to num trade objects, most recent
+                 first
+
+        NOTES: With an index, only the trades up to the end of
+               the page are looked at, working back from the most
+               recent trade of each stock, so the first pages
+               cost the same however many trades there are.
+        """
+        newest = merge(*[_backwards(*span) 
+                         for span in self._spans(stock, None, end)])
+        return [self.tradelist[-row] for timestamp, row in 
+                islice(newest, offset, offset + num)]
+
+    def trades_between(self, start=None, end=None, stock=None):
+        """ 
+        NAME: trades_between(start=None, end=None, stock=None)
+
+        PURPOSE: Returns the trades with start <= timestamp < end
+
+        INPUTS:  start, end = The time range in seconds. None is
+                              no limit.
+                 stock      = If given, only this stock's trades 
+                              are returned
+
+        OUTPUTS: A list of trade objects, in time order
+
+        """
+        ordered = merge(*[_forwards(*span) 
+                          for span in self._spans(stock, start, end)])
+        return [self.tradelist[row] for timestamp, row in ordered]
+
+    def _spans(self, stock, start, end):
+        """ 
+        The trades (of one stock, or all of them) with start <= 
+        timestamp < end, as a list of (times, rows, lo, hi) where
+        times[lo:hi] and rows[lo:hi] are the timestamps and 
+        tradelist positions of some of the trades in time order.
+        From the index there is one of these for each stock. 
+        Without an index the trades are found and sorted.
+        """
+        if stock is not None:
+            stock = str(stock).upper()
+        if self.index is not None:
+            if stock is None:
+                return [series.span(start, end) 
+                        for series in self.index.series.values()]
+            series = self.index.series.get(stock)
+            return [] if series is None else [series.span(start, end)]
+
+        _scanned(len(self.tradelist))
+        if self.columnar:
+            cols = self.tradelist
+            times = cols.timestamp
+            inrange = np.ones(len(cols), dtype=bool)
+            if stock is not None:
+                symid = cols.symbols.lookup(stock)
+                inrange &= cols.symid == (-1 if symid is None else symid)
+            if start is not None:
+                inrange &= times >= start
+            if end is not None:
+                inrange &= times < end
+            rows = np.flatnonzero(inrange)
+            rows = rows[np.argsort(times[rows], kind='mergesort')]
+            times = times[rows].tolist()
+            rows = rows.tolist()
+        else:
+            low = -float('inf') if start is None else start
+            high = float('inf') if end is None else end
+            ordered = sorted((trade.timestamp, row) 
+                             for row, trade in enumerate(self.tradelist)
+                             if low <= trade.timestamp < high and 
+                             (stock is None or trade.stock == stock))
+            times = [timestamp for timestamp, row in ordered]
+            rows = [row for timestamp, row in ordered]
+        return [(times, rows, 0, len(rows))]
+
+    def position(self, stock, mark=None):
+        """
+        NAME: .position(stock, mark=None)
+
+        PURPOSE: The position in a stock: the quantity held, the
+                 average price it cost, the profit or loss made 
+                 so far and the total quantities bought and sold
+
+        INPUTS:  stock = The stock abbreviation (type = string)
+                 mark  = The price to value the quantity held at,
+                         for the unrealized profit or loss, or 
+                         None (type = float)
+
+        OUTPUTS: A dict, as for Position.summary. A stock that 
+                 hasn't been traded has a position of zero.
+
+        NOTES: This reads the running position, so costs the same
+               however many trades there are, once the trades 
+               added since the last position was asked for have 
+               been taken into it.
+
+        """
+        self._update_positions()
+        stock = str(stock).upper()
+        position = self.positions.get(stock)
+        if position is None:
+            position = Position(stock)
+        return position.summary(mark)
+
+    def position_all(self, marks=None):
+        """
+        NAME: .position_all(marks=None)
+
+        PURPOSE: The position in every stock traded
+
+        INPUTS:  marks = A dict of the price to value each stock 
+                         at, or None. Stocks not in it have no 
+                         unrealized profit or loss. (type = dict)
+
+        OUTPUTS: A dict of each stock's position, as for .position
+
+        """
+        self._update_positions()
+        if marks is None:
+            marks = {}
+        return dict((stock, position.summary(marks.get(stock)))
+                    for stock, position in self.positions.items())
+
+    def num_tr(self):
+        """ 
+        NAME: num_tr()
+
+        PURPOSE: Returns the number of trades in the portfolio
+
+        INPUTS: none (self)
+
+        OUTPUTS: The number of trades, including any compacted 
+                 into the archive
+
+        """
+        return len(self.tradelist) + self.num_compacted
+
+    def num_stocks(self):
+        """ 
+        NAME: num_stocks()
+
+        PURPOSE: Returns the number of stock types in the portfolio
+
+        INPUTS: none (self)
+
+        OUTPUTS: The number of unique stock types
+
+        """
+        if self.archive:
+            return len(self.stock_types())
+        if self.index is not None:
+            return len(self.index.series)
+        if self.columnar:
+            return len(self._symids_traded())
+        _scanned(len(self.tradelist))
+        return len(set([self.tradelist[i].stock 
+                         for i in range(len(self.tradelist))]))
+
+    def stock_types(self):
+        """ 
+        NAME: stock_types()
+
+        PURPOSE: Returns a list of stock types in the portfolio
+
+        INPUTS: none (self)
+
+        OUTPUTS: A list containing the names of the types of
+                 stock within the portfolio
+
+        """
+        if self.archive:
+            # The stocks held, and those only in the archive
+            if self.index is not None:
+                held = set(self.index.series)
+            else:
+                _scanned(len(self.tradelist))
+                held = set(trade.stock for trade in self.tradelist)
+            return list(held.union(self.archive))
+        if self.index is not None:
+            return list(self.index.series)
+        if self.columnar:
+            names = self.tradelist.symbols.names
+            return [names[i] for i in self._symids_traded()]
+        _scanned(len(self.tradelist))
+        return list(set([self.tradelist[i].stock 
                           for i in range(len(self.tradelist))]))
 
+    def _symids_traded(self):
+        """ The ids of the stocks held in the trade columns """
+        cols = self.tradelist
+        _scanned(len(cols))
+        return np.flatnonzero(np.bincount(cols.symid,
+                                          minlength=len(cols.symbols)))
+
+
+class Portfolio(PortfolioBase):
+    """ 
+    The Portfolio class describes the attributes and methods 
+    associated with a trader's portfolio. Effectively, this
+    holds a set of trades. 
+
+    Attributes: 
+        As for PortfolioBase
+
+    Methods:
+        As for PortfolioBase, plus
+        add_trade   = To add a trade into the portfolio 
+        add_trades  = To add a batch of trades into the portfolio
+        from_journal = Reopen a portfolio from its journal
+        add_window  = Keep running prices over a standing window
+        remove_window = Stop keeping a standing window
+        add_bars    = Keep time bars of each stock's trades
+        remove_bars = Stop keeping time bars
+        set_retention = Compact trades older than a time
+        compact     = Compact the trades older than the retention
+        add_sketches = Keep quantile sketches of each stock
+        remove_sketches = Stop keeping quantile sketches
+        enable_cache = Keep the results of recent queries
+        disable_cache = Stop keeping query results
+        add_listener = Call a function as trades are added
+        remove_listener = Stop calling a function
+        quantile    = The median, or other quantiles, of a stock's
+                      trade prices or sizes
+        sketch      = The merged quantile sketch of a stock
+
+    """
+
+    def add_trade(self,trade):
+        """
+        NAME: .add_trade(trade)
+
+        PURPOSE: To add a trade into the tradelist
+
+        INPUTS:  A trade object
+
+        OUTPUTS: The updated tradelist
+
+        """
+        #Tell the user what is happening
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio ", 
+                self.tradername)
+        
+        #Write the trade to the journal before taking it in
+        if self.journal is not None:
+            self.journal.append(trade)
+
+        #Append the trade object to the list, and to the index
+        row = len(self.tradelist)
+        self.tradelist.append(trade)
+        if self.index is not None:
+            self.index.add(trade.stock, trade.tr_price, trade.tr_quant,
+                           trade.timestamp, row)
+        if self.windows:
+            now = self.clock()
+            for window in self.windows.itervalues():
+                window.add(trade.stock, trade.tr_price, trade.tr_quant,
+                           trade.timestamp, now)
+        if self.bars:
+            self._add_bars([trade.stock], [trade.tr_price], 
+                           [trade.tr_quant], [trade.timestamp])
+        if self.sketches is not None:
+            self._add_sketches([trade.stock], [trade.tr_price], 
+                               [trade.tr_quant], [trade.timestamp])
+        if self.cache is not None:
+            self.cache.touch([trade.stock])
+        for listener in self.listeners:
+            listener(self, [trade.stock], [trade.tr_price], 
+                     [trade.tr_quant], [trade.timestamp])
+        if self.retention is not None:
+            self.compact()
+
+    def add_trades(self, trades):
+        """
+        NAME: .add_trades(trades)
+
+        PURPOSE: To add a batch of trades into the tradelist. The
+                 index and any standing windows are updated once 
+                 for the whole batch, rather than once per trade.
+
+        INPUTS:  trades = An iterable of trade objects, a NumPy 
+                          array of trade records (dtype TRADE_DTYPE)
+                          or an Arrow record batch (or table) with
+                          the same fields, as from to_arrow
+
+        OUTPUTS: The number of trades added
+
+        """
+        if pa is not None and isinstance(trades, (pa.RecordBatch, pa.Table)):
+            trades = arrow_trade_records(trades)
+        start = len(self.tradelist)
+        if np is not None and isinstance(trades, np.ndarray):
+            # Nothing is taken in if any of the records is invalid
+            _check_records(trades)
+        else:
+            trades = list(trades)
+        if self.journal is not None:
+            self.journal.extend(trades)
+
+        num = len(trades)
+        if np is not None and isinstance(trades, np.ndarray):
+            # The stocks, as ids into names, without a Python object
+            # for each trade
+            if self.columnar:
+                cols = self.tradelist
+                cols.extend_records(trades)
+                names, symids = cols.symbols.names, cols.symid[start:]
+            else:
+                names, symids = np.unique(np.char.upper(trades['stock']),
+                                          return_inverse=True)
+                names = names.tolist()
+            if self.index is not None:
+                self.index.add_columns(symids, names, trades['tr_price'],
+                                       trades['tr_quant'], 
+                                       trades['timestamp'], start)
+            traded = set(names[i] for i in np.unique(symids).tolist())
+            # Lists of the trades are only made for a tradelist of 
+            # Trade objects, or for anything (windows, bars etc.) 
+            # that takes the trades one at a time
+            if (not self.columnar or self.windows or self.bars or 
+                    self.sketches is not None or self.listeners):
+                stocks = [names[i] for i in symids.tolist()]
+                prices = trades['tr_price'].tolist()
+                quants = trades['tr_quant'].tolist()
+                timestamps = trades['timestamp'].tolist()
+            if not self.columnar:
+                sides = [bors.upper() for bors in trades['bors'].tolist()]
+                self.tradelist.extend(
+                        Trade(stock, price, quant, bors, timestamp)
+                        for stock, price, quant, bors, timestamp in 
+                        zip(stocks, prices, quants, sides, timestamps))
+        else:
+            stocks = [trade.stock for trade in trades]
+            prices = [trade.tr_price for trade in trades]
+            quants = [trade.tr_quant for trade in trades]
+            timestamps = [trade.timestamp for trade in trades]
+            traded = set(stocks)
+            self.tradelist.extend(trades)
+            if self.index is not None:
+                self.index.add_batch(stocks, prices, quants, timestamps, 
+                                     start)
+
+        #Tell the user what is happening
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio with %s trades",
+                self.tradername, num)
+
+        if self.windows:
+            now = self.clock()
+            rows = sorted(xrange(num), key=timestamps.__getitem__)
+            for window in self.windows.itervalues():
+                for row in rows:
+                    window.add(stocks[row], prices[row], quants[row],
+                               timestamps[row], now)
+        if self.bars:
+            self._add_bars(stocks, prices, quants, timestamps)
+        if self.sketches is not None:
+            self._add_sketches(stocks, prices, quants, timestamps)
+        if self.cache is not None:
+            self.cache.touch(traded)
+        for listener in self.listeners:
+            listener(self, stocks, prices, quants, timestamps)
+        if self.retention is not None:
+            self.compact()
+        return num
+
+    @classmethod
+    def from_journal(cls, tradername, filename, indexed=True, market=None,
+                     clock=time):
+        """
+        NAME: Portfolio.from_journal(tradername, filename, indexed=True,
+                                     market=None, clock=time)
+
+        PURPOSE: To reopen a portfolio from its journal, e.g. after
+                 a restart. The journal file is memory mapped and 
+                 the trades are served straight from it, in a 
+                 columnar portfolio, without making a Trade object
+                 for each one. New trades are added to the journal.
+
+        INPUTS:  tradername = The trader's name (type = string)
+                 filename   = The journal file (type = string)
+                 indexed    = As for Portfolio()
+                 market     = As for Portfolio()
+                 clock      = As for Portfolio()
+
+        OUTPUTS: The Portfolio object
+
+        NOTES: Only the index (if indexed) has to be rebuilt, 
+               which NumPy does from the mapped columns, so this 
+               is much quicker than adding the trades again. No 
+               Python object is made for each trade: the positions
+               are worked out when one is first asked for.
+
+        """
+        symbols = market.symbols if market is not None else None
+        tradelist = TradeColumns.from_records(map_trade_file(filename), 
+                                              symbols)
+        portfolio = cls(tradername, tradelist, columnar=True, 
+                        indexed=indexed, market=market, clock=clock)
+        portfolio.journal = TradeJournal(filename)
+        return portfolio
+
+    def add_window(self, trange, stocks=None):
+        """
+        NAME: .add_window(trange, stocks=None)
+
+        PURPOSE: To set up a standing window of the last 'trange'
+                 minutes, kept up to date as trades are added. 
+                 volweightsp and asi_calc calls for this time 
+                 range are then answered from the window's running
+                 sums, without going back over the trades.
+
+        INPUTS:  trange = The length of the window in minutes 
+                          (type = float)
+                 stocks = The stocks to follow, or None for all 
+                          of them (type = list of strings)
+
+        OUTPUTS: The RollingWindow object
+
+        NOTES:   The window starts with the trades already in the 
+                 portfolio that fall within it. Only a window that
+                 follows all stocks is used for asi_calc.
+
+        """
+        window = RollingWindow(trange, stocks)
+        now = self.clock()
+        tstart = now - trange*60.
+        _scanned(len(self.tradelist))
+        recent = [trade for trade in self.tradelist 
+                  if trade.timestamp >= tstart]
+        recent.sort(key=lambda trade: trade.timestamp)
+        for trade in recent:
+            window.add(trade.stock, trade.tr_price, trade.tr_quant,
+                       trade.timestamp, now)
+        self.windows[trange] = window
+        return window
+
+    def remove_window(self, trange):
+        """ Stops keeping the standing window of 'trange' minutes """
+        del self.windows[trange]
+
+    def add_bars(self, resolution):
+        """
+        NAME: .add_bars(resolution)
+
+        PURPOSE: To keep time bars (open, high, low, close and 
+                 volume) of each stock's trades, updated as trades
+                 are added. Windowed prices can then be found from
+                 the bars, by passing the resolution to 
+                 volweightsp, volweightsp_all or asi_calc.
+
+        INPUTS:  resolution = The length of each bar in seconds,
+                              e.g. 1, 60 or 300 (type = float)
+
+        OUTPUTS: A dict of the TimeBars of each stock
+
+        NOTES: The bars start with the trades already in the 
+               portfolio.
+
+        """
+        self.bars[resolution] = {}
+        _scanned(len(self.tradelist))
+        self._add_bars([trade.stock for trade in self.tradelist],
+                       [trade.tr_price for trade in self.tradelist],
+                       [trade.tr_quant for trade in self.tradelist],
+                       [trade.timestamp for trade in self.tradelist],
+                       [resolution])
+        return self.bars[resolution]
+
+    def remove_bars(self, resolution):
+        """ Stops keeping the time bars of 'resolution' seconds """
+        del self.bars[resolution]
+
+    def add_sketches(self, k=200, bucket=None, max_periods=1440):
+        """
+        NAME: .add_sketches(k=200, bucket=None, max_periods=1440)
+
+        PURPOSE: To keep quantile sketches of each stock's trade
+                 prices and quantities, updated as trades are 
+                 added, so that their median and percentiles 
+                 can be found without sorting the trades
+
+        INPUTS:  k      = The accuracy of the sketches. A quantile
+                          is within about 1.7/k of the trades of 
+                          the true one, e.g. 1% for k=200, and 
+                          each sketch holds about 3*k values 
+                          (type = int)
+                 bucket = If given, a pair of sketches is kept for
+                          each period of 'bucket' seconds, so that
+                          quantiles can be found over a time range
+                          (type = float)
+                 max_periods = The most periods kept for each 
+                          stock, older ones being rolled up into
+                          one (see TradeSketches), or None for no
+                          limit (type = int)
+
+        OUTPUTS: A dict of the TradeSketches of each stock
+
+        NOTES: The sketches start with the trades already in the 
+               portfolio.
+
+        """
+        self.sketches = {}
+        self._sketch_options = (k, bucket, max_periods)
+        _scanned(len(self.tradelist))
+        self._add_sketches([trade.stock for trade in self.tradelist],
+                           [trade.tr_price for trade in self.tradelist],
+                           [trade.tr_quant for trade in self.tradelist],
+                           [trade.timestamp for trade in self.tradelist])
+        return self.sketches
+
+    def remove_sketches(self):
+        """ Stops keeping quantile sketches """
+        self.sketches = None
+
+    def _add_sketches(self, stocks, prices, quants, timestamps):
+        """ Adds trades to the quantile sketches """
+        sketches = self.sketches
+        for stock, price, quant, timestamp in zip(stocks, prices, quants,
+                                                  timestamps):
+            stock_sketches = sketches.get(stock)
+            if stock_sketches is None:
+                stock_sketches = sketches[stock] = \
+                                        TradeSketches(*self._sketch_options)
+            stock_sketches.add(price, quant, timestamp)
+
+    def set_retention(self, retention, resolution=60):
+        """
+        NAME: .set_retention(retention, resolution=60)
+
+        PURPOSE: To hold the trades of only the last 'retention'
+                 minutes, so that a long running portfolio doesn't
+                 keep growing. Older trades are compacted into 
+                 bars of each stock (the archive), and the Trade 
+                 objects let go. num_tr, earliest_tr, latest_tr,
+                 volweightsp, volweightsp_all and asi_calc still 
+                 count the compacted trades.
+
+        INPUTS:  retention  = How long to hold trades for, in 
+                              minutes, or None to stop compacting
+                              (type = float)
+                 resolution = The length of each bar of the 
+                              archive in seconds (type = float)
+
+        OUTPUTS: The number of trades compacted straight away
+
+        NOTES: Trades are compacted as they are added, a bar at a
+               time. A query whose time range starts before the 
+               retention is answered to whole bars of the archive,
+               as if given that resolution. Queries within the 
+               retention are answered from the trades, as before.
+
+               Reports, recent_trades and trades_between only see
+               the trades still held. The journal, positions, time
+               bars and standing windows are not changed.
+
+        """
+        if self.archive and float(resolution) != self._archive_resolution:
+            raise StockError("the archive's resolution can't be changed "
+                             "once trades have been compacted")
+        self.retention = retention
+        self._archive_resolution = float(resolution)
+        if retention is None:
+            return 0
+        return self.compact()
+
+    def compact(self, now=None):
+        """
+        NAME: .compact(now=None)
+
+        PURPOSE: To compact the trades older than the retention 
+                 into the archive. This is done as trades are 
+                 added, so need only be called to compact when no
+                 trades are coming in.
+
+        INPUTS:  now = The current time, in seconds, or None for 
+                       the clock's time (type = float)
+
+        OUTPUTS: The number of trades compacted
+
+        NOTES: Only whole bars are compacted, so nothing is done 
+               until another bar has passed out of the retention.
+               Any cached results are dropped.
+
+               The trades to go are found from the index. They are
+               normally the first trades added, which are then 
+               sliced off the front of the tradelist, and of each
+               series of the index, in place. Only if a trade was 
+               added more than the retention late are the trades
+               kept copied, and the index rebuilt.
+
+        """
+        if self.retention is None:
+            raise StockError("no retention has been set")
+        if now is None:
+            now = self.clock()
+        resolution = self._archive_resolution
+        cutoff = now - self.retention*60.
+        cutoff -= cutoff % resolution
+        if self.compacted_to is not None and cutoff <= self.compacted_to:
+            return 0
+        self.compacted_to = cutoff
+
+        # The rows of the trades to go, in order
+        if self.index is not None:
+            old = []
+            for series in self.index.series.itervalues():
+                times, rows, lo, hi = series.span(None, cutoff)
+                old.extend(rows[lo:hi])
+            old.sort()
+        elif self.columnar:
+            _scanned(len(self.tradelist))
+            old = np.flatnonzero(self.tradelist.timestamp < cutoff).tolist()
+        else:
+            _scanned(len(self.tradelist))
+            old = [row for row, trade in enumerate(self.tradelist)
+                   if trade.timestamp < cutoff]
+        num = len(old)
+        if num == 0:
+            return 0
+
+        if self.columnar:
+            cols = self.tradelist
+            names = cols.symbols.names
+            trades = zip([names[i] for i in cols.symid[old].tolist()],
+                         cols.price[old].tolist(), cols.quant[old].tolist(),
+                         cols.timestamp[old].tolist())
+        else:
+            trades = [(trade.stock, trade.tr_price, trade.tr_quant, 
+                       trade.timestamp) 
+                      for trade in (self.tradelist[row] for row in old)]
+        for stock, price, quant, timestamp in trades:
+            stock_bars = self.archive.get(stock)
+            if stock_bars is None:
+                stock_bars = self.archive[stock] = TimeBars(resolution)
+            stock_bars.add(price, quant, timestamp)
+
+        # The positions take the trades before they go
+        self._update_positions()
+        if old[-1] == num - 1:
+            # The first num trades, sliced off the front
+            if self.columnar:
+                self.tradelist.drop(num)
+            else:
+                del self.tradelist[:num]
+            if self.index is not None:
+                self.index.drop(cutoff, num)
+        else:
+            _scanned(len(self.tradelist))
+            if self.columnar:
+                self.tradelist.keep(self.tradelist.timestamp >= cutoff)
+            else:
+                self.tradelist[:] = [trade for trade in self.tradelist 
+                                     if trade.timestamp >= cutoff]
+            if self.index is not None:
+                self.reindex()
+        self._positions_to = len(self.tradelist)
+        self.num_compacted += num
+
+        _report(logging.DEBUG, "\n... Compacted %s of %s's trades", num,
+                self.tradername)
+        if self.cache is not None:
+            self.cache.clear()
+        return num
+
+    def enable_cache(self, maxsize=1024):
+        """
+        NAME: .enable_cache(maxsize=1024)
+
+        PURPOSE: To keep the results of recent volweightsp, 
+                 volweightsp_all and asi_calc queries, so that
+                 asking again costs almost nothing until a trade
+                 is added for a stock the result depends on, or
+                 a trade the result used ages out of its time 
+                 range
+
+        INPUTS:  maxsize = The most results to keep. The least 
+                           recently used are dropped first.
+
+        OUTPUTS: The ResultCache, whose stats() give the hits and
+                 misses
+
+        NOTES: Queries using time bars (resolution) aren't cached.
+
+        """
+        self.cache = ResultCache(maxsize)
+        return self.cache
+
+    def disable_cache(self):
+        """ Stops keeping query results """
+        self.cache = None
+
+    def add_listener(self, listener):
+        """
+        NAME: .add_listener(listener)
+
+        PURPOSE: To call a function each time trades are added, 
+                 e.g. so that a Market can follow the portfolio
+
+        INPUTS:  listener = A function taking (portfolio, stocks, 
+                            prices, quants, timestamps), the last
+                            four being lists with one entry per 
+                            trade added
+
+        OUTPUTS: None
+
+        """
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Stops calling a function each time trades are added """
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _add_bars(self, stocks, prices, quants, timestamps, resolutions=None):
+        """ Adds trades to the time bars (by default, all of them) """
+        if resolutions is None:
+            resolutions = self.bars.keys()
+        for resolution in resolutions:
+            bars = self.bars[resolution]
+            for stock, price, quant, timestamp in zip(stocks, prices, quants,
+                                                      timestamps):
+                stock_bars = bars.get(stock)
+                if stock_bars is None:
+                    stock_bars = bars[stock] = TimeBars(resolution)
+                stock_bars.add(price, quant, timestamp)
+
+    def sketch(self, stock, field='price', trange=None, start=None, 
+               end=None, asof=None):
+        """
+        NAME: .sketch(stock, field='price', trange=None, start=None, 
+                      end=None, asof=None)
+
+        PURPOSE: The quantile sketch of a stock's trade prices (or
+                 quantities) within a time range, e.g. to merge 
+                 with those of other portfolios
+
+        INPUTS:  stock = The stock abbreviation (type = string)
+                 field = 'price' or 'quant' (type = string)
+                 trange, start, end, asof = As for volweightsp. If
+                         none of these are given, all trades are
+                         summarised. A time range needs sketches 
+                         kept with a bucket, and is widened out to
+                         whole buckets.
+
+        OUTPUTS: A new QuantileSketch
+
+        """
+        if self.sketches is None:
+            raise StockError("quantile sketches are not being kept; "
+                             "call add_sketches first")
+        if field not in ('price', 'quant'):
+            raise StockError("field must be 'price' or 'quant'")
+        if trange is None and start is None:
+            tstart, tend = None, (asof if end is None else end)
+        else:
+            tstart, tend = _interval(self.clock, trange, start, end, asof)
+        if tend is not None or tstart is not None:
+            if self._sketch_options[1] is None:
+                raise StockError("quantile sketches kept without a bucket "
+                                 "can't be asked for a time range")
+        stock_sketches = self.sketches.get(str(stock).upper())
+        if stock_sketches is None:
+            return QuantileSketch(self._sketch_options[0])
+        prices, quants = stock_sketches.window(tstart, tend)
+        return prices if field == 'price' else quants
+
+    def quantile(self, stock, q, field='price', trange=None, start=None,
+                 end=None, asof=None):
+        """
+        NAME: .quantile(stock, q, field='price', trange=None, 
+                        start=None, end=None, asof=None)
+
+        PURPOSE: Estimates the median, or any other quantile, of a
+                 stock's trade prices (or quantities) from its 
+                 quantile sketches
+
+        INPUTS:  stock = The stock abbreviation (type = string)
+                 q     = The quantile, from 0 to 1, e.g. 0.5 for 
+                         the median or 0.99 for the 99th 
+                         percentile, or a list of them
+                 field, trange, start, end, asof = As for .sketch
+
+        OUTPUTS: The estimated quantile (or a list of them), or 0 
+                 (zero) for each if the stock hasn't been traded 
+                 within the time range
+
+        NOTES: The cost depends on k and the number of buckets 
+               in the time range, not on the number of trades.
+
+        """
+        sketch = self.sketch(stock, field, trange, start, end, asof)
+        qs = q if isinstance(q, (list, tuple)) else [q]
+        if sketch.count == 0:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            values = [0]*len(qs)
+        else:
+            values = sketch.quantiles(qs)
+        return values if isinstance(q, (list, tuple)) else values[0]
+
+
+
+class ConcurrentPortfolio(PortfolioBase):
+    """ 
+    The ConcurrentPortfolio class holds a trader's trades, like
+    a Portfolio, but many threads can add trades to it at once
+    (e.g. one per feed), while other threads query it. 
+
+    Attributes:
+        As for PortfolioBase, plus
+        locks       = The writers' locks. Each stock uses the lock
+                      chosen by the hash of its symbol, so writers
+                      of different stocks rarely wait for each 
+                      other (type = list of threading.Lock)
+
+    Methods:
+        As for PortfolioBase, plus
+        add_trade   = To add a trade, from any thread
+        add_trades  = To add a batch of trades, from any thread
+        snapshot    = The trades of each stock added so far
+
+    NOTES: The trades are always indexed, and held as a list of
+           Trade objects. Standing windows, time bars, quantile
+           sketches and cached results are not kept, trades 
+           are not compacted and no listeners are called, so
+           there are no methods for these (and a Market can't
+           register the portfolio).
+
+           Readers take no locks. The index keeps each stock's 
+           trades in a ConcurrentTradeSeries, so a query sees 
+           each stock's trades as they were at one moment, and 
+           sees every trade whose add_trade has returned. Only
+           the append to the tradelist (and the journal) is 
+           done under a lock shared by all writers. A stock's
+           position is updated under its writers' lock, so a
+           position read while a trade of that stock is being
+           added may be part way through it.
+
+    """
+
+    def __init__(self, tradername, tradelist, stripes=16, journal=None,
+                 market=None, clock=time):
+        """ Initialise the portfolio object """
+        self.locks = [threading.Lock() for i in xrange(stripes)]
+        self._append_lock = threading.Lock()
+        PortfolioBase.__init__(self, tradername, list(tradelist), 
+                               journal=journal, market=market, clock=clock)
+        # The positions are kept up to date as trades are added,
+        # under the writers' locks, rather than when asked for
+        PortfolioBase._update_positions(self)
+
+    def _update_positions(self):
+        """ The positions are always up to date """
+
+    def _lock(self, stock):
+        """ The writers' lock for a stock """
+        return self.locks[hash(stock) % len(self.locks)]
+
+    def _append(self, trades):
+        """ 
+        Appends trades to the journal and tradelist, returning 
+        the position of the first
+        """
+        with self._append_lock:
+            if self.journal is not None:
+                self.journal.extend(trades)
+            start = len(self.tradelist)
+            self.tradelist.extend(trades)
+        return start
+
+    def reindex(self):
+        """ As for Portfolio.reindex, with ConcurrentTradeSeries """
+        _scanned(len(self.tradelist))
+        self.index = TradeIndex([trade.stock for trade in self.tradelist],
+                                [trade.tr_price for trade in self.tradelist],
+                                [trade.tr_quant for trade in self.tradelist],
+                                [trade.timestamp for trade in self.tradelist],
+                                series_class=ConcurrentTradeSeries)
+
+    def add_trade(self, trade):
+        """ As for Portfolio.add_trade, safe to call from any thread """
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio ", 
+                self.tradername)
+        with self._lock(trade.stock):
+            row = self._append([trade])
+            self.index.add(trade.stock, trade.tr_price, trade.tr_quant,
+                           trade.timestamp, row)
+            self._add_positions([trade.stock], [trade.tr_price], 
+                                [trade.tr_quant], [trade.bors])
+
+    def add_trades(self, trades):
+        """ As for Portfolio.add_trades, safe to call from any thread """
+        if pa is not None and isinstance(trades, (pa.RecordBatch, pa.Table)):
+            trades = arrow_trade_records(trades)
+        if np is not None and isinstance(trades, np.ndarray):
+            _check_records(trades)
+            trades = [Trade(stock.upper(), price, quant, bors.upper(), 
+                            timestamp)
+                      for stock, price, quant, bors, timestamp in 
+                      zip(trades['stock'].tolist(), 
+                          trades['tr_price'].tolist(),
+                          trades['tr_quant'].tolist(), 
+                          trades['bors'].tolist(),
+                          trades['timestamp'].tolist())]
+        else:
+            trades = list(trades)
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio with %s trades",
+                self.tradername, len(trades))
+
+        # Take the locks of all of the batch's stocks, always in 
+        # the same order so that two batches can't deadlock
+        locks = sorted(set(self._lock(trade.stock) for trade in trades), 
+                       key=self.locks.index)
+        for lock in locks:
+            lock.acquire()
+        try:
+            start = self._append(trades)
+            self.index.add_batch([trade.stock for trade in trades],
+                                 [trade.tr_price for trade in trades],
+                                 [trade.tr_quant for trade in trades],
+                                 [trade.timestamp for trade in trades], 
+                                 start)
+            self._add_positions([trade.stock for trade in trades],
+                                [trade.tr_price for trade in trades],
+                                [trade.tr_quant for trade in trades],
+                                [trade.bors for trade in trades])
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return len(trades)
 
+    def snapshot(self):
+        """
+        NAME: .snapshot()
+
+        PURPOSE: Returns the trades of each stock added so far, 
+                 without stopping other threads adding more
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A dictionary mapping each stock symbol to the 
+                 state of its ConcurrentTradeSeries, 
+                 (times, rows, cum_pq, cum_q, n), of which only
+                 the first n trades of the arrays are to be used
+
+        """
+        return dict((stock, series.state) 
+                    for stock, series in self.index.series.items())
+
+
+def _shard_worker(conn):
+    """ 
+    Runs one shard of a ShardedPortfolio: a non-interactive 
+    Portfolio that answers the requests sent down conn
+    """
+    set_interactive(False)
+    portfolio = Portfolio("Shard", [])
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        if method == 'add_trades':
+            # Sent without waiting for a reply
+            portfolio.add_trades(Trade(*row) for row in args)
+            continue
+        try:
+            if method == 'log_sums':
+                prices = portfolio.volweightsp_all(*args).values()
+                result = sum(log(price) for price in prices), len(prices)
+            else:
+                result = getattr(portfolio, method)(*args)
+            conn.send((True, result))
+        except Exception as err:
+            conn.send((False, err))
+    conn.close()
+
+
+class ShardedPortfolio(object):
+    """ 
+    The ShardedPortfolio class holds a portfolio split by stock
+    over a pool of worker processes (shards), so that queries
+    over many stocks use more than one core. It has the same
+    methods as a Portfolio for adding trades and for querying.
+
+    Attributes:
+        tradername  = The trader's name (type = string)
+        shards      = The number of worker processes (type = int)
+        buffer_size = The number of trades held for a shard before
+                      they are sent to it (type = int)
+        clock       = The function giving the current time, in 
+                      seconds (type = function, default time.time)
+
+    Methods:
+        add_trade   = To add a trade into the portfolio
+        add_trades  = To add a batch of trades into the portfolio
+        flush       = Send any held trades to the shards
+        close       = Stop the worker processes
+        volweightsp = The volume weighted stock price
+        volweightsp_all = The volume weighted price of every
+                      stock traded within a time range
+        asi_calc    = The All Share Index
+        earliest_tr = Print the time of the earlist trade
+        num_tr      = The number of trades in the portfolio
+        num_stocks  = The number of different stocks
+        stock_types = The stock types in the portfolio
+
+    NOTES: Each stock's trades are all held by the shard chosen
+           by the hash of its symbol. Trades are held back and 
+           sent to the shards buffer_size at a time, and any
+           held trades are sent before each query.
+
+           A query over all stocks is sent to every shard at 
+           once, and the shards work on it in parallel. For 
+           asi_calc each shard returns just the sum of the logs
+           of its stocks' vol. weighted prices and the number 
+           of them, which are added up here. The shards don't 
+           print anything, whatever the mode. The clock is read 
+           here, once per query, so every shard uses the same 
+           time range.
+
+    """
+
+    def __init__(self, tradername, tradelist, shards=None, buffer_size=1000,
+                 clock=time):
+        """ Initialise the portfolio object, starting the shards """
+        self.tradername = tradername
+        self.clock = clock
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        self.shards = shards
+        self.buffer_size = buffer_size
+        self._conns = []
+        self._procs = []
+        for i in xrange(shards):
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_shard_worker, 
+                                           args=(child_conn,))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._buffers = [[] for i in xrange(shards)]
+        self.add_trades(tradelist)
+
+    def _shard(self, stock):
+        """ The shard that holds a stock's trades """
+        return hash(stock) % self.shards
+
+    def _send(self, shard):
+        """ Sends the trades held for a shard """
+        if self._buffers[shard]:
+            self._conns[shard].send(('add_trades', self._buffers[shard]))
+            self._buffers[shard] = []
+
+    def _call(self, method, args=(), shards=None):
+        """ 
+        Calls a method in some shards (default all of them), in 
+        parallel, returning a list of their results
+        """
+        if shards is None:
+            shards = xrange(self.shards)
+        self.flush()
+        for shard in shards:
+            self._conns[shard].send((method, args))
+        results = [self._conns[shard].recv() for shard in shards]
+        for success, result in results:
+            if not success:
+                raise result
+        return [result for success, result in results]
+
+    def add_trade(self, trade):
+        """
+        NAME: .add_trade(trade)
+
+        PURPOSE: To add a trade into the portfolio
+
+        INPUTS:  A trade object
+
+        OUTPUTS: None
+
+        """
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio ", 
+                self.tradername)
+        shard = self._shard(trade.stock)
+        buf = self._buffers[shard]
+        buf.append((trade.stock, trade.tr_price, trade.tr_quant, trade.bors, 
+                    trade.timestamp))
+        if len(buf) >= self.buffer_size:
+            self._send(shard)
+
+    def add_trades(self, trades):
+        """
+        NAME: .add_trades(trades)
+
+        PURPOSE: To add a batch of trades into the portfolio
+
+        INPUTS:  trades = An iterable of trade objects
+
+        OUTPUTS: The number of trades added
+
+        """
+        num = 0
+        for trade in trades:
+            shard = self._shard(trade.stock)
+            self._buffers[shard].append((trade.stock, trade.tr_price, 
+                                         trade.tr_quant, trade.bors, 
+                                         trade.timestamp))
+            num += 1
+        _report(logging.DEBUG, "\n... Updating %s's Portfolio with %s trades",
+                self.tradername, num)
+        for shard in xrange(self.shards):
+            if len(self._buffers[shard]) >= self.buffer_size:
+                self._send(shard)
+        return num
+
+    def flush(self):
+        """ Sends any held trades to the shards """
+        for shard in xrange(self.shards):
+            self._send(shard)
+
+    def close(self):
+        """ Stops the worker processes """
+        for conn in self._conns:
+            conn.send((None, None))
+            conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns, self._procs = [], []
+
+    def volweightsp(self, stock_search, trange=None, start=None, end=None,
+                    asof=None):
+        """ As for Portfolio.volweightsp, answered by one shard """
+        if type(stock_search) != str:
+            stock_search = str(stock_search)
+        stock_search = stock_search.upper()
+        start, end = _interval(self.clock, trange, start, end, asof)
+        return self._call('volweightsp', (stock_search, None, None, start, 
+                                          end),
+                          [self._shard(stock_search)])[0]
+
+    def volweightsp_all(self, trange=None, start=None, end=None, asof=None):
+        """ As for Portfolio.volweightsp_all """
+        start, end = _interval(self.clock, trange, start, end, asof)
+        vwsp = {}
+        for shard_vwsp in self._call('volweightsp_all', 
+                                     (None, None, start, end)):
+            vwsp.update(shard_vwsp)
+        return vwsp
+
+    def asi_calc(self, trange=None, start=None, end=None, asof=None):
+        """ 
+        As for Portfolio.asi_calc, the geometric mean of the 
+        prices of all of the shards' stocks
+        """
+        _report(logging.DEBUG, "\n>>> Computing All Share Index (ASI) using"
+                " %s's Portfolio <<<", self.tradername)
+        start, end = _interval(self.clock, trange, start, end, asof)
+        log_sums = self._call('log_sums', (None, None, start, end))
+        num = sum(shard_num for log_sum, shard_num in log_sums)
+        if num == 0:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0
+        return exp(sum(log_sum for log_sum, shard_num in log_sums)/num)
+
+    def earliest_tr(self, start=None, end=None, asof=None):
+        """ As for Portfolio.earliest_tr """
+        if end is None:
+            end = asof
+        now = self.clock() if asof is None else asof
+        trades = [trade for trade in 
+                  self._call('earliest_trade', (start, end))
+                  if trade is not None]
+        if not trades:
+            _report(logging.INFO, " >>> No trades in given time range...")
+            return 0
+        trade = min(trades, key=attrgetter('timestamp'))
+        oldest = now - trade.timestamp
+        _report(logging.INFO, "\n>>> The earliest trade was %ss ago:", oldest)
+        _report(logging.INFO, "%s", trade)
+        return oldest
+
+    def num_tr(self):
+        """ The number of trades in the portfolio """
+        return sum(self._call('num_tr'))
+
+    def num_stocks(self):
+        """ The number of stock types in the portfolio """
+        return sum(self._call('num_stocks'))
+
+    def stock_types(self):
+        """ A list of the stock types in the portfolio """
+        return [stock for stocks in self._call('stock_types') 
+                for stock in stocks]
+
+# Reading and writing trade files
+
+def _check_side(stock, bors):
+    """ 
+    Returns bors in upper case, or raises an InvalidSideError if
+    it isn't 'B' or 'S' in either case 
+    """
+    side = bors.upper() if isinstance(bors, basestring) else bors
+    if side not in ('B', 'S'):
+        raise InvalidSideError("%s: bors must be 'B' or 'S', not %r" 
+                               % (stock, bors))
+    return side
+
+
+def _check_symbols(stocks):
+    """ 
+    Raises a StockError if any of the stock symbols is too long
+    for a trade record
+    """
+    for stock in stocks:
+        if len(stock) > 8:
+            raise StockError("stock symbols longer than 8 characters (%s) "
+                             "can't be held in a trade record" % (stock))
+
+
+def _check_records(records, first=0):
+    """ 
+    Raises a StockError for the first invalid trade in an array
+    of trade records, numbering them from first 
+    """
+    valid = ((records['tr_price'] > 0) & (records['tr_quant'] > 0) &
+             np.isfinite(records['tr_price']) & 
+             np.isfinite(records['tr_quant']) &
+             np.in1d(records['bors'], ['B', 'S', 'b', 's']))
+    if not valid.all():
+        num = int(np.argmin(valid))
+        record = records[num]
+        _check_trade(first + num, record['stock'], record['tr_price'],
+                     record['tr_quant'], record['bors'].upper())
+
+
+def _check_trade(num, stock, price, quant, bors):
+    """ 
+    Raises a StockError if trade number num isn't valid. NaN 
+    and infinite prices or quantities aren't valid.
+    """
+    if not 0 < price < INF:
+        raise InvalidPriceError("trade %s (%s): price must be > 0, not %s" 
+                                % (num, stock, price))
+    if not 0 < quant < INF:
+        raise InvalidQuantityError("trade %s (%s): quantity must be > 0, "
+                                   "not %s" % (num, stock, quant))
+    if bors not in ('B', 'S'):
+        raise InvalidSideError("trade %s (%s): bors must be 'B' or 'S', "
+                               "not %r" % (num, stock, bors))
+
+
+def read_csv_trades(csvfile, chunksize=10000):
+    """
+    NAME: read_csv_trades(csvfile, chunksize=10000)
+
+    PURPOSE: Reads the trades in a CSV file, a chunk at a time
+
+    INPUTS:  csvfile   = An open file with one trade per line as
+                         stock,price,quantity,bors,timestamp and 
+                         an optional header line
+             chunksize = The number of trades per chunk
+
+    OUTPUTS: Yields lists of up to chunksize trade objects
+
+    NOTES: An invalid line raises a StockError giving its line
+           number, rather than asking the user to correct it.
+
+    """
+    chunk = []
+    for num, row in enumerate(csv.reader(csvfile), 1):
+        if not row:
+            continue
+        try:
+            stock, price, quant, bors, timestamp = row
+            price, quant = float(price), float(quant)
+            timestamp = float(timestamp)
+        except ValueError:
+            if num == 1:
+                # A header line
+                continue
+            raise StockError("line %s: expected stock,price,quantity,"
+                             "bors,timestamp, not %r" % (num, row))
+        stock, bors = stock.strip().upper(), bors.strip().upper()
+        _check_trade(num, stock, price, quant, bors)
+        chunk.append(Trade(stock, price, quant, bors, timestamp))
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_binary_trades(binfile, chunksize=100000):
+    """
+    NAME: read_binary_trades(binfile, chunksize=100000)
+
+    PURPOSE: Reads the trades in a binary trade file, a chunk 
+             at a time
+
+    INPUTS:  binfile   = An open file of TRADE_RECORD records
+             chunksize = The number of trades per chunk
+
+    OUTPUTS: Yields NumPy arrays of up to chunksize trade records
+             (dtype TRADE_DTYPE), or lists of trade objects if 
+             NumPy isn't available
+
+    """
+    size = TRADE_RECORD.size
+    first = 0
+    while True:
+        buf = binfile.read(chunksize*size)
+        if not buf:
+            return
+        if len(buf) % size:
+            raise StockError("trade %s: the file ends part way through "
+                             "a trade record" % (first + len(buf)//size))
+        if np is not None:
+            records = np.frombuffer(buf, dtype=TRADE_DTYPE)
+            _check_records(records, first)
+            yield records
+        else:
+            chunk = []
+            for offset in xrange(0, len(buf), size):
+                stock, price, quant, timestamp, bors = \
+                            TRADE_RECORD.unpack_from(buf, offset)
+                stock, bors = stock.rstrip('\0'), bors.upper()
+                _check_trade(first + offset//size, stock, price, quant, bors)
+                chunk.append(Trade(stock, price, quant, bors, timestamp))
+            yield chunk
+        first += len(buf)//size
+
+
+def map_trade_file(filename):
+    """
+    NAME: map_trade_file(filename)
+
+    PURPOSE: Memory maps a binary trade file (or journal), 
+             read only
+
+    INPUTS:  filename = The binary trade file
+
+    OUTPUTS: A NumPy array of trade records (dtype TRADE_DTYPE)
+             that reads straight from the mapped file
+
+    NOTES: Any part record at the end of the file is left out.
+
+    """
+    if np is None:
+        raise ImportError("numpy is needed to map a trade file")
+    with open(filename, 'rb') as binfile:
+        size = os.fstat(binfile.fileno()).st_size
+        size -= size % TRADE_RECORD.size
+        if size == 0:
+            return np.zeros(0, dtype=TRADE_DTYPE)
+        mapped = mmap.mmap(binfile.fileno(), size, access=mmap.ACCESS_READ)
+    return np.frombuffer(mapped, dtype=TRADE_DTYPE)
+
+
+def arrow_trade_records(batch):
+    """
+    NAME: arrow_trade_records(batch)
+
+    PURPOSE: Converts an Arrow record batch (or table) of trades,
+             as from Portfolio.to_arrow, to trade records
+
+    INPUTS:  batch = A pyarrow.RecordBatch or pyarrow.Table with 
+                     'stock', 'tr_price', 'tr_quant', 'timestamp' 
+                     and 'bors' fields
+
+    OUTPUTS: A NumPy array of trade records (dtype TRADE_DTYPE)
+
+    """
+    if isinstance(batch, pa.Table):
+        batches = batch.to_batches()
+        if not batches:
+            return np.zeros(0, dtype=TRADE_DTYPE)
+        return np.concatenate([arrow_trade_records(part) 
+                               for part in batches])
+    records = np.zeros(batch.num_rows, dtype=TRADE_DTYPE)
+    for name in TRADE_DTYPE['names']:
+        column = batch.column(batch.schema.get_field_index(name))
+        if name in ('stock', 'bors'):
+            records[name] = [str(value).upper() for value in 
+                             column.to_pylist()]
+        else:
+            records[name] = column.to_numpy()
+    return records
+
+
+def write_binary_trades(binfile, trades):
+    """
+    NAME: write_binary_trades(binfile, trades)
+
+    PURPOSE: Writes trades to a binary trade file, as one 
+             TRADE_RECORD record per trade
+
+    INPUTS:  binfile = An open file, in binary mode
+             trades  = An iterable of trade objects
+
+    OUTPUTS: None
+
+    """
+    pack = TRADE_RECORD.pack
+    chunk = []
+    for trade in trades:
+        if len(trade.stock) > 8:
+            raise StockError("stock symbols longer than 8 characters (%s) "
+                             "can't be written" % (trade.stock))
+        chunk.append(pack(trade.stock, trade.tr_price, trade.tr_quant, 
+                          trade.timestamp, trade.bors))
+        if len(chunk) == 4096:
+            binfile.write(''.join(chunk))
+            chunk = []
+    binfile.write(''.join(chunk))
+
+
+# Trade feeds
+
+class FeedResult(object):
+    """
+    The FeedResult class holds the result of a query made 
+    through a FeedConsumer, once the consumer has got to it.
+
+    Attributes:
+        ready  = Set once the result is ready (type = 
+                 threading.Event)
+
+    Methods:
+        result = Waits for the result, and returns it
+
+    """
 
+    def __init__(self, method, args):
+        """ Initialise the class """
+        self.method = method
+        self.args = args
+        self.ready = threading.Event()
+        self._value = self._error = None
+
+    def result(self, timeout=None):
+        """
+        NAME: .result(timeout=None)
+
+        PURPOSE: Waits for the result of the query
+
+        INPUTS:  timeout = The longest time to wait in seconds,
+                           or None to wait for as long as it takes
+
+        OUTPUTS: The result, as returned by the Portfolio method.
+                 Any exception the method raised is raised here.
+
+        """
+        if not self.ready.wait(timeout):
+            raise RuntimeError("no result after %s seconds" % (timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class FeedConsumer(object):
+    """
+    The FeedConsumer class takes raw trades from a feed, checks
+    them, and adds them to a portfolio in batches, from a 
+    thread of its own. 
+
+    Attributes:
+        portfolio  = The portfolio the trades are added to
+                     (type = Portfolio)
+        queue      = The raw trades (and queries) waiting to be
+                     taken. It holds at most maxsize, after which
+                     put() waits, so a fast feed is held back 
+                     rather than using up memory (type = Queue)
+        batch_size = The most trades added in one batch (type = int)
+        added      = The number of trades added (type = int)
+        rejected   = The number of raw trades that weren't valid,
+                     which are logged and left out (type = int)
+        failed     = The number of valid trades in batches the 
+                     portfolio failed to add (type = int)
+        error      = The last error adding a batch, or None
+                     (type = Exception)
+
+    Methods:
+        put         = Queue a raw trade
+        consume     = Queue every raw trade from a feed
+        volweightsp = Queue a volweightsp query
+        asi_calc    = Queue an asi_calc query
+        close       = Finish the queued trades and stop, waiting
+                      up to a timeout
+
+    NOTES: A raw trade is a tuple of (stock, price, quantity, 
+           bors) or (stock, price, quantity, bors, timestamp). 
+           A trade without a timestamp is timed, by the 
+           portfolio's clock, when it is taken from the queue.
+
+           Queries go through the same queue, so they see every 
+           trade queued before them. They return a FeedResult, 
+           to wait on for the answer. Only the consumer's thread
+           uses the portfolio, so it needs no locks.
+
+           If the portfolio fails to add a batch, the error is 
+           logged and kept in error, the queries queued after 
+           the batch (up to the next batch added) raise it from
+           their result(), and the consumer goes on. Should the 
+           thread itself stop with an error, every query still 
+           queued raises it.
+
+    """
+
+    def __init__(self, portfolio, maxsize=10000, batch_size=1000):
+        """ Initialise the class and start its thread """
+        self.portfolio = portfolio
+        self.queue = Queue(maxsize)
+        self.batch_size = batch_size
+        self.added = self.rejected = self.failed = 0
+        self.error = self._batch_error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, raw, timeout=None):
+        """ 
+        Queues a raw trade, waiting (up to timeout seconds) if 
+        the queue is full 
+        """
+        self.queue.put(raw, True, timeout)
+
+    def consume(self, feed):
+        """
+        NAME: .consume(feed)
+
+        PURPOSE: Queues every raw trade from a feed
+
+        INPUTS:  feed = An iterable of raw trades, e.g. from 
+                        simulated_feed
+
+        OUTPUTS: The number of raw trades queued
+
+        """
+        num = 0
+        for raw in feed:
+            self.queue.put(raw)
+            num += 1
+        return num
+
+    def volweightsp(self, stock_search, trange):
+        """ Queues a Portfolio.volweightsp query, returning a FeedResult """
+        return self._query('volweightsp', (stock_search, trange))
+
+    def asi_calc(self, trange):
+        """ Queues a Portfolio.asi_calc query, returning a FeedResult """
+        return self._query('asi_calc', (trange,))
+
+    def close(self, timeout=None):
+        """ 
+        Adds the trades still queued, then stops the thread, 
+        waiting up to timeout seconds in all for it. Returns 
+        whether the thread has stopped.
+        """
+        if self._thread.is_alive():
+            # The time spent waiting for room in the queue counts
+            # against the timeout
+            started = time()
+            try:
+                self.queue.put(None, True, timeout)
+            except Full:
+                return False
+            if timeout is not None:
+                timeout = max(0., timeout - (time() - started))
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _query(self, method, args):
+        """ Queues a query of the portfolio """
+        query = FeedResult(method, args)
+        self.queue.put(query)
+        return query
+
+    def _trade(self, raw):
+        """ Makes a Trade from a raw trade, or None if it isn't valid """
+        try:
+            stock, price, quant, bors = raw[:4]
+            if len(raw) > 4:
+                timestamp = float(raw[4])
+            else:
+                timestamp = getattr(self.portfolio, 'clock', time)()
+            stock, bors = str(stock).upper(), str(bors).upper()
+            price, quant = float(price), float(quant)
+            _check_trade(self.added + self.rejected, stock, price, quant, 
+                         bors)
+        except (ValueError, TypeError) as err:
+            self.rejected += 1
+            _report(logging.WARNING, "\n!! Rejected trade %r: %s", raw, err)
+            return None
+        return Trade(stock, price, quant, bors, timestamp)
+
+    def _add(self, batch):
+        """ 
+        Adds a batch of trades to the portfolio, keeping the error
+        for the queries behind it if it fails
+        """
+        try:
+            self.added += self.portfolio.add_trades(batch)
+        except Exception as err:
+            self.failed += len(batch)
+            self.error = self._batch_error = err
+            _report(logging.ERROR, "\n!! Failed to add a batch of %s trades: "
+                    "%s", len(batch), err)
+        else:
+            self._batch_error = None
+
+    def _run(self):
+        """ Takes trades and queries from the queue until closed """
+        try:
+            self._take()
+        except Exception as err:
+            self.error = err
+            _report(logging.ERROR, "\n!! The feed consumer stopped: %s", err)
+            # Nothing more will be taken, so fail the queries left
+            while not self.queue.empty():
+                item = self.queue.get()
+                if isinstance(item, FeedResult):
+                    item._error = err
+                    item.ready.set()
+
+    def _take(self):
+        """ The loop of _run """
+        get = self.queue.get
+        while True:
+            # Wait for the next item, then take whatever else is 
+            # already queued, up to a batch
+            items = [get()]
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(get())
+
+            batch = []
+            for item in items:
+                if item is None or isinstance(item, FeedResult):
+                    if batch:
+                        self._add(batch)
+                        batch = []
+                    if item is None:
+                        return
+                    if self._batch_error is not None:
+                        # Its answer would be missing the failed batch
+                        item._error = self._batch_error
+                    else:
+                        try:
+                            item._value = getattr(self.portfolio, 
+                                                  item.method)(*item.args)
+                        except Exception as err:
+                            item._error = err
+                    item.ready.set()
+                else:
+                    trade = self._trade(item)
+                    if trade is not None:
+                        batch.append(trade)
+            if batch:
+                self._add(batch)
+
+
+def simulated_feed(num_trades, stocks=('TEA', 'POP', 'ALE', 'GIN', 'JOE'), 
+                   rate=None, seed=0):
+    """
+    NAME: simulated_feed(num_trades, stocks=('TEA', 'POP', 'ALE', 
+                         'GIN', 'JOE'), rate=None, seed=0)
+
+    PURPOSE: A made up feed of raw trades, for trying out a 
+             FeedConsumer without a real feed
+
+    INPUTS:  num_trades = The number of trades
+             stocks     = The stock symbols traded
+             rate       = The trades per second, or None to make
+                          them as fast as they are taken
+             seed       = The random seed, so feeds are repeatable
+
+    OUTPUTS: Yields raw trades, (stock, price, quantity, bors, 
+             timestamp), timestamped when they are made
+
+    NOTES: Each stock's price is a random walk.
+
+    """
+    rand = random.Random(seed)
+    prices = dict((stock, rand.uniform(10., 500.)) for stock in stocks)
+    for i in xrange(num_trades):
+        if rate is not None:
+            sleep(1./rate)
+        stock = rand.choice(stocks)
+        prices[stock] = max(0.01, prices[stock]*(1. + rand.gauss(0., 0.001)))
+        yield (stock, round(prices[stock], 2), float(rand.randint(1, 1000)),
+               'B' if rand.random() < 0.5 else 'S', time())
+
+
+# Instrumentation
+
+class Instrumentation(object):
+    """
+    The Instrumentation class records, for each instrumented 
+    method, the number of calls, the number of trades scanned 
+    and a histogram of the call latencies.
+
+    Attributes:
+        calls   = A dictionary of the number of calls, keyed
+                  by method name ('Class.method')
+        scanned = A dictionary of the number of trades scanned
+        seconds = A dictionary of the total time spent, in 
+                  seconds
+        counts  = A dictionary of the latency histogram of 
+                  each method, as a list of counts with one 
+                  more entry than BUCKETS (the last counts the
+                  calls slower than the largest bucket)
+
+    Methods:
+        reset            = Clears all the recorded values
+        record           = Records one call
+        snapshot         = The recorded values as a dictionary
+        prometheus       = The recorded values in the Prometheus
+                           text format
+        write_prometheus = Writes the Prometheus text to a file
+
+    NOTES: The latency buckets are powers of two, from 1 
+           microsecond to about 1 second, as upper bounds. The
+           values are recorded and read under a lock, so calls
+           can be recorded from many threads at once.
+
+    """
+    BUCKETS = tuple(1e-6*2**i for i in range(21))
+
+    def __init__(self):
+        """ Initialise the class, with nothing recorded """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clears all the recorded values """
+        with self._lock:
+            self.calls = {}
+            self.scanned = {}
+            self.seconds = {}
+            self.counts = {}
+
+    def record(self, name, seconds, scanned=0):
+        """
+        NAME: .record(name, seconds, scanned=0)
+
+        PURPOSE: Records one call of a method
+
+        INPUTS:  name    = The method name, as 'Class.method'
+                 seconds = How long the call took
+                 scanned = The number of trades it scanned
+
+        OUTPUTS: None
+
+        """
+        bucket = bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            counts = self.counts.get(name)
+            if counts is None:
+                counts = self.counts[name] = [0]*(len(self.BUCKETS) + 1)
+                self.calls[name] = self.scanned[name] = 0
+                self.seconds[name] = 0.
+            self.calls[name] += 1
+            self.scanned[name] += scanned
+            self.seconds[name] += seconds
+            counts[bucket] += 1
+
+    def snapshot(self):
+        """
+        NAME: .snapshot()
+
+        PURPOSE: Returns a copy of the values recorded so far
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A dictionary, keyed by method name, of 
+                 dictionaries with the 'calls', 'trades_scanned',
+                 'total_seconds' and 'histogram' of the method.
+                 The histogram is a list of (upper bound, count) 
+                 pairs, the last with an upper bound of inf.
+
+        """
+        bounds = self.BUCKETS + (float('inf'),)
+        with self._lock:
+            return dict((name, {'calls': self.calls[name],
+                                'trades_scanned': self.scanned[name],
+                                'total_seconds': self.seconds[name],
+                                'histogram': zip(bounds, counts)})
+                        for name, counts in self.counts.iteritems())
+
+    def prometheus(self):
+        """
+        NAME: .prometheus()
+
+        PURPOSE: Returns the values recorded so far in the 
+                 Prometheus text exposition format
+
+        INPUTS:  None (self)
+
+        OUTPUTS: A string, with the counters 
+                 supersimplestocks_calls_total and 
+                 supersimplestocks_trades_scanned_total and the
+                 histogram supersimplestocks_latency_seconds, each
+                 labelled by method
+
+        """
+        with self._lock:
+            return self._prometheus()
+
+    def _prometheus(self):
+        """ The text of prometheus, made under the lock """
+        names = sorted(self.counts)
+        lines = ['# HELP supersimplestocks_calls_total Number of calls.',
+                 '# TYPE supersimplestocks_calls_total counter']
+        lines.extend('supersimplestocks_calls_total{method="%s"} %d' 
+                     % (name, self.calls[name]) for name in names)
+        lines.extend(['# HELP supersimplestocks_trades_scanned_total '
+                      'Number of trades scanned.',
+                      '# TYPE supersimplestocks_trades_scanned_total counter'])
+        lines.extend('supersimplestocks_trades_scanned_total{method="%s"} %d'
+                     % (name, self.scanned[name]) for name in names)
+        lines.extend(['# HELP supersimplestocks_latency_seconds '
+                      'Call latency.',
+                      '# TYPE supersimplestocks_latency_seconds histogram'])
+        for name in names:
+            total = 0
+            for bound, count in zip(self.BUCKETS, self.counts[name]):
+                total += count
+                lines.append('supersimplestocks_latency_seconds_bucket'
+                             '{method="%s",le="%r"} %d' % (name, bound, total))
+            lines.append('supersimplestocks_latency_seconds_bucket'
+                         '{method="%s",le="+Inf"} %d' 
+                         % (name, self.calls[name]))
+            lines.append('supersimplestocks_latency_seconds_sum'
+                         '{method="%s"} %r' % (name, self.seconds[name]))
+            lines.append('supersimplestocks_latency_seconds_count'
+                         '{method="%s"} %d' % (name, self.calls[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """
+        NAME: .write_prometheus(filename)
+
+        PURPOSE: Writes the Prometheus text to a file, e.g. for
+                 the node exporter's textfile collector
+
+        INPUTS:  filename = The file to write
+
+        OUTPUTS: None
+
+        NOTES: The text is written to a temporary file that is 
+               then renamed, so the file is never read half 
+               written.
+
+        """
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'w') as promfile:
+            promfile.write(self.prometheus())
+        os.rename(tmpname, filename)
+
+
+# The values recorded while instrumentation is enabled
+instrumentation = Instrumentation()
+
+# The original methods of the instrumented classes, keyed by
+# (class, method name)
+_uninstrumented = {}
+
+
+def _scan_done():
+    """ 
+    Ends the innermost count of trades scanned, adding it to the
+    count it is within, and returns it
+    """
+    stack = _scan_counts.stack
+    scanned = stack.pop()
+    if stack:
+        stack[-1] += scanned
+    return scanned
+
+
+def _instrumented(name, method):
+    """ 
+    Wraps method to record its calls in instrumentation. For a 
+    generator method, a call lasts until the generator finishes
+    (or is closed), and the time spent making each item counts,
+    not the time between items.
+    """
+    def wrapper(*args, **kwargs):
+        _scan_counts.stack.append(0)
+        start = time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time() - start
+            instrumentation.record(name, seconds, _scan_done())
+
+    def generator_wrapper(*args, **kwargs):
+        iterator = method(*args, **kwargs)
+        seconds = scanned = 0
+        try:
+            while True:
+                _scan_counts.stack.append(0)
+                start = time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time() - start
+                    scanned += _scan_done()
+                yield item
+        finally:
+            iterator.close()
+            instrumentation.record(name, seconds, scanned)
+
+    if inspect.isgeneratorfunction(method):
+        wrapper = generator_wrapper
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def enable_instrumentation(classes=None):
+    """
+    NAME: enable_instrumentation(classes=None)
+
+    PURPOSE: Starts recording the calls, trades scanned and 
+             latencies of the public methods (and __repr__) of 
+             some classes, in the module's instrumentation 
+             object
+
+    INPUTS:  classes = The classes to instrument. Defaults to 
+                       Stock, Trade and Portfolio.
+
+    OUTPUTS: The Instrumentation object, instrumentation
+
+    NOTES: The methods are replaced by timing wrappers, and put
+           back by disable_instrumentation, so there is no 
+           overhead when instrumentation is off. A call made 
+           within another instrumented call is counted for 
+           both, and its trades scanned are added to both. 
+           A generator method is timed while it makes its items,
+           and recorded once it finishes or is closed. Each 
+           thread counts the trades scanned by its own calls, 
+           so calls made from many threads at once (e.g. by a 
+           FeedConsumer, or a ConcurrentPortfolio's writers) are
+           each counted for their own trades.
+
+    """
+    if classes is None:
+        classes = (Stock, Trade, Portfolio)
+    for cls in classes:
+        # The methods a class inherits are instrumented on the class
+        # itself, under its own name, leaving its bases as they were
+        methods = {}
+        for base in reversed(cls.__mro__[:-1]):
+            methods.update(vars(base))
+        for attr, method in methods.items():
+            if ((attr.startswith('_') and attr != '__repr__') or
+                    not callable(method) or
+                    (cls, attr) in _uninstrumented):
+                continue
+            _uninstrumented[cls, attr] = vars(cls).get(attr)
+            setattr(cls, attr, 
+                    _instrumented('%s.%s' % (cls.__name__, attr), method))
+    return instrumentation
+
+
+def disable_instrumentation():
+    """
+    NAME: disable_instrumentation()
+
+    PURPOSE: Puts back the original methods replaced by 
+             enable_instrumentation. The values recorded so far
+             are kept, in instrumentation.
+
+    INPUTS:  None
+
+    OUTPUTS: None
+
+    """
+    for (cls, attr), method in _uninstrumented.items():
+        if method is None:
+            delattr(cls, attr)
+        else:
+            setattr(cls, attr, method)
+    _uninstrumented.clear()
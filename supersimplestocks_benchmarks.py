@@ -0,0 +1,559 @@
+""" 
+NAME: supersimplestocks_benchmarks.py
+
+AUTHOR: The supersimplestocks contributors (the classes it 
+        measures were first written by Graham Kerr)
+
+PURPOSE: To measure the performance of the classes in 
+         supersimplestocks.py
+
+INPUTS:  Command line options, see 
+             python supersimplestocks_benchmarks.py --help
+
+OUTPUTS: Prints to screen (on terminal), and optionally saves
+         the results to a JSON file
+
+DATE WRITTEN: 18th October 2026, with the memory benchmark
+     MOD HISTORY: 18th October 2026 -- the timing benchmarks and
+                  baseline regression checks; the ConcurrentPortfolio
+                  stress test; each size run in a process of its
+                  own, for its memory
+
+NOTES: The timing benchmarks make a seeded synthetic market 
+       of trades for each portfolio size, add the trades to a 
+       portfolio one at a time, and then time repeated calls 
+       of the main Portfolio methods. For each method the 
+       throughput (calls per second) and latency percentiles
+       are reported, along with the memory used. Each size is 
+       run in a child process of its own, and the memory used
+       is how far that process's peak resident memory grew 
+       during the run, so that one size's peak doesn't hide 
+       the next's.
+
+       A saved set of results can be used as a baseline for a 
+       later run, which then fails (exit status 1) if any 
+       method's median latency has grown by more than the 
+       threshold for it, e.g.
+
+         python supersimplestocks_benchmarks.py --save base.json
+         python supersimplestocks_benchmarks.py --baseline base.json
+                --threshold 0.25 --threshold asi_calc=0.5
+
+       The memory benchmark compares the bytes held by each 
+       trade when stored as a Trade object with an instance 
+       __dict__ (as Trade used to be), as a Trade object with
+       __slots__, and as a row of a TradeColumns object. The 
+       stock symbol and buy/sell strings are shared between 
+       trades so aren't counted.
+
+       The stress test (--stress THREADS) adds a synthetic 
+       market of trades to a ConcurrentPortfolio from several 
+       writer threads while a reader thread queries it, then 
+       checks the results against the same trades added to a 
+       Portfolio one at a time (exit status 1 if they differ).
+
+"""
+#Import some modules
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+from bisect import bisect_left
+from timeit import default_timer
+from time import time
+from supersimplestocks import Trade, TradeColumns, Portfolio, np, \
+                              set_interactive, ConcurrentPortfolio
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The methods timed, and the default portfolio sizes
+METHODS = ('add_trade', 'volweightsp', 'asi_calc', 'earliest_tr', 
+           '__repr__')
+SIZES = (10**3, 10**4, 10**5)
+# The default allowed growth in median latency before a method
+# counts as having regressed, as a fraction
+THRESHOLD = 0.25
+
+
+class DictTrade(object):
+    """ A Trade held in an instance __dict__, for comparison """
+
+    def __init__(self, stock, tr_price, tr_quant, bors, timestamp):
+        """ Initialise the class """
+        self.stock = stock.upper()
+        self.tr_price = tr_price
+        self.tr_quant = tr_quant
+        self.bors = bors
+        self.timestamp = timestamp
+
+
+def trade_bytes(trade):
+    """ 
+    NAME: trade_bytes(trade)
+
+    PURPOSE: Returns the bytes held by a single trade object: the
+             object itself, its __dict__ if it has one, and the 
+             price, quantity and timestamp floats it owns
+
+    INPUTS:  trade = A Trade or DictTrade object
+
+    OUTPUTS: The size in bytes
+    
+    """
+    size = sys.getsizeof(trade)
+    if hasattr(trade, '__dict__'):
+        size += sys.getsizeof(trade.__dict__)
+    for value in (trade.tr_price, trade.tr_quant, trade.timestamp):
+        size += sys.getsizeof(value)
+    # The trade list holds a pointer to each trade
+    return size + 8
+
+
+def memory_benchmark(num_trades=100000):
+    """ 
+    NAME: memory_benchmark(num_trades=100000)
+
+    PURPOSE: Prints the bytes per trade for num_trades trades
+             held each of the ways that a portfolio can hold them
+
+    INPUTS:  num_trades = The number of trades to make
+
+    OUTPUTS: A dict of the bytes per trade for each way
+
+    """
+    now = time()
+    rows = [("POP", 40.0 + i % 7, float(1 + i % 50), 'BS'[i % 2], now + i)
+            for i in xrange(num_trades)]
+
+    results = {}
+    results['Trade with __dict__'] = sum(
+            trade_bytes(DictTrade(*row)) for row in rows) / float(num_trades)
+    trades = [Trade(*row) for row in rows]
+    results['Trade with __slots__'] = sum(
+            trade_bytes(trade) for trade in trades) / float(num_trades)
+    if np is not None:
+        cols = TradeColumns(trades)
+        allocated = sum(getattr(cols, '_' + name).nbytes 
+                        for name, dtype in cols.COLUMNS)
+        results['TradeColumns (as allocated)'] = allocated / float(num_trades)
+        results['TradeColumns (filled)'] = sum(
+            getattr(cols, name).nbytes 
+            for name, dtype in cols.COLUMNS) / float(num_trades)
+
+    print "\n>>> Memory per trade, for %s trades <<<" % (num_trades)
+    for name in sorted(results, key=results.get, reverse=True):
+        print "    %-30s %6.1f bytes" % (name, results[name])
+    return results
+
+
+def generate_trades(num_trades, num_stocks=20, spread=3600., rate=None,
+                    seed=0, end=None):
+    """ 
+    NAME: generate_trades(num_trades, num_stocks=20, spread=3600., 
+                          rate=None, seed=0, end=None)
+
+    PURPOSE: Makes a seeded synthetic market of trades
+
+    INPUTS:  num_trades = The number of trades to make
+             num_stocks = The number of different stocks
+             spread     = The time in seconds that the trades are
+                          spread over, ending at 'end'
+             rate       = The mean trades per second. If given 
+                          this sets the spread instead
+             seed       = The random seed, so runs are repeatable
+             end        = The time of the last trade, or None for 
+                          the current time
+
+    OUTPUTS: A list of trade objects, in time order
+
+    NOTES: Each stock has its own price level, which drifts as a 
+           random walk. Some stocks are traded more than others,
+           and the gaps between trades are exponential (Poisson 
+           arrivals).
+
+    """
+    rand = random.Random(seed)
+    if rate is not None:
+        spread = num_trades / float(rate)
+    if end is None:
+        end = time()
+    stocks = ['S%03d' % (i) for i in xrange(num_stocks)]
+    prices = [rand.uniform(10., 500.) for sym in stocks]
+    weights = [1. / (i + 1) for i in xrange(num_stocks)]
+    cumweights = [sum(weights[:i+1]) for i in xrange(num_stocks)]
+
+    # Exponential gaps, scaled to fill the spread exactly
+    gaps = [rand.expovariate(1.) for i in xrange(num_trades)]
+    scale = spread / (sum(gaps) or 1.)
+    timestamp = end - spread
+
+    trades = []
+    for gap in gaps:
+        timestamp += gap*scale
+        pick = rand.random() * cumweights[-1]
+        i = min(bisect_left(cumweights, pick), num_stocks - 1)
+        prices[i] = max(0.01, prices[i] * (1. + rand.gauss(0., 0.001)))
+        trades.append(Trade(stocks[i], round(prices[i], 2), 
+                            float(rand.randint(1, 1000)), 
+                            'B' if rand.random() < 0.5 else 'S', 
+                            timestamp))
+    return trades
+
+
+def percentile(values, pct):
+    """ The pct'th percentile of a sorted list of values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.))]
+
+
+def time_calls(func, args_list):
+    """ 
+    NAME: time_calls(func, args_list)
+
+    PURPOSE: Calls func once with each set of arguments, timing 
+             each call
+
+    INPUTS:  func      = The function to call
+             args_list = A list of argument tuples
+
+    OUTPUTS: A dict of the number of calls, the throughput (calls
+             per second) and the latency percentiles in seconds
+
+    """
+    latencies = []
+    for args in args_list:
+        start = default_timer()
+        func(*args)
+        latencies.append(default_timer() - start)
+    total = sum(latencies)
+    latencies.sort()
+    return {'calls': len(latencies),
+            'throughput': len(latencies) / total if total else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None}
+
+
+def peak_memory():
+    """ 
+    The peak resident memory of this process in kB, if known.
+    This is the peak over the life of the process, so only the
+    growth of it over a run says what the run used.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kB, but Mac OS gives bytes
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def run_benchmark(num_trades, num_stocks=20, spread=3600., rate=None,
+                  columnar=False, queries=200, seed=0):
+    """ 
+    NAME: run_benchmark(num_trades, num_stocks=20, spread=3600., 
+                        rate=None, columnar=False, queries=200, seed=0)
+
+    PURPOSE: Times the main Portfolio methods for one size of 
+             portfolio
+
+    INPUTS:  num_trades = The number of trades in the portfolio
+             num_stocks, spread, rate, seed = As for generate_trades
+             columnar   = Whether to use a columnar portfolio
+             queries    = The number of timed calls of each query
+                          method (__repr__ is called fewer times)
+
+    OUTPUTS: A dict of the results of time_calls for each method,
+             plus 'memory_kb', how far the peak memory grew in 
+             kB during the run (or None if it isn't known)
+
+    NOTES: Run each size in a new process (see run_in_process)
+           for memory_kb to be the size's own.
+
+    """
+    start_peak = peak_memory()
+    trades = generate_trades(num_trades, num_stocks, spread, rate, seed)
+    rand = random.Random(seed + 1)
+    portfolio = Portfolio("Benchmark", [], columnar=columnar)
+
+    results = {}
+    results['add_trade'] = time_calls(portfolio.add_trade, 
+                                      [(trade,) for trade in trades])
+    stocks = portfolio.stock_types()
+    windows = [rand.choice((1., 5., 15., 60.)) for i in xrange(queries)]
+    results['volweightsp'] = time_calls(portfolio.volweightsp, 
+            [(rand.choice(stocks), window) for window in windows])
+    results['asi_calc'] = time_calls(portfolio.asi_calc,
+            [(window,) for window in windows])
+    results['earliest_tr'] = time_calls(portfolio.earliest_tr,
+            [()] * queries)
+    results['__repr__'] = time_calls(portfolio.__repr__, 
+            [()] * max(1, min(queries, 10**6 // num_trades)))
+    if start_peak is not None:
+        results['memory_kb'] = peak_memory() - start_peak
+    else:
+        results['memory_kb'] = None
+    return results
+
+
+def run_in_process(func, *args):
+    """ 
+    Calls func(*args) in a child process, returning its result,
+    so that the call starts with a peak memory of its own 
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stress_test(num_trades, num_stocks=20, threads=4, spread=3600., 
+                seed=0):
+    """ 
+    NAME: stress_test(num_trades, num_stocks=20, threads=4, 
+                      spread=3600., seed=0)
+
+    PURPOSE: Adds trades to a ConcurrentPortfolio from several
+             writer threads at once, while a reader thread 
+             queries it, and checks the results against a serial
+             replay of the same trades
+
+    INPUTS:  num_trades = The number of trades
+             num_stocks, spread, seed = As for generate_trades
+             threads    = The number of writer threads
+
+    OUTPUTS: A list of the problems found (empty if none)
+
+    NOTES: Each writer adds the trades of its own share of the 
+           stocks, as a feed handler would, some one at a time 
+           and some in small batches. Some of the trades added 
+           one at a time are added in reverse, so arrive late.
+
+    """
+    trades = generate_trades(num_trades, num_stocks, spread, seed=seed)
+    stocks = sorted(set(trade.stock for trade in trades))
+    # A time range that holds all of the trades
+    trange = spread/60. + 60.
+    portfolio = ConcurrentPortfolio("Stress", [])
+    problems = []
+    writing = [True]
+
+    def writer(mine):
+        for start in xrange(0, len(mine), 20):
+            chunk = mine[start:start+20]
+            if start % 40:
+                portfolio.add_trades(chunk)
+            else:
+                if start % 200 == 0:
+                    chunk.reverse()
+                for trade in chunk:
+                    portfolio.add_trade(trade)
+
+    def reader():
+        rand = random.Random(seed + 2)
+        seen = {}
+        try:
+            while writing[0]:
+                if portfolio.volweightsp(rand.choice(stocks), trange) < 0:
+                    problems.append("negative volweightsp")
+                if portfolio.asi_calc(trange) < 0:
+                    problems.append("negative asi_calc")
+                for stock, (times, rows, cum_pq, cum_q, num) in \
+                        portfolio.snapshot().iteritems():
+                    last = seen.get(stock, 0)
+                    if num < last:
+                        problems.append("%s lost trades" % (stock))
+                    seen[stock] = num
+                    if any(times[i] > times[i+1] 
+                           for i in xrange(max(0, last - 1), num - 1)):
+                        problems.append("%s out of time order" % (stock))
+        except Exception as err:
+            problems.append("reader failed: %r" % (err))
+
+    writers = [threading.Thread(target=writer, args=(
+                    [trade for trade in trades 
+                     if stocks.index(trade.stock) % threads == i],))
+               for i in xrange(threads)]
+    read = threading.Thread(target=reader)
+    start = default_timer()
+    read.start()
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = default_timer() - start
+    writing[0] = False
+    read.join()
+
+    serial = Portfolio("Serial", [])
+    for trade in trades:
+        serial.add_trade(trade)
+    if portfolio.num_tr() != serial.num_tr():
+        problems.append("num_tr %s, serially %s" % (portfolio.num_tr(),
+                                                    serial.num_tr()))
+    if sorted(portfolio.stock_types()) != sorted(serial.stock_types()):
+        problems.append("stock_types differ")
+    vwsp, serial_vwsp = (portfolio.volweightsp_all(trange), 
+                         serial.volweightsp_all(trange))
+    for stock in stocks:
+        if abs(vwsp.get(stock, 0.) - serial_vwsp[stock]) > \
+                1e-9*serial_vwsp[stock]:
+            problems.append("volweightsp of %s %r, serially %r" % (
+                            stock, vwsp.get(stock), serial_vwsp[stock]))
+    asi, serial_asi = portfolio.asi_calc(trange), serial.asi_calc(trange)
+    if abs(asi - serial_asi) > 1e-9*serial_asi:
+        problems.append("asi_calc %r, serially %r" % (asi, serial_asi))
+
+    print "\n>>> Stress test: %s trades of %s stocks from %s threads <<<" % (
+                num_trades, num_stocks, threads)
+    print "    %.0f trades per second" % (num_trades / elapsed)
+    for problem in problems:
+        print "    !! " + problem
+    if not problems:
+        print "    ... The same results as a serial replay"
+    return problems
+
+
+def print_results(all_results):
+    """ Prints a table of the results of run_benchmark for each size """
+    print "\n>>> Portfolio benchmarks <<<"
+    print "    %-12s %10s %12s %10s %10s %10s" % (
+            "method", "trades", "calls/s", "p50 (us)", "p90 (us)", 
+            "p99 (us)")
+    for size in sorted(all_results, key=int):
+        results = all_results[size]
+        for method in METHODS:
+            stats = results[method]
+            print "    %-12s %10s %12.1f %10.1f %10.1f %10.1f" % (
+                    method, size, stats['throughput'] or 0., 
+                    stats['p50']*1e6, stats['p90']*1e6, stats['p99']*1e6)
+        print "    %-12s %10s %12s  %s kB" % (
+                "memory used", size, "", results['memory_kb'])
+
+
+def find_regressions(all_results, baseline, thresholds):
+    """ 
+    NAME: find_regressions(all_results, baseline, thresholds)
+
+    PURPOSE: Compares a run's results with a baseline run
+
+    INPUTS:  all_results = The results of this run, by size
+             baseline    = The results of the baseline run, by size
+             thresholds  = The allowed fractional growth in median 
+                           latency for each method. The entry None
+                           is the default for any other method.
+
+    OUTPUTS: A list of messages, one per regression
+
+    """
+    regressions = []
+    for size, results in sorted(all_results.items()):
+        if size not in baseline:
+            continue
+        for method in METHODS:
+            if method not in baseline[size]:
+                continue
+            old = baseline[size][method]['p50']
+            new = results[method]['p50']
+            allowed = thresholds.get(method, thresholds[None])
+            if old and new > old * (1. + allowed):
+                regressions.append(
+                        "%s with %s trades: median latency %.1fus, was "
+                        "%.1fus (allowed +%d%%)" % (method, size, new*1e6, 
+                        old*1e6, allowed*100))
+    return regressions
+
+
+def parse_thresholds(values):
+    """ Turns '--threshold' options, X or METHOD=X, into a dict """
+    thresholds = {None: THRESHOLD}
+    for value in values or []:
+        method, sep, fraction = value.rpartition('=')
+        thresholds[method or None] = float(fraction)
+    return thresholds
+
+
+def main(argv=None):
+    """ Runs the benchmarks from the command line """
+    parser = argparse.ArgumentParser(
+            description="Benchmarks for supersimplestocks.py")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+            help="comma separated portfolio sizes, e.g. "
+                 "1000,10000,100000,1000000,10000000")
+    parser.add_argument('--stocks', type=int, default=20,
+            help="the number of different stocks")
+    parser.add_argument('--spread', type=float, default=3600.,
+            help="the time in seconds the trades are spread over")
+    parser.add_argument('--rate', type=float, default=None,
+            help="the mean trades per second (sets the spread instead)")
+    parser.add_argument('--queries', type=int, default=200,
+            help="the number of timed calls of each query method")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--columnar', action='store_true',
+            help="use columnar portfolios")
+    parser.add_argument('--memory', action='store_true',
+            help="also run the memory per trade benchmark")
+    parser.add_argument('--stress', type=int, metavar='THREADS',
+            help="also run the stress test of a ConcurrentPortfolio, "
+                 "with this many writer threads, on the largest size")
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--baseline', 
+            help="a saved JSON file to compare the results with")
+    parser.add_argument('--threshold', action='append', 
+            help="allowed growth in median latency, as a fraction, "
+                 "either for all methods (e.g. 0.25) or one method "
+                 "(e.g. asi_calc=0.5). May be repeated.")
+    args = parser.parse_args(argv)
+
+    # No printing or prompting while timing
+    set_interactive(False)
+
+    all_results = {}
+    sizes = [int(size) for size in args.sizes.split(',')]
+    for size in sizes:
+        all_results[str(size)] = run_in_process(run_benchmark, size, 
+                args.stocks, args.spread, args.rate, args.columnar, 
+                args.queries, args.seed)
+    print_results(all_results)
+
+    if args.memory:
+        memory_benchmark()
+
+    failed = False
+    if args.stress:
+        failed = bool(stress_test(max(sizes), args.stocks, args.stress,
+                                  args.spread, args.seed))
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump({'config': vars(args), 'results': all_results}, 
+                      outfile, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)['results']
+        regressions = find_regressions(all_results, baseline, 
+                                       parse_thresholds(args.threshold))
+        if regressions:
+            print "\n!! Performance regressions against %s:" % (
+                        args.baseline)
+            for regression in regressions:
+                print "    " + regression
+            return 1
+        print "\n... No regressions against %s" % (args.baseline)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -79,8 +79,8 @@ if __name__ == '__main__':
     trades = [pop_tr2, pop_tr3, pop_tr4, pop_tr5,
               tea_tr1, tea_tr2, gin_tr1, gin_tr2, gin_tr3]
 
-    # for item in trades:
-    [tradeport.add_trade(item) for item in trades]
+    # Add them all in one go
+    tradeport.add_trades(trades)
 
     # The portfolio is now bigger...
     print "\n ... Number of trades in %s's Portfolio: %s" % (
@@ -134,7 +134,7 @@ if __name__ == '__main__':
     trades2 = [pop_tr6, pop_tr7, ale_tr1, ale_tr2,
               tea_tr3, tea_tr4, gin_tr4]
 
-    [tradeport.add_trade(item) for item in trades2]
+    tradeport.add_trades(trades2)
 
     earliest = tradeport.earliest_tr()
 
@@ -0,0 +1,717 @@
+""" 
+NAME:   test_supersimplestocks.py
+
+PURPOSE:  Regression tests for supersimplestocks.py. Run with
+          python -m unittest test_supersimplestocks (or pytest).
+
+"""
+
+import cPickle
+import copy
+import math
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import supersimplestocks as sss
+
+
+sss.set_interactive(False)
+
+
+class TradeTests(unittest.TestCase):
+    """ Tests of the Trade class """
+
+    def test_pickle_round_trip(self):
+        """ A trade survives pickling with every protocol """
+        trade = sss.Trade('tea', 44.0, 2.0, 'B', 1464700000.0)
+        for module in (pickle, cPickle):
+            for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+                again = module.loads(module.dumps(trade, protocol))
+                self.assertEqual((again.stock, again.tr_price, again.tr_quant,
+                                  again.bors, again.timestamp),
+                                 ('TEA', 44.0, 2.0, 'B', 1464700000.0))
+        self.assertEqual(repr(copy.deepcopy(trade)), repr(trade))
+
+    def test_side_normalised(self):
+        """ A lower case side is taken as upper case, others rejected """
+        self.assertEqual(sss.Trade('TEA', 44.0, 2.0, 'b', 0.).bors, 'B')
+        self.assertEqual(sss.Trade('TEA', 44.0, 2.0, 's', 0.).bors, 'S')
+        for bors in ('x', '', None):
+            with self.assertRaises(sss.InvalidSideError):
+                sss.Trade('TEA', 44.0, 2.0, bors, 0.)
+
+
+class MarketTests(unittest.TestCase):
+    """ Tests of the Market class """
+
+    def test_stock_in_two_markets(self):
+        """ Each market keeps its own ids, without changing the stock """
+        tea = sss.Stock('TEA', 'Common', 0.0, 100.0)
+        pop = sss.Stock('POP', 'Common', 8.0, 100.0)
+        first, second = sss.Market([tea, pop]), sss.Market([pop, tea])
+        self.assertEqual((first.symid('TEA'), first.symid('pop')), (0, 1))
+        self.assertEqual((second.symid('tea'), second.symid('POP')), (1, 0))
+        self.assertFalse(hasattr(tea, 'symid'))
+        with self.assertRaises(sss.UnknownStockError):
+            first.symid('ALE')
+
+    def test_symbols_traded_outside_market(self):
+        """ A columnar portfolio's other symbols get ids but no stock """
+        tea = sss.Stock('TEA', 'Common', 0.0, 100.0)
+        market = sss.Market([tea])
+        portfolio = sss.Portfolio('test', [
+                sss.Trade('ALE', 10.0, 1.0, 'B', 1.0)], columnar=True,
+                market=market)
+        portfolio.add_trades([sss.Trade('GIN', 10.0, 1.0, 'S', 2.0)])
+        self.assertEqual(market.symbols.names, ['TEA', 'ALE', 'GIN'])
+        self.assertEqual(list(market), [tea])
+        yields, ratios = market.screen([[50.0, 100.0]])
+        self.assertEqual(yields.shape, (1, 2))
+        self.assertEqual(market.symid('tea'), 0)
+        for sym in ('ALE', 'gin'):
+            with self.assertRaises(sss.UnknownStockError):
+                market.symid(sym)
+
+    def test_unregister_keeps_others_compacted(self):
+        """ Unregistering takes out only that portfolio's trades """
+        now = [1000.0]
+        clock = lambda: now[0]
+        market = sss.Market(clock=clock)
+        first = sss.Portfolio('first', [], clock=clock)
+        second = sss.Portfolio('second', [], clock=clock)
+        second.set_retention(10.)
+        market.register(first)
+        market.register(second)
+        second.add_trade(sss.Trade('TEA', 10.0, 1.0, 'B', 100.0))
+        second.add_trade(sss.Trade('TEA', 30.0, 1.0, 'B', 990.0))
+        first.add_trades([sss.Trade('TEA', 50.0, 2.0, 'S', 995.0),
+                          sss.Trade('POP', 5.0, 1.0, 'B', 996.0)])
+        now[0] = 1060.0
+        self.assertEqual(second.compact(), 1)
+        self.assertEqual(len(second.tradelist), 1)
+        self.assertEqual(market.volweightsp('TEA', 60), 35.0)
+        market.unregister(first)
+        market.unregister(first)
+        self.assertEqual((market.portfolios, market.num_tr), ([second], 2))
+        self.assertEqual(market.volweightsp('TEA', 60), 20.0)
+        self.assertEqual(market.volweightsp('POP', 60), 0)
+        second.add_trade(sss.Trade('TEA', 40.0, 2.0, 'B', 999.0))
+        self.assertEqual(market.volweightsp('TEA', 60), 30.0)
+        market.register(first)
+        self.assertEqual(market.num_tr, 5)
+
+    def test_register_failure_leaves_market(self):
+        """ A portfolio that can't be followed isn't counted """
+        class Unfollowable(sss.Portfolio):
+            def add_listener(self, listener):
+                raise TypeError("can't be followed")
+        market = sss.Market()
+        trades = [sss.Trade('TEA', 10.0, 1.0, 'B', 1.0)]
+        with self.assertRaises(TypeError):
+            market.register(Unfollowable('test', trades))
+        self.assertEqual((market.portfolios, market.num_tr), ([], 0))
+        market.register(sss.Portfolio('test', trades))
+        self.assertEqual(market.num_tr, 1)
+
+
+NOW = 100000.0
+STOCKS = ('TEA', 'POP', 'ALE', 'GIN', 'JOE')
+
+
+def random_trades(num, seed, span=3600.0):
+    """ num trades of STOCKS, timed in no order over span seconds to NOW """
+    rand = random.Random(seed)
+    return [sss.Trade(rand.choice(STOCKS), round(rand.uniform(1, 500), 2),
+                      float(rand.randint(1, 100)), rand.choice('BS'),
+                      NOW - rand.uniform(0, span)) for i in xrange(num)]
+
+
+def scanned_vwsp(trades, stock, start, end=None):
+    """ The vol. weighted price of a stock, by looking at every trade """
+    within = [trade for trade in trades if trade.stock == stock and
+              start <= trade.timestamp and (end is None or
+                                            trade.timestamp < end)]
+    if not within:
+        return 0
+    return (sum(trade.tr_price*trade.tr_quant for trade in within)/
+            sum(trade.tr_quant for trade in within))
+
+
+def scanned_asi(trades, start, end=None):
+    """ The All Share Index, by looking at every trade """
+    prices = [scanned_vwsp(trades, stock, start, end) for stock in STOCKS]
+    prices = [price for price in prices if price]
+    if not prices:
+        return 0
+    return math.exp(sum(math.log(price) for price in prices)/len(prices))
+
+
+class IndexTests(unittest.TestCase):
+    """ Tests of the queries answered through the index """
+
+    def test_against_scan(self):
+        """ Every way of holding the trades gives the scanned answers """
+        trades = random_trades(3000, 1)
+        for options in ({'indexed': False}, {}, {'columnar': True}):
+            portfolio = sss.Portfolio('test', trades[:1000],
+                                      clock=lambda: NOW, **options)
+            # Later trades arrive out of time order, some one by one
+            portfolio.add_trades(trades[1000:2500])
+            for trade in trades[2500:]:
+                portfolio.add_trade(trade)
+            for trange in (1, 5, 15, 60):
+                start = NOW - trange*60.
+                for stock in STOCKS:
+                    self.assertAlmostEqual(
+                        portfolio.volweightsp(stock, trange),
+                        scanned_vwsp(trades, stock, start), places=9)
+                self.assertAlmostEqual(portfolio.asi_calc(trange),
+                                       scanned_asi(trades, start), places=9)
+            self.assertEqual(portfolio.volweightsp('NONE', 60), 0)
+
+
+class TimeRangeTests(unittest.TestCase):
+    """ Tests of start, end, asof and the portfolio's clock """
+
+    def test_ranges(self):
+        """ Time ranges that don't end now give the scanned answers """
+        trades = random_trades(2000, 2)
+        for options in ({'indexed': False}, {}, {'columnar': True}):
+            now = [NOW]
+            portfolio = sss.Portfolio('test', trades, clock=lambda: now[0],
+                                      **options)
+            start, end = NOW - 3000., NOW - 1200.
+            for stock in STOCKS:
+                self.assertAlmostEqual(
+                    portfolio.volweightsp(stock, start=start, end=end),
+                    scanned_vwsp(trades, stock, start, end), places=9)
+                self.assertAlmostEqual(
+                    portfolio.volweightsp(stock, 15, asof=end),
+                    scanned_vwsp(trades, stock, end - 900., end), places=9)
+            self.assertAlmostEqual(portfolio.asi_calc(start=start, end=end),
+                                   scanned_asi(trades, start, end), places=9)
+            self.assertAlmostEqual(portfolio.asi_calc(15, asof=end),
+                                   scanned_asi(trades, end - 900., end),
+                                   places=9)
+
+            # The earliest trade's age, as of now or of asof
+            first = min(trade.timestamp for trade in trades)
+            self.assertEqual(portfolio.earliest_tr(), NOW - first)
+            within = min(trade.timestamp for trade in trades
+                         if start <= trade.timestamp < end)
+            self.assertEqual(portfolio.earliest_tr(start, end), NOW - within)
+            self.assertEqual(portfolio.earliest_tr(start, asof=end),
+                             end - within)
+            first_tea = min(trade.timestamp for trade in trades
+                            if trade.stock == 'TEA')
+            self.assertEqual(portfolio.earliest_tr(stock='TEA'),
+                             NOW - first_tea)
+            self.assertEqual(portfolio.earliest_tr(NOW + 1.), 0)
+
+            # A range that ends now moves with the clock
+            now[0] = NOW + 600.
+            self.assertAlmostEqual(portfolio.volweightsp('TEA', 15),
+                                   scanned_vwsp(trades, 'TEA', NOW - 300.),
+                                   places=9)
+            self.assertAlmostEqual(portfolio.asi_calc(15),
+                                   scanned_asi(trades, NOW - 300.), places=9)
+            self.assertEqual(portfolio.earliest_tr(), NOW + 600. - first)
+
+
+class ShardedPortfolioTests(unittest.TestCase):
+    """ Tests of the ShardedPortfolio class """
+
+    def test_against_portfolio(self):
+        """ Two shards give a Portfolio's answers, and pass on errors """
+        trades = random_trades(2000, 3)
+        portfolio = sss.Portfolio('test', trades, clock=lambda: NOW)
+        sharded = sss.ShardedPortfolio('test', trades[:1000], shards=2,
+                                       buffer_size=300, clock=lambda: NOW)
+        try:
+            sharded.add_trades(trades[1000:1900])
+            for trade in trades[1900:]:
+                sharded.add_trade(trade)
+            self.assertEqual(sharded.num_tr(), 2000)
+            self.assertEqual(sharded.num_stocks(), len(STOCKS))
+            for trange in (5, 60):
+                for stock in STOCKS:
+                    self.assertAlmostEqual(sharded.volweightsp(stock, trange),
+                                           portfolio.volweightsp(stock, trange),
+                                           places=9)
+                self.assertAlmostEqual(sharded.asi_calc(trange),
+                                       portfolio.asi_calc(trange), places=9)
+            self.assertEqual(sharded.earliest_tr(), portfolio.earliest_tr())
+
+            # An error in a shard is raised here, and the shard goes on
+            with self.assertRaises(sss.StockError):
+                sharded._call('quantile', ('TEA', 0.5))
+            self.assertEqual(sharded.num_tr(), 2000)
+        finally:
+            sharded.close()
+
+
+class ReportTests(unittest.TestCase):
+    """ Tests of the printed trades """
+
+    TRADES = [('TEA', 44.0, 2.0, 'B', 1464700000.0),
+              ('POP', 8.5, 100.0, 'S', 1464700061.25),
+              ('TEA', 45.125, 3.0, 'S', 1464700122.5)]
+    LINES = ['\n2016-05-31, 13:06:40  -- Bought 2.0 of TEA at 44.0p',
+             '\n2016-05-31, 13:07:41  -- Sold 100.0 of POP at 8.5p',
+             '\n2016-05-31, 13:08:42  -- Sold 3.0 of TEA at 45.125p']
+
+    def portfolios(self):
+        """ The trades in each way of holding them """
+        trades = [sss.Trade(*trade) for trade in self.TRADES]
+        return [sss.Portfolio('Graham', trades, **options) for options in
+                ({'indexed': False}, {}, {'columnar': True})]
+
+    def test_repr(self):
+        """ The portfolio prints as it always has """
+        for portfolio in self.portfolios():
+            self.assertEqual(repr(portfolio), ''.join(self.LINES))
+            self.assertEqual(''.join(portfolio.iter_report(chunk_size=2)),
+                             ''.join(self.LINES))
+        output = StringIO()
+        sys.stdout, stdout = output, sys.stdout
+        sss.set_interactive(True)
+        try:
+            text = repr(self.portfolios()[0])
+        finally:
+            sss.set_interactive(False)
+            sys.stdout = stdout
+        self.assertEqual(output.getvalue(), "\n\nGraham's Portfolio:\n")
+        self.assertEqual(text, ''.join(self.LINES))
+
+    def test_filters(self):
+        """ A stock, time range or page prints only those trades """
+        lines = self.LINES
+        for portfolio in self.portfolios():
+            for kwargs, expected in (
+                    ({'stock': 'tea'}, [lines[0], lines[2]]),
+                    ({'stock': 'GIN'}, []),
+                    ({'page': 0, 'page_size': 2}, lines[:2]),
+                    ({'page': 1, 'page_size': 2}, lines[2:]),
+                    ({'page': 2, 'page_size': 2}, []),
+                    ({'stock': 'TEA', 'page': 1, 'page_size': 1}, lines[2:]),
+                    ({'start': 1464700061.25, 'end': 1464700122.5},
+                     lines[1:2])):
+                self.assertEqual(''.join(portfolio.iter_report(**kwargs)),
+                                 ''.join(expected))
+                fileobj = StringIO()
+                portfolio.write_report(fileobj, **kwargs)
+                self.assertEqual(fileobj.getvalue(), ''.join(expected))
+
+
+class CacheTests(unittest.TestCase):
+    """ Tests of the cache of query results """
+
+    def test_miss_uses_standing_window(self):
+        """ A query the cache can't answer is answered by its window """
+        now = [100.0]
+        portfolio = sss.Portfolio('test', [], clock=lambda: now[0])
+        portfolio.add_trades([sss.Trade('TEA', 10.0, 1.0, 'B', 90.0),
+                              sss.Trade('TEA', 20.0, 3.0, 'S', 95.0)])
+        portfolio.add_window(5)
+        portfolio.enable_cache()
+        window, calls = portfolio.windows[5], []
+        def vwsp(*args):
+            calls.append(args)
+            return sss.RollingWindow.vwsp(window, *args)
+        window.vwsp = vwsp
+        self.assertEqual(portfolio.volweightsp('TEA', 5), 17.5)
+        self.assertEqual(portfolio.volweightsp('TEA', 5), 17.5)
+        self.assertEqual(len(calls), 1)
+        self.assertAlmostEqual(portfolio.asi_calc(5), 17.5)
+
+    def test_clock_read_once(self):
+        """ A query reads the clock once, whether cached or not """
+        reads = []
+        def clock():
+            reads.append(None)
+            return 1000.0
+        portfolio = sss.Portfolio('test', [
+                sss.Trade('TEA', 10.0, 1.0, 'B', 990.0)], clock=clock)
+        for cached in (False, True):
+            if cached:
+                portfolio.enable_cache()
+            for query in (lambda: portfolio.volweightsp('TEA', 15),
+                          lambda: portfolio.volweightsp_all(15),
+                          lambda: portfolio.asi_calc(15)):
+                del reads[:]
+                query()
+                self.assertEqual(len(reads), 1)
+
+
+class RollingWindowTests(unittest.TestCase):
+    """ Tests of the RollingWindow class """
+
+    def test_cancellation(self):
+        """ A huge trade ageing out leaves the others' sums exact """
+        window = sss.RollingWindow(1)
+        window.add('TEA', 1e17, 1.0, 100.0, now=100.0)
+        window.add('TEA', 1.0, 1.0, 120.0, now=120.0)
+        window.add('TEA', 3.0, 1.0, 130.0, now=130.0)
+        window.expire(161.0)
+        self.assertEqual(window.vwsp('TEA', 161.0), 2.0)
+        self.assertEqual(window.asi(161.0), 2.0)
+
+        # Nor can it stop trades being added to a portfolio
+        now = [100.0]
+        portfolio = sss.Portfolio('test', [], clock=lambda: now[0])
+        portfolio.add_window(1)
+        portfolio.add_trade(sss.Trade('TEA', 1e17, 1.0, 'B', 100.0))
+        now[0] = 161.0
+        portfolio.add_trade(sss.Trade('TEA', 1.0, 1.0, 'B', 120.0))
+        self.assertEqual(portfolio.volweightsp('TEA', 1), 1.0)
+
+
+class FeedConsumerTests(unittest.TestCase):
+    """ Tests of the FeedConsumer class """
+
+    def test_failed_batch(self):
+        """ A batch the portfolio can't add fails the queries behind it """
+        class Refusing(sss.Portfolio):
+            def add_trades(self, trades):
+                if any(trade.stock == 'BAD' for trade in trades):
+                    raise RuntimeError('refused')
+                return sss.Portfolio.add_trades(self, trades)
+        consumer = sss.FeedConsumer(Refusing('test', []))
+        consumer.put(('TEA', 10.0, 1.0, 'B', 1.0))
+        consumer.put(('BAD', 10.0, 1.0, 'B', 2.0))
+        failed = consumer.volweightsp('TEA', 5)
+        consumer.put(('TEA', 20.0, 1.0, 'B', 3.0))
+        answered = consumer.asi_calc(1e9)
+        with self.assertRaises(RuntimeError):
+            failed.result(5)
+        self.assertGreater(answered.result(5), 0)
+        self.assertTrue(consumer.close(5))
+        self.assertIn(consumer.failed, (1, 2))
+        self.assertTrue(isinstance(consumer.error, RuntimeError))
+
+    def test_close_timeout(self):
+        """ close() gives up, returning False, if the queue stays full """
+        release = threading.Event()
+        class Slow(sss.Portfolio):
+            def add_trades(self, trades):
+                release.wait()
+                return sss.Portfolio.add_trades(self, trades)
+        portfolio = Slow('test', [], clock=lambda: 42.0)
+        consumer = sss.FeedConsumer(portfolio, maxsize=1, batch_size=1)
+        consumer.put(('TEA', 10.0, 1.0, 'B'))
+        consumer.put(('TEA', 20.0, 1.0, 'B'))
+        self.assertFalse(consumer.close(0.2))
+        release.set()
+        self.assertTrue(consumer.close(5))
+        self.assertEqual([trade.timestamp for trade in portfolio.tradelist],
+                         [42.0, 42.0])
+
+    def test_result_timeout(self):
+        """ result() gives up after its timeout """
+        result = sss.FeedResult('asi_calc', (5,))
+        with self.assertRaises(RuntimeError):
+            result.result(0.01)
+
+
+class InstrumentationTests(unittest.TestCase):
+    """ Tests of the instrumentation of methods """
+
+    def tearDown(self):
+        sss.disable_instrumentation()
+        sss.instrumentation.reset()
+
+    def test_generator_timed_while_iterated(self):
+        """ A generator method's work is counted as it is iterated """
+        portfolio = sss.Portfolio('test', [
+                sss.Trade('TEA', 10.0, 1.0, 'B', float(i)) for i in xrange(3)])
+        instrumentation = sss.enable_instrumentation()
+        chunks = portfolio.iter_report(chunk_size=1)
+        self.assertEqual(instrumentation.calls, {})
+        self.assertEqual(len(list(chunks)), 3)
+        report = instrumentation.snapshot()['Portfolio.iter_report']
+        self.assertEqual((report['calls'], report['trades_scanned']), (1, 3))
+        self.assertGreaterEqual(report['total_seconds'],
+            instrumentation.seconds['Trade.__repr__'])
+
+        # One that isn't finished is counted when it is closed
+        chunks = portfolio.iter_report(chunk_size=1)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(instrumentation.calls['Portfolio.iter_report'], 2)
+
+        # Inherited methods are put back as they were
+        sss.disable_instrumentation()
+        self.assertNotIn('iter_report', vars(sss.Portfolio))
+
+    def test_threads_counted_apart(self):
+        """ Calls from many threads are each counted for their own trades """
+        portfolios = [sss.Portfolio('test', [
+                sss.Trade('TEA', 10.0, 1.0, 'B', float(i))
+                for i in xrange(num)], indexed=False) for num in (10, 1000)]
+        instrumentation = sss.enable_instrumentation()
+        for portfolio in portfolios:
+            portfolio.volweightsp('TEA', None, None, 0.)
+        expected = instrumentation.scanned['Portfolio.volweightsp']*100
+        instrumentation.reset()
+        def query(portfolio):
+            for i in xrange(100):
+                portfolio.volweightsp('TEA', None, None, 0.)
+        threads = [threading.Thread(target=query, args=(portfolio,))
+                   for portfolio in portfolios*2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(instrumentation.calls['Portfolio.volweightsp'], 400)
+        self.assertEqual(instrumentation.scanned['Portfolio.volweightsp'],
+                         expected*2)
+        self.assertEqual(sum(instrumentation.counts['Portfolio.volweightsp']),
+                         400)
+
+
+class ConcurrentPortfolioTests(unittest.TestCase):
+    """ Tests of the ConcurrentPortfolio class """
+
+    def test_shared_queries_only(self):
+        """ It answers a Portfolio's queries, without its extra features """
+        trades = [sss.Trade('TEA', 10.0 + i, 1.0, 'B', float(i))
+                  for i in xrange(5)]
+        portfolio = sss.Portfolio('test', trades)
+        concurrent = sss.ConcurrentPortfolio('test', trades[:2], stripes=4)
+        concurrent.add_trades(trades[2:4])
+        concurrent.add_trade(trades[4])
+        for method, args in (('volweightsp', ('TEA', None, None, 0., 10.)),
+                             ('asi_calc', (None, None, 0., 10.)),
+                             ('num_tr', ()), ('stock_types', ())):
+            self.assertEqual(getattr(concurrent, method)(*args),
+                             getattr(portfolio, method)(*args))
+        self.assertEqual(concurrent.position('TEA'), portfolio.position('TEA'))
+        for method in ('add_window', 'add_bars', 'add_sketches',
+                       'enable_cache', 'set_retention', 'add_listener'):
+            self.assertFalse(hasattr(concurrent, method), method)
+
+        # So a market can't follow it, and is left as it was
+        market = sss.Market()
+        with self.assertRaises(AttributeError):
+            market.register(concurrent)
+        self.assertEqual((market.portfolios, market.num_tr), ([], 0))
+
+    def test_stress(self):
+        """ Writers and a reader at once give a serial replay's answers """
+        trades = random_trades(4000, 4)
+        concurrent = sss.ConcurrentPortfolio('test', [], stripes=4,
+                                             clock=lambda: NOW)
+        # Each writer adds its own stocks' trades, some late, some
+        # one at a time and some in batches
+        feeds = [[trade for trade in trades if trade.stock in stocks]
+                 for stocks in (STOCKS[:2], STOCKS[2:4], STOCKS[4:])]
+        for feed in feeds:
+            for start in xrange(0, len(feed), 100):
+                feed[start:start+20] = reversed(feed[start:start+20])
+        problems, writing = [], [True]
+
+        def writer(feed):
+            for start in xrange(0, len(feed), 20):
+                if start % 40:
+                    concurrent.add_trades(feed[start:start+20])
+                else:
+                    for trade in feed[start:start+20]:
+                        concurrent.add_trade(trade)
+
+        def reader():
+            seen = {}
+            while writing[0]:
+                if concurrent.asi_calc(60) < 0:
+                    problems.append('negative asi_calc')
+                for stock, (times, rows, cum_pq, cum_q, num) in \
+                        concurrent.snapshot().iteritems():
+                    if num < seen.get(stock, 0):
+                        problems.append('%s lost trades' % (stock))
+                    seen[stock] = num
+                    if any(times[i] > times[i+1] for i in xrange(num - 1)):
+                        problems.append('%s out of time order' % (stock))
+
+        threads = [threading.Thread(target=writer, args=(feed,))
+                   for feed in feeds]
+        read = threading.Thread(target=reader)
+        read.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writing[0] = False
+        read.join()
+        self.assertEqual(problems, [])
+
+        serial = sss.Portfolio('test', [], clock=lambda: NOW)
+        for feed in feeds:
+            for trade in feed:
+                serial.add_trade(trade)
+        self.assertEqual(concurrent.num_tr(), serial.num_tr())
+        for stock, vwsp in serial.volweightsp_all(60).iteritems():
+            self.assertAlmostEqual(concurrent.volweightsp(stock, 60), vwsp,
+                                   places=9)
+        self.assertAlmostEqual(concurrent.asi_calc(60), serial.asi_calc(60),
+                               places=9)
+        self.assertEqual(concurrent.position_all(), serial.position_all())
+
+
+class SketchTests(unittest.TestCase):
+    """ Tests of the quantile sketches """
+
+    def test_periods_rolled_up(self):
+        """ Old periods are rolled up, keeping every trade """
+        sketches = sss.TradeSketches(bucket=60, max_periods=10, seed=1)
+        for i in xrange(6000):
+            sketches.add(float(i % 97), 1.0, float(i))
+        self.assertEqual(len(sketches), 10)
+        self.assertEqual((sketches.rolled_from, sketches.rolled_to), 
+                         (0.0, 5400.0))
+        self.assertEqual(sketches.window()[0].count, 6000)
+        self.assertEqual(sketches.window(5400, None)[0].count, 600)
+        # A late trade, and a window reaching into the roll up
+        sketches.add(1.0, 1.0, 30.0)
+        self.assertEqual(sketches.window(None, 60)[0].count, 5401)
+        self.assertTrue(all(sketch._random is sketches._random 
+                            for sketch in sketches.prices))
+
+
+class RetentionTests(unittest.TestCase):
+    """ Tests of compacting old trades into the archive """
+
+    def test_compaction(self):
+        """ List and columnar portfolios compact to the same answers """
+        now = [0.]
+        clock = lambda: now[0]
+        trades = [sss.Trade('ABC'[i % 3], 1.0 + i % 7, 1.0 + i % 5, 'B', 
+                            i*7.) for i in xrange(2000)]
+        # A trade more than the retention late
+        trades.insert(1500, sss.Trade('A', 5.0, 2.0, 'S', 1000.0))
+        full = sss.Portfolio('full', trades, clock=clock)
+        for columnar in (False, True):
+            portfolio = sss.Portfolio('test', [], columnar=columnar, 
+                                      clock=clock)
+            now[0] = 0.
+            portfolio.set_retention(30, 60)
+            for trade in trades:
+                now[0] = max(now[0], trade.timestamp + 1)
+                portfolio.add_trade(trade)
+            self.assertLess(len(portfolio.tradelist), 300)
+            self.assertEqual(portfolio.num_tr(), full.num_tr())
+            for trange in (5, 29):
+                self.assertAlmostEqual(portfolio.asi_calc(trange), 
+                                       full.asi_calc(trange))
+            self.assertAlmostEqual(portfolio.volweightsp('A', start=0),
+                                   full.volweightsp('A', start=0))
+            self.assertEqual(portfolio.position_all(), full.position_all())
+            self.assertEqual(
+                    [repr(trade) for trade in portfolio.recent_trades(5)],
+                    [repr(trade) for trade in full.recent_trades(5)])
+
+
+class PositionTests(unittest.TestCase):
+    """ Tests of the positions kept by a portfolio """
+
+    ROWS = [('TEA', 10.0, 5.0, 'b', 1.0), ('TEA', 12.0, 2.0, 's', 2.0),
+            ('POP', 20.0, 1.0, 's', 3.0), ('TEA', 11.0, 1.0, 'B', 4.0)]
+
+    def test_lower_case_sides(self):
+        """ Lower case sides give the same positions in every form """
+        expected = {'TEA': (4.0, 10.25, 4.0, 6.0, 2.0), 
+                    'POP': (-1.0, 20.0, 0.0, 0.0, 1.0)}
+        records = sss.np.zeros(len(self.ROWS), dtype=sss.TRADE_DTYPE)
+        for name, column in zip(('stock', 'tr_price', 'tr_quant', 'bors', 
+                                 'timestamp'), zip(*self.ROWS)):
+            records[name] = column
+        for columnar in (False, True):
+            for trades in ([sss.Trade(*row) for row in self.ROWS], records):
+                portfolio = sss.Portfolio('test', [], columnar=columnar)
+                portfolio.add_trades(trades)
+                for stock, values in expected.iteritems():
+                    position = portfolio.position(stock)
+                    self.assertEqual(
+                            (position['net_quant'], position['avg_price'],
+                             position['realized'], position['bought'], 
+                             position['sold']), values)
+
+    def test_from_journal(self):
+        """ A reopened journal has the same positions as its trades """
+        trades = [sss.Trade(*row) for row in self.ROWS]
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(filename, 'wb') as journal:
+                sss.write_binary_trades(journal, trades)
+            reopened = sss.Portfolio.from_journal('test', filename,
+                                                  clock=lambda: 1e10)
+            reopened.close()
+            self.assertEqual(reopened.position_all(), 
+                             sss.Portfolio('test', trades).position_all())
+            latest = max(trade.timestamp for trade in trades)
+            self.assertEqual(reopened.earliest_tr(start=latest), 
+                             1e10 - latest)
+        finally:
+            os.remove(filename)
+
+    def test_invalid_side_rejected(self):
+        """ A record with an invalid side is rejected, taking nothing """
+        records = sss.np.zeros(2, dtype=sss.TRADE_DTYPE)
+        records['stock'], records['timestamp'] = 'TEA', 1.0
+        records['tr_price'], records['tr_quant'] = 10.0, 1.0
+        records['bors'] = ['B', 'x']
+        for columnar in (False, True):
+            portfolio = sss.Portfolio('test', [], columnar=columnar)
+            with self.assertRaises(sss.InvalidSideError):
+                portfolio.add_trades(records)
+            self.assertEqual(len(portfolio.tradelist), 0)
+        with self.assertRaises(sss.InvalidSideError):
+            sss.Position('TEA').add(10.0, 1.0, 'x')
+
+
+
+class RecordTests(unittest.TestCase):
+    """ Tests of the trades as arrays of trade records """
+
+    def test_round_trip(self):
+        """ Records give back the same trades, or refuse long symbols """
+        trades = [sss.Trade('TEA', 10.0, 1.0, 'B', 1.0),
+                  sss.Trade('LONGSYMB', 20.0, 2.0, 'S', 2.0)]
+        for columnar in (False, True):
+            records = sss.Portfolio('test', trades,
+                                    columnar=columnar).to_records()
+            again = sss.Portfolio('test', [], columnar=columnar)
+            again.add_trades(records)
+            self.assertEqual(repr(again), repr(sss.Portfolio('test', trades)))
+            portfolio = sss.Portfolio('test', trades + [
+                    sss.Trade('LONGSYMBOL1', 30.0, 3.0, 'B', 3.0)],
+                    columnar=columnar)
+            with self.assertRaises(sss.StockError):
+                portfolio.to_records()
+
+
+class ReaderTests(unittest.TestCase):
+    """ Tests of the trade file readers """
+
+    def test_non_finite_values_rejected(self):
+        """ NaN and infinite prices and quantities raise a StockError """
+        for price, quant, error in (('nan', '2', sss.InvalidPriceError),
+                                    ('inf', '2', sss.InvalidPriceError),
+                                    ('44', 'nan', sss.InvalidQuantityError),
+                                    ('44', '-inf', sss.InvalidQuantityError)):
+            line = 'TEA,%s,%s,B,1464700000\n' % (price, quant)
+            with self.assertRaises(error):
+                list(sss.read_csv_trades(StringIO(line)))
+            record = sss.TRADE_RECORD.pack('TEA', float(price), float(quant),
+                                           1464700000.0, 'B')
+            with self.assertRaises(error):
+                list(sss.read_binary_trades(StringIO(record)))
+
+
+if __name__ == '__main__':
+    unittest.main()